@@ -0,0 +1,338 @@
+"""
+Keep running aggregates of the grants data for the visualizations, so
+that the charts can be built from compact summaries that are updated
+chunk by chunk instead of the full grants table. The summaries are
+saved next to the harvested data, so that a saved file can be charted
+again without reading its rows.
+"""
+
+import heapq
+import json
+import math
+import threading
+import pandas as pd
+import pyarrow as pa
+from pyarrow import parquet as pq
+
+TOP_GRANT_RECEIVERS = 15
+TOP_GRANTS_BY_RELATED_RECORDS = 50
+
+# The only grants data columns the visualizations need.
+CHART_COLUMNS = ['UT', 'Publication Year', 'Grant Amount, USD',
+                 'Principal Investigator Institution', 'Funding Agency', 'Funding Country',
+                 'Document Title', 'Related WoS Records Count']
+
+# The dimensions of the aggregate cube, and the measures summed up for
+# each of their combinations.
+CUBE_DIMENSIONS = ['Publication Year', 'Funding Country', 'Funding Agency',
+                   'Principal Investigator Institution']
+CUBE_MEASURES = ['Grant Amount, USD', 'Number of Grants']
+TOP_GRANTS_COLUMNS = ['UT', 'Related WoS Records Count', 'Document Title']
+
+
+def cube_path(path):
+    """Return the path of the aggregate cube saved next to a grants data
+    file.
+
+    :param path: str.
+    :return: str.
+    """
+    return f'{path.rsplit(".", 1)[0]}.cube.parquet'
+
+
+def year_value(value):
+    """Return a publication year as an int, or None if it is missing.
+
+    :param value: int, str or None.
+    :return: int or None.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def amount_value(value):
+    """Return a grant amount as a float, counting a missing amount as 0.
+
+    :param value: float, str or None.
+    :return: float.
+    """
+    try:
+        amount = float(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return 0.0 if math.isnan(amount) else amount
+
+
+def name_value(value, missing='(name unavailable)'):
+    """Return a name, or the placeholder of a missing name.
+
+    :param value: str or None.
+    :param missing: str.
+    :return: str.
+    """
+    if value is None or value == '' or value is pd.NA or value != value:
+        return missing
+    return value
+
+
+def count_value(value):
+    """Return a count as an int, or None if it is missing.
+
+    :param value: int or None.
+    :return: int or None.
+    """
+    if value is None or value is pd.NA or value != value:
+        return None
+    return int(value)
+
+
+class GrantsAggregates:
+    """Running totals of the grants data for all the visualizations: a
+    cube of the funding volume and number of grants by publication year,
+    funding country, funding agency and institution, its roll-ups to the
+    dimensions of each chart, and a bounded heap of the grants with the
+    most associated Web of Science records. Each update only touches the
+    totals of the records it adds, and a snapshot of the charts can be
+    taken at any moment, i.e. while a harvest is still running. The
+    memory used depends on the number of distinct combinations of the
+    cube dimensions, not on the number of grants.
+    """
+
+    def __init__(self, top_grants=TOP_GRANTS_BY_RELATED_RECORDS):
+        self.top_grants_limit = top_grants
+        self.cube = {}
+        self.by_year = {}
+        self.by_institution = {}
+        self.by_funder = {}
+        # Entries of (related records count, -record number, UT, title),
+        # so that the ties are won by the earliest records.
+        self.top_grants = []
+        self.records = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        with self.lock:
+            state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def add_totals(self, year, country, agency, institution, amount, count):
+        """Add a funding volume and a number of grants to the cube and
+        to its roll-ups. The caller must hold the lock.
+
+        :param year: int or None.
+        :param country: str.
+        :param agency: str.
+        :param institution: str.
+        :param amount: float.
+        :param count: int.
+        """
+        for totals, key in ((self.cube, (year, country, agency, institution)),
+                            (self.by_year, year)):
+            entry = totals.get(key)
+            if entry is None:
+                totals[key] = [amount, count]
+            else:
+                entry[0] += amount
+                entry[1] += count
+        self.by_institution[institution] = self.by_institution.get(institution, 0.0) + amount
+        funder = (agency, country)
+        self.by_funder[funder] = self.by_funder.get(funder, 0.0) + amount
+
+    def add_top_grant(self, related_records_count, ut, title):
+        """Offer a grant to the bounded heap of the top grants. The
+        caller must hold the lock.
+
+        :param related_records_count: int or None.
+        :param ut: str.
+        :param title: str.
+        """
+        self.records += 1
+        related_records_count = count_value(related_records_count)
+        if related_records_count is None:
+            return
+        entry = (related_records_count, -self.records, ut, title)
+        if len(self.top_grants) < self.top_grants_limit:
+            heapq.heappush(self.top_grants, entry)
+        elif entry > self.top_grants[0]:
+            heapq.heapreplace(self.top_grants, entry)
+
+    def write_records(self, records):
+        """Update the running totals with a list of parsed grants
+        records, i.e. a page returned by fetch_data_batch.
+
+        :param records: list of dict.
+        """
+        with self.lock:
+            for rec in records:
+                self.add_totals(year_value(rec['Publication Year']),
+                                name_value(rec['Funding Country'], ''),
+                                name_value(rec['Funding Agency']),
+                                name_value(rec['Principal Investigator Institution']),
+                                amount_value(rec['Grant Amount, USD']),
+                                0 if rec['UT'] is None else 1)
+                self.add_top_grant(rec['Related WoS Records Count'], rec['UT'],
+                                   rec['Document Title'])
+
+    def write(self, chunk):
+        """Update the running totals with a chunk of grants records.
+
+        :param chunk: pandas dataframe.
+        """
+        chunk = pd.DataFrame({
+            'UT': chunk['UT'],
+            'Publication Year': pd.to_numeric(chunk['Publication Year'],
+                                              errors='coerce').astype('Int64'),
+            'Grant Amount, USD': pd.to_numeric(chunk['Grant Amount, USD'],
+                                               errors='coerce').fillna(0),
+            'Principal Investigator Institution': (
+                chunk['Principal Investigator Institution'].replace(to_replace='', value=None).
+                fillna('(name unavailable)')
+            ),
+            'Funding Agency': (chunk['Funding Agency'].replace(to_replace='', value=None).
+                               fillna('(name unavailable)')),
+            'Funding Country': chunk['Funding Country'].astype(object).fillna(''),
+            'Document Title': chunk['Document Title'],
+            'Related WoS Records Count': chunk['Related WoS Records Count']
+        }).reset_index(drop=True)
+        totals = chunk.groupby(CUBE_DIMENSIONS, dropna=False).agg(**{
+            'Grant Amount, USD': ('Grant Amount, USD', 'sum'),
+            'Number of Grants': ('UT', 'count')
+        })
+        # Only the largest grants of the chunk can make it to the top.
+        candidates = chunk.nlargest(self.top_grants_limit, 'Related WoS Records Count',
+                                    keep='first').sort_index()
+        with self.lock:
+            for (year, country, agency, institution), amount, count in zip(
+                    totals.index, totals['Grant Amount, USD'], totals['Number of Grants']):
+                self.add_totals(year_value(year), country, agency, institution, float(amount),
+                                int(count))
+            records = self.records
+            for position, related_records_count, ut, title in zip(
+                    candidates.index, candidates['Related WoS Records Count'],
+                    candidates['UT'], candidates['Document Title']):
+                self.records = records + position
+                self.add_top_grant(related_records_count, ut, title)
+            self.records = records + len(chunk)
+
+    def close(self):
+        """Nothing to release, present for compatibility with the
+        other pipeline sinks.
+        """
+
+    def cube_frame(self):
+        """Return the cube as a dataframe, with a row for each
+        combination of the dimensions.
+
+        :return: pandas dataframe.
+        """
+        with self.lock:
+            rows = [(*key, amount, count) for key, (amount, count) in self.cube.items()]
+        cube = pd.DataFrame(rows, columns=CUBE_DIMENSIONS + CUBE_MEASURES)
+        cube['Publication Year'] = cube['Publication Year'].astype('Int64')
+        return cube
+
+    def save(self, path):
+        """Save the cube as a Parquet file, with the top grants in the
+        file metadata.
+
+        :param path: str.
+        """
+        table = pa.Table.from_pandas(self.cube_frame(), preserve_index=False)
+        top_grants = self.top_grants_frame()
+        top_grants = top_grants.astype(object).where(top_grants.notna(), None)
+        metadata = {
+            **(table.schema.metadata or {}),
+            b'top_grants': json.dumps(top_grants.to_dict(orient='list')).encode('utf-8'),
+            b'top_grants_limit': str(self.top_grants_limit).encode('utf-8')
+        }
+        pq.write_table(table.replace_schema_metadata(metadata), path)
+
+    @classmethod
+    def load(cls, path):
+        """Load the cube saved next to the harvested data.
+
+        :param path: str.
+        :return: GrantsAggregates.
+        """
+        table = pq.read_table(path)
+        metadata = table.schema.metadata
+        aggregates = cls(int(metadata[b'top_grants_limit']))
+        cube = table.to_pandas()
+        with aggregates.lock:
+            for year, country, agency, institution, amount, count in zip(
+                    *(cube[column] for column in CUBE_DIMENSIONS + CUBE_MEASURES)):
+                aggregates.add_totals(year_value(year), country, agency, institution,
+                                      float(amount), int(count))
+            top_grants = json.loads(metadata[b'top_grants'])
+            for ut, related_records_count, title in zip(
+                    *(top_grants[column] for column in TOP_GRANTS_COLUMNS)):
+                aggregates.add_top_grant(related_records_count, ut, title)
+        return aggregates
+
+    def funding_by_year_frame(self):
+        """Return total grant funding by publication year.
+
+        :return: pandas series.
+        """
+        with self.lock:
+            funding = {year: amount for year, (amount, _) in self.by_year.items()
+                       if year is not None}
+        return (pd.Series(funding, name='Grant Amount, USD', dtype=float).
+                rename_axis('Publication Year').sort_index())
+
+    def top_grant_receivers_frame(self, limit=TOP_GRANT_RECEIVERS):
+        """Return the institutions receiving the most grant funding.
+
+        :param limit: int.
+        :return: pandas dataframe.
+        """
+        with self.lock:
+            funding = dict(self.by_institution)
+        return (pd.Series(funding, name='Grant Amount, USD', dtype=float).
+                rename_axis('Principal Investigator Institution').sort_index().
+                sort_values(ascending=False)[:limit].reset_index())
+
+    def top_funders_frame(self):
+        """Return the funding agencies sorted by funding volumes.
+
+        :return: pandas dataframe.
+        """
+        with self.lock:
+            funding = dict(self.by_funder)
+        funding = pd.Series(funding.values(), name='Grant Amount, USD', dtype=float,
+                            index=pd.MultiIndex.from_tuples(
+                                funding.keys(), names=['Funding Agency', 'Funding Country']))
+        return funding.sort_index().sort_values(ascending=False).reset_index()
+
+    def average_grant_volume_frame(self):
+        """Return the number of grants, the total and the average
+        funding volumes by publication year.
+
+        :return: pandas dataframe.
+        """
+        with self.lock:
+            totals = {year: total for year, total in self.by_year.items() if year is not None}
+        agvby = pd.DataFrame.from_dict(totals, orient='index',
+                                       columns=['Total Funding Volume', 'Number of Grants'])
+        agvby = agvby.rename_axis('Publication Year').sort_index()
+        agvby['Average Grant Volume'] = (agvby['Total Funding Volume'] /
+                                         agvby['Number of Grants'])
+        return agvby
+
+    def top_grants_frame(self):
+        """Return the grants with the most associated Web of Science
+        records.
+
+        :return: pandas dataframe.
+        """
+        with self.lock:
+            top_grants = sorted(self.top_grants, reverse=True)
+        return pd.DataFrame([(ut, count, title) for count, _, ut, title in top_grants],
+                            columns=TOP_GRANTS_COLUMNS)
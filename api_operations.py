@@ -4,65 +4,348 @@ Starter API, retrieve exchange rates data with Ope Exchange Rates
 API.
 """
 
-from datetime import date, datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from json_decoding import decode_response, iterate_records, response_chunks, response_content
+from metrics import metrics
 
+WOS_API_URL = 'https://wos-api.clarivate.com/api/wos'
+RATES_API_URL = 'https://open.er-api.com/v6/latest/USD'
+TIMEOUT = 16
 
-def retrieve_rates_via_api():
+# Throughput settings for retrieving the pages of a single search query.
+REQUESTS_PER_SECOND = 5
+MAX_WORKERS = 4
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 1
+
+# Connection pool settings, sized to keep a connection per worker alive.
+POOL_SIZE = MAX_WORKERS * 2
+CONNECTION_RETRIES = 3
+
+
+class ApiClient:
+    """Keep a pooled HTTP session for all the calls to Web of Science
+    and exchange rates APIs, so that the connections (and their TLS
+    handshakes) are reused between the requests. The base URLs can be
+    replaced, i.e. to point the client to a local stub server.
+    """
+
+    def __init__(self, wos_url=WOS_API_URL, rates_url=RATES_API_URL, pool_size=POOL_SIZE,
+                 retries=CONNECTION_RETRIES, session=None):
+        self.wos_url = wos_url
+        self.rates_url = rates_url
+        self.session = session if session is not None else create_session(pool_size, retries)
+
+    def get(self, url, **kwargs):
+        """Send a GET request through the pooled session.
+
+        :param url: str.
+        :return: requests.Response.
+        """
+        kwargs.setdefault('timeout', TIMEOUT)
+        return self.session.get(url, **kwargs)
+
+    def close(self):
+        """Close all the pooled connections."""
+        self.session.close()
+
+
+def create_session(pool_size=POOL_SIZE, retries=CONNECTION_RETRIES):
+    """Create a keep-alive requests session with gzip compression, a
+    connection pool sized for the page retrieval workers, and retries
+    on connection errors and server-side failures. Throttled (429)
+    requests are handled separately, see retrieve_wos_metadata_via_api.
+
+    :param pool_size: int.
+    :param retries: int.
+    :return: requests.Session.
+    """
+    session = requests.Session()
+    session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+    retry = Retry(
+        total=retries,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=('GET',),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+api_client = ApiClient()
+
+
+def get_api_client(client=None):
+    """Return the client passed by the caller, or the module-level
+    one. Replacing api_operations.api_client swaps the client for all
+    the API calls at once.
+
+    :param client: ApiClient or None.
+    :return: ApiClient.
+    """
+    return client if client is not None else api_client
+
+
+class RateLimiter:
+    """Spread the API requests made from any number of threads so that
+    no more than a given number of them is sent per second.
+    """
+
+    def __init__(self, requests_per_second=REQUESTS_PER_SECOND):
+        self.interval = 1 / requests_per_second
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block the calling thread until it is allowed to send the
+        next request.
+        """
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+    def pause(self, seconds):
+        """Hold back all the threads for the given number of seconds,
+        i.e. when the server has asked to slow down.
+
+        :param seconds: int or float.
+        """
+        with self.lock:
+            self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+
+def retry_delay(response, attempt):
+    """Return the number of seconds to wait before retrying a throttled
+    request: the value of the Retry-After header, if the server sent
+    one, or an exponential backoff otherwise.
+
+    :param response: requests.Response.
+    :param attempt: int.
+    :return: float.
+    """
+    retry_after = response.headers.get('Retry-After')
+    if retry_after:
+        if retry_after.isdigit():
+            return float(retry_after)
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+            return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            pass
+    return BACKOFF_FACTOR * 2 ** attempt
+
+
+def retrieve_rates_via_api(client=None):
     """Get the exchange rates from the open exchange rates API:
     https://open.er-api.com/v6/latest/USD.
 
+    :param client: ApiClient or None.
     :return: dict.
     """
-    rates = requests.get(url='https://open.er-api.com/v6/latest/USD', timeout=16).json()['rates']
-    with open('currencies.csv', 'w', encoding='utf-8') as writing:
-        writing.writelines(f'Updated,{datetime.strftime(date.today(), "%m/%d/%Y")}\n\n'
-                           f'Currency,Rate VS USD\n')
-        for key, value in rates.items():
-            writing.writelines(f'{key},{value}\n')
-    return rates
+    client = get_api_client(client)
+    return decode_response(client.get(client.rates_url))['rates']
 
 
-def validate_search_query(apikey, query):
+def validate_search_query(apikey, query, client=None, rate_limiter=None):
     """Check if the search query is valid, returns the number of grants documents found in the
     query.
 
     :param apikey: str.
     :param query: str.
+    :param client: ApiClient or None.
+    :param rate_limiter: RateLimiter or None.
     :return: int.
     """
-    test_request = requests.get(
-        url=f'https://wos-api.clarivate.com/api/wos/?databaseId=GRANTS&usrQuery={query}&'
-            f'count=0&firstRecord=1',
-        headers={'X-ApiKey': apikey},
-        timeout=16
+    client = get_api_client(client)
+    if rate_limiter is not None:
+        with metrics.timer('api.rate_limit_wait'):
+            rate_limiter.wait()
+    metrics.increment('api.count_probes')
+    test_request = client.get(
+        client.wos_url,
+        params={'databaseId': 'GRANTS', 'usrQuery': query, 'count': 0, 'firstRecord': 1},
+        headers={'X-ApiKey': apikey}
     )
     if test_request.status_code == 200:
-        test_json = test_request.json()
+        test_json = decode_response(test_request)
         return test_request.status_code, test_json['QueryResult']['RecordsFound']
-    return test_request.status_code, test_request.json()['message'].split(':')[-1]
+    return test_request.status_code, decode_response(test_request)['message'].split(':')[-1]
 
 
-def retrieve_wos_metadata_via_api(apikey, query, rpp, first_record=1):
-    """Retrieve Web of Science documents metadata through Web of Science
-    Expanded API.
+def send_wos_request(apikey, query, rpp, first_record=1, rate_limiter=None, client=None,
+                     stream=False):
+    """Send a Web of Science Expanded API request for a page of the
+    search query results. Throttled requests (HTTP 429) are retried
+    after the delay requested by the server.
 
     :param apikey: str.
     :param query: str.
     :param rpp: int.
     :param first_record: int.
-    :return: dict.
+    :param rate_limiter: RateLimiter or None.
+    :param client: ApiClient or None.
+    :param stream: bool.
+    :return: requests.Response.
     """
+    client = get_api_client(client)
     params = {
         'databaseId': 'GRANTS',
         'usrQuery': query,
         'count': rpp,
         'firstRecord': first_record
     }
-    initial_request = requests.get(
-        url='https://wos-api.clarivate.com/api/wos',
-        params=params,
-        headers={'X-ApiKey': apikey},
-        timeout=16
-    )
-    return initial_request.json()
+    for attempt in range(MAX_RETRIES + 1):
+        if rate_limiter is not None:
+            with metrics.timer('api.rate_limit_wait'):
+                rate_limiter.wait()
+        with metrics.timer('api.request'):
+            response = client.get(
+                client.wos_url,
+                params=params,
+                headers={'X-ApiKey': apikey},
+                stream=stream
+            )
+        metrics.increment('api.requests')
+        if response.status_code != 429 or attempt == MAX_RETRIES:
+            break
+        metrics.increment('api.retries')
+        response.close()
+        delay = retry_delay(response, attempt)
+        if rate_limiter is not None:
+            rate_limiter.pause(delay)
+        else:
+            time.sleep(delay)
+    return response
+
+
+def retrieve_wos_metadata_via_api(apikey, query, rpp, first_record=1, rate_limiter=None,
+                                  client=None):
+    """Retrieve Web of Science documents metadata through Web of Science
+    Expanded API.
+
+    :param apikey: str.
+    :param query: str.
+    :param rpp: int.
+    :param first_record: int.
+    :param rate_limiter: RateLimiter or None.
+    :param client: ApiClient or None.
+    :return: dict.
+    """
+    return decode_response(send_wos_request(apikey, query, rpp, first_record, rate_limiter,
+                                            client))
+
+
+def retrieve_wos_page_content(apikey, query, rpp, first_record=1, rate_limiter=None,
+                              client=None):
+    """Retrieve a page of Web of Science documents metadata through Web
+    of Science Expanded API, without decoding it, i.e. to decode it in
+    another process.
+
+    :param apikey: str.
+    :param query: str.
+    :param rpp: int.
+    :param first_record: int.
+    :param rate_limiter: RateLimiter or None.
+    :param client: ApiClient or None.
+    :return: bytes.
+    """
+    return response_content(send_wos_request(apikey, query, rpp, first_record, rate_limiter,
+                                             client))
+
+
+def stream_wos_records(apikey, query, rpp, first_record=1, rate_limiter=None, client=None):
+    """Retrieve a page of Web of Science documents metadata through Web
+    of Science Expanded API, yielding the records as they are decoded
+    from the response body, so that the raw and the decoded page are
+    never held in memory at the same time.
+
+    :param apikey: str.
+    :param query: str.
+    :param rpp: int.
+    :param first_record: int.
+    :param rate_limiter: RateLimiter or None.
+    :param client: ApiClient or None.
+    :return: generator of dict.
+    """
+    response = send_wos_request(apikey, query, rpp, first_record, rate_limiter, client,
+                                stream=True)
+    with response:
+        response.raise_for_status()
+        yield from iterate_records(response_chunks(response))
+
+
+def retrieve_wos_page_records(apikey, query, rpp, first_record=1, rate_limiter=None,
+                              client=None):
+    """Retrieve a page of Web of Science documents metadata through Web
+    of Science Expanded API with stream_wos_records. Only the records of
+    the page are kept, in a page of the same shape as the decoded ones.
+
+    :param apikey: str.
+    :param query: str.
+    :param rpp: int.
+    :param first_record: int.
+    :param rate_limiter: RateLimiter or None.
+    :param client: ApiClient or None.
+    :return: dict.
+    """
+    records = list(stream_wos_records(apikey, query, rpp, first_record, rate_limiter, client))
+    return {'Data': {'Records': {'records': {'REC': records}}}}
+
+
+def retrieve_pages(apikey, query, rpp, first_records, workers=MAX_WORKERS,
+                   requests_per_second=REQUESTS_PER_SECOND, client=None, rate_limiter=None,
+                   raw=False, stream=False):
+    """Retrieve the pages of the search query results starting at each
+    of the given firstRecord values with a pool of worker threads,
+    sharing a common request rate budget. The pages are yielded in the
+    order of first_records, decoded, or as the raw JSON documents if raw
+    is True. With stream, the records of each page are decoded as its
+    response body streams in, see retrieve_wos_page_records; raw takes
+    precedence over it. A rate limiter shared with other harvests
+    replaces the budget of requests_per_second.
+
+    :param apikey: str.
+    :param query: str.
+    :param rpp: int.
+    :param first_records: iterable of int.
+    :param workers: int.
+    :param requests_per_second: int or float.
+    :param client: ApiClient or None.
+    :param rate_limiter: RateLimiter or None.
+    :param raw: bool.
+    :param stream: bool.
+    :return: generator of dict, or of bytes if raw is True.
+    """
+    client = get_api_client(client)
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(requests_per_second)
+    if raw:
+        retrieve_page = retrieve_wos_page_content
+    elif stream:
+        retrieve_page = retrieve_wos_page_records
+    else:
+        retrieve_page = retrieve_wos_metadata_via_api
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Only keep a bounded number of pages in flight, so that the
+        # pages waiting to be consumed don't pile up in memory.
+        pending = []
+        for first_record in first_records:
+            pending.append(executor.submit(
+                retrieve_page, apikey, query, rpp, first_record, rate_limiter, client
+            ))
+            if len(pending) >= workers * 2:
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
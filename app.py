@@ -2,24 +2,183 @@
 A Flask app that allows retrieving, processing, and visualizing the
 Web of Science Grants Index data.
 
-Main app file: manage Flask interface actions and rendering, manage the
-main function that is launched on clicking the "Run" button.
+Main app file: create the Flask app, manage Flask interface actions and
+rendering, manage the main function that is launched on clicking the
+"Run" button. The analysis and plotting modules are only imported when
+a request needs them, so that i.e. validating a search query doesn't
+pay for them; the app can import them in the background once started.
 """
 
-from datetime import date
-import pandas as pd
-from flask import Flask, render_template, request
-from data_processing import get_usd_rates, fetch_data
-from visualizations import visualize_data, visualize_excel
-from api_operations import validate_search_query, retrieve_wos_metadata_via_api
-from apikeys import EXPANDED_APIKEY
+import logging
+import os
+import threading
+import uuid
+from flask import Flask, Response, abort, current_app, jsonify, render_template, request, session
+from api_operations import RateLimiter, validate_search_query
+from checkpoints import CheckpointStore
+from exchange_rates import RateProvider
+from jobs import JobRegistry
+from metrics import metrics
+from query_cache import QueryCache
+from result_store import ResultStore
 
-app = Flask(__name__)
+# The buttons switching between the visualizations, in the order of the
+# plots.
+VISUALIZATIONS = (
+    'grant_funding_by_year',
+    'top_grant_receivers',
+    'top_funders',
+    'average_grant_volume_per_year',
+    'top_grants_by_associated_wos_records'
+)
+PLOTLY_JS_MAX_AGE = 7 * 24 * 3600
 
-plots_list = []
+
+class Services:
+    """The stores and workers shared by the requests of an app, each
+    created on first use. The ones backed by the analysis modules
+    (pandas, pyarrow) import them only then.
+    """
+
+    def __init__(self, profile_dir=None, texts_out_of_line=False):
+        self.profile_dir = profile_dir
+        self.texts_out_of_line = texts_out_of_line
+        self.created = {}
+        self.lock = threading.RLock()
+
+    def get(self, name, factory):
+        """Return the named service, creating it on first use.
+
+        :param name: str.
+        :param factory: callable returning the service.
+        :return: object.
+        """
+        with self.lock:
+            if name not in self.created:
+                self.created[name] = factory()
+            return self.created[name]
+
+    @property
+    def checkpoints(self):
+        """:return: CheckpointStore."""
+        return self.get('checkpoints', CheckpointStore)
+
+    @property
+    def query_cache(self):
+        """:return: QueryCache."""
+        return self.get('query_cache', QueryCache)
+
+    @property
+    def jobs(self):
+        """:return: JobRegistry."""
+        return self.get('jobs', JobRegistry)
+
+    @property
+    def results(self):
+        """:return: ResultStore."""
+        return self.get('results', ResultStore)
+
+    @property
+    def rate_provider(self):
+        """:return: RateProvider."""
+        return self.get('rate_provider', RateProvider)
+
+    @property
+    def rate_limiter(self):
+        """:return: RateLimiter, shared by all the API requests."""
+        return self.get('rate_limiter', RateLimiter)
+
+    @property
+    def grants_store(self):
+        """:return: GrantsStore."""
+        def create():
+            from grants_store import GrantsStore  # pylint: disable=import-outside-toplevel
+            return GrantsStore()
+        return self.get('grants_store', create)
+
+    @property
+    def harvester(self):
+        """:return: Harvester."""
+        def create():
+            from harvest import Harvester  # pylint: disable=import-outside-toplevel
+            return Harvester(self.checkpoints, self.query_cache, self.rate_provider,
+                             self.grants_store, rate_limiter=self.rate_limiter,
+                             profile_dir=self.profile_dir,
+                             texts_out_of_line=self.texts_out_of_line)
+        return self.get('harvester', create)
+
+    @property
+    def apikey(self):
+        """:return: str, the Web of Science Expanded API key."""
+        def read():
+            from apikeys import EXPANDED_APIKEY  # pylint: disable=import-outside-toplevel
+            return EXPANDED_APIKEY
+        return self.get('apikey', read)
+
+    def link_graph(self):
+        """Return the link graph of all the stored grants, rebuilt when
+        grants were stored since it was built.
+
+        :return: LinkGraph.
+        """
+        version = self.grants_store.version()
+        with self.lock:
+            built = self.created.get('link_graph')
+            if built is None or built[0] != version:
+                built = self.created['link_graph'] = (version, self.grants_store.link_graph())
+            return built[1]
+
+    def warm_up(self):
+        """Import the analysis and plotting modules, load the plotly.js
+        bundle and create the stores ahead of the first run.
+        """
+        with metrics.timer('app.warm_up'):
+            from visualizations import plotly_js  # pylint: disable=import-outside-toplevel
+            plotly_js()
+            _ = self.harvester, self.jobs, self.results
+
+
+def services():
+    """Return the services of the current app.
+
+    :return: Services.
+    """
+    return current_app.extensions['grants']
+
+
+def create_app(warm_up=False, profile_dir=None, texts_out_of_line=None):
+    """Create the Flask app. With warm_up, the analysis and plotting
+    modules are imported in a background thread right away instead of
+    by the first request needing them.
+
+    :param warm_up: bool.
+    :param profile_dir: str or None, to dump the cProfile statistics of
+        each run, GRANTS_PROFILE_DIR by default.
+    :param texts_out_of_line: bool or None, to save the grant
+        descriptions and related records next to the data files rather
+        than in them, set by GRANTS_TEXTS_OUT_OF_LINE by default.
+    :return: Flask.
+    """
+    app = Flask(__name__)
+    app.secret_key = os.environ.get('FLASK_SECRET_KEY') or os.urandom(24)
+    if texts_out_of_line is None:
+        texts_out_of_line = os.environ.get('GRANTS_TEXTS_OUT_OF_LINE', '') not in ('', '0')
+    app.extensions['grants'] = Services(profile_dir or os.environ.get('GRANTS_PROFILE_DIR'),
+                                        texts_out_of_line)
+    app.add_url_rule('/', view_func=start_menu, methods=['POST', 'GET'])
+    app.add_url_rule('/plotly.js', view_func=plotly_bundle, methods=['GET'])
+    app.add_url_rule('/metrics', view_func=metrics_report, methods=['GET'])
+    app.add_url_rule('/links', view_func=links_report, methods=['GET'])
+    app.add_url_rule('/jobs/<job_id>', view_func=job_progress, methods=['GET'])
+    app.add_url_rule('/jobs/<job_id>/preview/<int:index>', view_func=job_preview,
+                     methods=['GET'])
+    app.add_url_rule('/jobs/<job_id>/result', view_func=job_result, methods=['GET'])
+    if warm_up:
+        threading.Thread(target=app.extensions['grants'].warm_up, name='warm-up',
+                         daemon=True).start()
+    return app
 
 
-@app.route(rule="/", methods=['POST', 'GET'])
 def start_menu():
     """Manage Flask interface actions and rendering
 
@@ -32,30 +191,99 @@ def start_menu():
         search_query = request.form['search_query']
         return search_section(button, search_query)
 
-    # Loading Excel file
+    # Loading a saved file
     if request.method == 'POST' and 'filename' in request.form.keys():
         file = request.form['filename']
         return load_file_section(file)
 
+    # Charting the grants of all the past harvests
+    if request.method == 'POST' and 'stored_grants' in request.form.keys():
+        return stored_grants_section()
+
+    # Exporting the retrieved data to Excel
+    if request.method == 'POST' and 'export' in request.form.keys():
+        file = request.form['export']
+        return export_section(file)
+
     # Switching between visualizations
-    if request.method == 'POST' and 'button' in request.form.keys():
-        visualizations = {
-            "grant_funding_by_year": plots_list[0],
-            "top_grant_receivers": plots_list[1],
-            "top_funders": plots_list[2],
-            "average_grant_volume_per_year": plots_list[3],
-            "top_grants_by_associated_wos_records": plots_list[4]
-        }
-        if request.form['button'] in visualizations:
-            for key, value in visualizations.items():
-                if request.method == 'POST' and request.form['button'] == key:
-                    return render_template(
-                        'index.html',
-                        plot=value,
-                        index=plots_list.index(value))
+    if request.method == 'POST' and request.form.get('button') in VISUALIZATIONS:
+        result = services().results.get(session.get('result_id'))
+        if result is None:
+            return render_template('index.html', search_query='',
+                                   message='The results have expired, please run the search '
+                                           'or load the file again.')
+        index = VISUALIZATIONS.index(request.form['button'])
+        return render_template('index.html', plot=result['plots'][index], index=index)
     return render_template('index.html', search_query='')
 
 
+def plotly_bundle():
+    """Serve the plotly.js bundle, cached by the browser, so that the
+    pages only carry the JSON figures.
+
+    :return: Flask response.
+    """
+    from visualizations import plotly_js  # pylint: disable=import-outside-toplevel
+    response = Response(plotly_js(), mimetype='application/javascript')
+    response.cache_control.public = True
+    response.cache_control.max_age = PLOTLY_JS_MAX_AGE
+    return response
+
+
+def metrics_report():
+    """Report the counters and the per-stage timers of the harvests, and
+    the number of jobs by status.
+
+    :return: Flask JSON response.
+    """
+    report = metrics.snapshot()
+    report['jobs'] = services().jobs.status_counts()
+    return jsonify(report)
+
+
+def links_report():
+    """Report on the links between the stored grants and their related
+    Web of Science records: the grants with the most linked records,
+    the pairs of funders sharing the most records, and the clusters of
+    funders linked by shared records. The number of entries, the
+    funder to list the co-funders of and the least number of records
+    shared by the funders of a cluster can be given as the top, funder
+    and min_shared parameters.
+
+    :return: Flask JSON response.
+    """
+    from link_graph import TOP_CO_FUNDERS  # pylint: disable=import-outside-toplevel
+    top = request.args.get('top', TOP_CO_FUNDERS, type=int)
+    min_shared = request.args.get('min_shared', 1, type=int)
+    graph = services().link_graph()
+    report = {
+        'grants': len(graph.grant_uts),
+        'records': len(graph.record_uts),
+        'links': graph.links_count,
+        'top_linked_grants': graph.top_linked_grants(top),
+        'top_co_funding': graph.top_co_funding(top),
+        'funder_clusters': graph.funder_clusters(min_shared)[:top]
+    }
+    if 'funder' in request.args:
+        report['co_funders'] = graph.co_funders(request.args['funder'], top)
+    return jsonify(report)
+
+
+def show_result(result_id, **context):
+    """Make a stored result the current one of the user session and
+    render its first visualization.
+
+    :param result_id: str.
+    :return: render_template object.
+    """
+    result = services().results.get(result_id)
+    if result is None:
+        return render_template('index.html', search_query=context.get('search_query', ''),
+                               message='The results have expired, please run the search again.')
+    session['result_id'] = result_id
+    return render_template('index.html', plot=result['plots'][0], index=0, **context)
+
+
 def search_section(button, search_query):
     """Manage the actions and processes for the page search section.
 
@@ -64,7 +292,15 @@ def search_section(button, search_query):
     :return: render_template object.
     """
     if search_query != '' and button == 'validate':
-        response = validate_search_query(EXPANDED_APIKEY, search_query)
+        query_cache = services().query_cache
+        records_found = query_cache.get_value(search_query, 'count')
+        if records_found is not None:
+            response = (200, records_found)
+        else:
+            response = validate_search_query(services().apikey, search_query,
+                                             rate_limiter=services().rate_limiter)
+            if response[0] == 200:
+                query_cache.put_value(search_query, 'count', response[1])
         if response[0] == 200:
             return render_template(
                 'index.html',
@@ -76,20 +312,61 @@ def search_section(button, search_query):
             message=f'Request status: {response[0]}, message: {response[1]}',
             search_query=search_query
         )
-    if search_query != '' and button == 'run':
-        plots_list.clear()
-        safe_filename, plots = run_button_main_function(EXPANDED_APIKEY, search_query)
-        for plot in plots:
-            plots_list.append(plot)
-        return render_template(
-            'index.html',
-            filename=safe_filename,
-            search_query=search_query,
-            plot=plots_list[0]
-        )
+    if search_query != '' and button in ('run', 'refresh'):
+        main_function = (run_button_main_function if button == 'run'
+                         else refresh_button_main_function)
+        job = services().jobs.submit(search_query, run_search_job, services(), main_function,
+                                     services().apikey, search_query)
+        return render_template('index.html', job_id=job.id, search_query=search_query)
     return render_template('index.html', search_query='')
 
 
+def job_progress(job_id):
+    """Report the status and progress of a background job.
+
+    :param job_id: str.
+    :return: Flask JSON response.
+    """
+    job = services().jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.progress())
+
+
+def job_preview(job_id, index):
+    """Render a chart of the data a running job has retrieved so far.
+
+    :param job_id: str.
+    :param index: int.
+    :return: Flask response.
+    """
+    job = services().jobs.get(job_id)
+    if job is None or not 0 <= index < len(VISUALIZATIONS):
+        abort(404)
+    if job.aggregates is None or not job.aggregates.records:
+        return Response(status=204)
+    from visualizations import PLOTS  # pylint: disable=import-outside-toplevel
+    return Response(PLOTS[index](job.aggregates), mimetype='application/json')
+
+
+def job_result(job_id):
+    """Render the result of a background job once it is done, or keep
+    reporting its progress until then.
+
+    :param job_id: str.
+    :return: render_template object.
+    """
+    job = services().jobs.get(job_id)
+    if job is None:
+        abort(404)
+    if job.status == 'failed':
+        return render_template('index.html', message=f'Run failed: {job.error}',
+                               search_query=job.query)
+    if job.status != 'done':
+        return render_template('index.html', job_id=job.id, search_query=job.query)
+    return show_result(job.id, filename=job.result, search_query=job.query)
+
+
 def load_file_section(file):
     """Manage the actions and processes for the load file search
     section.
@@ -97,53 +374,119 @@ def load_file_section(file):
     :param file:
     :return:
     """
-    plots_list.clear()
     if file == '':
         return render_template('index.html', search_query='')
-    plots = visualize_excel(f'downloads/{file}')
-    for plot in plots:
-        plots_list.append(plot)
-    return render_template('index.html', plot=plots_list[0], index=0)
+    path = download_path(file)
+    if path is None:
+        return render_template('index.html', search_query='',
+                               message=f'No file named "{file}" in the downloads folder.')
+    from visualizations import visualize_file  # pylint: disable=import-outside-toplevel
+    result_id = uuid.uuid4().hex
+    services().results.put(result_id, {'filename': file, 'plots': visualize_file(path)})
+    return show_result(result_id)
 
 
-def run_button_main_function(apikey, search_query):
-    """When the 'Run' button is pressed, manage all the API operations,
-    data processing, and visualizations
+def download_path(file):
+    """Return the path of a file of the downloads folder named in a
+    form, or None if the name is not the one of a file directly in it.
+
+    :param file: str.
+    :return: str or None.
+    """
+    if file != os.path.basename(file) or file in ('', '.', '..'):
+        return None
+    downloads_dir = os.path.realpath(services().harvester.downloads_dir)
+    path = os.path.realpath(os.path.join(downloads_dir, file))
+    if os.path.dirname(path) != downloads_dir or not os.path.isfile(path):
+        return None
+    return path
+
+
+def stored_grants_section():
+    """Chart the union of the grants stored by all the past harvests,
+    aggregated in the grants store.
+
+    :return: render_template object.
+    """
+    aggregates = services().grants_store.aggregates()
+    if not aggregates.records:
+        return render_template('index.html', search_query='',
+                               message='No grants have been stored yet, please run a search.')
+    from visualizations import visualize_aggregates  # pylint: disable=import-outside-toplevel
+    result_id = uuid.uuid4().hex
+    services().results.put(result_id, {'filename': None,
+                                       'plots': visualize_aggregates(aggregates)})
+    return show_result(result_id)
+
 
+def export_section(file):
+    """Convert a saved Parquet file into an Excel spreadsheet on demand.
+
+    :param file: str.
+    :return: render_template object.
+    """
+    path = download_path(file)
+    if path is None:
+        return render_template('index.html', search_query='',
+                               message=f'No file named "{file}" in the downloads folder.')
+    from storage import export_to_excel  # pylint: disable=import-outside-toplevel
+    excel_file = os.path.basename(export_to_excel(path))
+    result = services().results.get(session.get('result_id'))
+    if result is not None:
+        return render_template('index.html', excel_filename=excel_file, plot=result['plots'][0],
+                               index=0)
+    return render_template('index.html', excel_filename=excel_file, search_query='')
+
+
+def run_search_job(app_services, main_function, apikey, search_query, job):
+    """Run the search in a background job, and store its result under
+    the job id.
+
+    :param app_services: Services.
+    :param main_function: function, run_button_main_function or
+        refresh_button_main_function.
+    :param apikey: str.
+    :param search_query: str.
+    :param job: Job.
+    :return: str.
+    """
+    filename, plots = main_function(app_services, apikey, search_query, job)
+    app_services.results.put(job.id, {'filename': filename, 'plots': plots})
+    return filename
+
+
+def run_button_main_function(app_services, apikey, search_query, job=None):
+    """When the 'Run' button is pressed, harvest the grants of the
+    search query and visualize them. The results of a query that was
+    run recently are served from the query cache.
+
+    :param app_services: Services.
     :param apikey: str.
     :param search_query: str.
+    :param job: Job or None, to report the progress to.
     :return: str, tuple.
     """
-    records_per_page = 100
-    grants_list = []
-    usd_rates = get_usd_rates()
-    initial_json = retrieve_wos_metadata_via_api(apikey, search_query, records_per_page)
-    for record in initial_json['Data']['Records']['records']['REC']:
-        grants_list.append(fetch_data(record, usd_rates))
-    total_results = initial_json['QueryResult']['RecordsFound']
-    requests_required = ((total_results - 1) // records_per_page) + 1
-    print(f'Total Web of Science API requests required: {requests_required}.')
-    for i in range(1, requests_required):
-        first_record = int(f'{i}01')
-        subsequent_json = retrieve_wos_metadata_via_api(
-            apikey,
-            search_query,
-            records_per_page,
-            first_record
-        )
-        for record in subsequent_json['Data']['Records']['records']['REC']:
-            fetch_data(record, usd_rates)
-        print(f'Request {i + 1} of {requests_required} complete.')
-
-    df = pd.DataFrame(grants_list)
-    safe_filename = search_query.replace('*', '').replace('"', '')
-    df.to_excel(
-        excel_writer=f'downloads/{safe_filename} - {date.today()}.xlsx',
-        sheet_name='Grants Data',
-        index=False
-    )
-    plots = visualize_data(df)
-    return f'{safe_filename} - {date.today()}.xlsx', plots
-
-
-app.run(debug=False)
+    from visualizations import visualize_aggregates  # pylint: disable=import-outside-toplevel
+    filename, aggregates = app_services.harvester.run(apikey, search_query, job)
+    return filename, visualize_aggregates(aggregates)
+
+
+def refresh_button_main_function(app_services, apikey, search_query, job=None):
+    """When the 'Refresh' button is pressed, only harvest the grants of
+    the search query published since its last harvest, and visualize
+    all its stored grants.
+
+    :param app_services: Services.
+    :param apikey: str.
+    :param search_query: str.
+    :param job: Job or None, to report the progress to.
+    :return: str, tuple.
+    """
+    from visualizations import visualize_aggregates  # pylint: disable=import-outside-toplevel
+    filename, aggregates = app_services.harvester.refresh(apikey, search_query, job)
+    return filename, visualize_aggregates(aggregates)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    create_app(warm_up=True).run(debug=False)
@@ -0,0 +1,195 @@
+"""
+Harvest many search queries at once from the command line, without the
+Flask app: the queries of a file, one per line, are run across a shared
+pool of job workers and a shared API request rate budget, with the same
+harvest code as the app, and a summary report of the runs is written
+next to the data files. With --count, the number of records each query
+finds is only probed, without loading the analysis modules.
+
+Run python batch.py QUERIES_FILE [--workers N] [--refresh] [--output-dir DIR] [--count].
+"""
+
+import argparse
+from datetime import datetime
+import json
+import logging
+import os
+import sys
+import time
+from api_operations import RateLimiter, validate_search_query
+from checkpoints import CheckpointStore
+from exchange_rates import RateProvider
+from jobs import JobRegistry
+from metrics import metrics
+from query_cache import normalize_query, QueryCache
+
+BATCH_WORKERS = 4
+BATCH_SUMMARY = 'batch_summary.json'
+
+
+def read_queries(path):
+    """Read the search queries of a file, one per line, skipping the
+    blank lines and the comment lines starting with #.
+
+    :param path: str.
+    :return: list of str.
+    """
+    with open(path, 'r', encoding='utf-8') as reading:
+        lines = (line.strip() for line in reading)
+        return [line for line in lines if line and not line.startswith('#')]
+
+
+def unique_queries(queries):
+    """Drop the search queries that are other spellings of an earlier
+    one, which would be harvested by the same job.
+
+    :param queries: list of str.
+    :return: list of str.
+    """
+    unique = {}
+    for query in queries:
+        unique.setdefault(normalize_query(query), query)
+    return list(unique.values())
+
+
+def harvest_query(harvester, refresh, apikey, search_query, job):
+    """Run or refresh the harvest of a search query in a batch job.
+
+    :param harvester: Harvester.
+    :param refresh: bool.
+    :param apikey: str.
+    :param search_query: str.
+    :param job: Job.
+    :return: dict, the data file name and the number of records.
+    """
+    harvest = harvester.refresh if refresh else harvester.run
+    filename, aggregates = harvest(apikey, search_query, job)
+    return {'filename': filename, 'records': aggregates.records}
+
+
+def count_queries(apikey, queries, query_cache=None, rate_limiter=None):
+    """Probe the number of records each search query finds, with a
+    count=0 request unless the query cache knows it.
+
+    :param apikey: str.
+    :param queries: list of str.
+    :param query_cache: QueryCache or None.
+    :param rate_limiter: RateLimiter or None.
+    :return: dict of str to int, or to the error message of a query
+        that failed.
+    """
+    counts = {}
+    for query in queries:
+        records_found = query_cache.get_value(query, 'count') if query_cache else None
+        if records_found is None:
+            status, records_found = validate_search_query(apikey, query,
+                                                          rate_limiter=rate_limiter)
+            if status != 200:
+                records_found = f'Request status: {status}, message: {records_found}'
+            elif query_cache is not None:
+                query_cache.put_value(query, 'count', records_found)
+        counts[query] = records_found
+        print(f'{records_found}: {query}')
+    return counts
+
+
+def run_batch(apikey, queries, harvester, workers=BATCH_WORKERS, refresh=False):
+    """Harvest the search queries with a pool of job workers, and
+    report the outcome of each run. The spellings of the same query are
+    harvested and reported once.
+
+    :param apikey: str.
+    :param queries: list of str.
+    :param harvester: Harvester.
+    :param workers: int.
+    :param refresh: bool, to only harvest the grants published since
+        the last harvest of each query.
+    :return: dict.
+    """
+    started = time.time()
+    queries = unique_queries(queries)
+    registry = JobRegistry(workers=workers, finished_kept=len(queries))
+    submitted = [registry.submit(query, harvest_query, harvester, refresh, apikey, query)
+                 for query in queries]
+    runs = []
+    for query, job in zip(queries, submitted):
+        job.wait()
+        result = job.result or {}
+        runs.append({
+            'query': query,
+            'status': job.status,
+            'records': result.get('records'),
+            'filename': result.get('filename'),
+            'pages': job.pages_fetched,
+            'seconds': round(job.finished - job.started, 1),
+            'error': job.error
+        })
+        print(f'{job.status}: {query}')
+    registry.executor.shutdown()
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'queries': len(queries),
+        'done': sum(run['status'] == 'done' for run in runs),
+        'failed': sum(run['status'] == 'failed' for run in runs),
+        'records': sum(run['records'] or 0 for run in runs),
+        'seconds': round(time.time() - started, 1),
+        'metrics': metrics.snapshot(),
+        'runs': runs
+    }
+
+
+def parse_arguments():
+    """Parse the command line options.
+
+    :return: argparse.Namespace.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n', maxsplit=1)[0])
+    parser.add_argument('queries', help='file of search queries, one per line')
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS,
+                        help='number of queries harvested at once')
+    parser.add_argument('--refresh', action='store_true',
+                        help='only harvest the grants published since the last harvest of '
+                             'each query')
+    parser.add_argument('--output-dir', help='directory to write the data files to, '
+                                             'downloads by default')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='dump the cProfile statistics of each run to the directory')
+    parser.add_argument('--summary', help='file to write the JSON summary report to, '
+                                          f'{BATCH_SUMMARY} in the output directory by default')
+    parser.add_argument('--texts-out-of-line', action='store_true',
+                        help='save the grant descriptions and related records next to the '
+                             'data files rather than in them')
+    parser.add_argument('--parallel-parse', action='store_true',
+                        help='decode and parse the API pages in a pool of processes')
+    parser.add_argument('--stream-records', action='store_true',
+                        help='decode the records of the API pages as the responses stream in')
+    parser.add_argument('--count', action='store_true',
+                        help='only print the number of records each query finds')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from apikeys import EXPANDED_APIKEY  # pylint: disable=import-error
+    arguments = parse_arguments()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if arguments.count:
+        query_counts = count_queries(EXPANDED_APIKEY, read_queries(arguments.queries),
+                                     QueryCache(), RateLimiter())
+        sys.exit(1 if any(isinstance(count, str) for count in query_counts.values()) else 0)
+    # The harvest modules load pandas and pyarrow, which the count
+    # probes don't need.
+    from grants_store import GrantsStore  # pylint: disable=ungrouped-imports
+    from harvest import DOWNLOADS_DIR, Harvester
+    arguments.output_dir = arguments.output_dir or DOWNLOADS_DIR
+    batch_harvester = Harvester(CheckpointStore(), QueryCache(), RateProvider(), GrantsStore(),
+                                arguments.output_dir, RateLimiter(), arguments.profile,
+                                arguments.texts_out_of_line, arguments.parallel_parse,
+                                arguments.stream_records)
+    summary = run_batch(EXPANDED_APIKEY, read_queries(arguments.queries), batch_harvester,
+                        arguments.workers, arguments.refresh)
+    summary_path = arguments.summary or os.path.join(arguments.output_dir, BATCH_SUMMARY)
+    with open(summary_path, 'w', encoding='utf-8') as output:
+        json.dump(summary, output, indent=2)
+    print(f'Queries harvested: {summary["done"]} of {summary["queries"]}, '
+          f'summary written to {summary_path}.')
+    sys.exit(1 if summary['failed'] else 0)
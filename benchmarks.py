@@ -0,0 +1,745 @@
+"""
+Benchmark the Grants Index harvest end to end without live credentials:
+the API pages are served by a local stub server, either replayed from
+recorded fixtures or generated as synthetic records at several scales.
+The timings and peak memory of each stage are written as JSON, so that
+the results of different versions can be compared. Run with
+`python benchmarks.py --help` for the options.
+"""
+
+import argparse
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from aggregates import GrantsAggregates
+import api_operations
+from api_operations import ApiClient, retrieve_pages, retrieve_wos_metadata_via_api
+from data_processing import extract_grant_fields, fetch_data_batch, grants_frame
+import json_decoding
+from link_graph import LinkGraph
+from pipeline import iterate_pages, page_records
+from storage import ExcelSink, ParquetSink, export_to_excel
+from visualizations import PLOTS
+
+BENCHMARK_RECORDS = 1000
+BENCHMARK_REPEATS = 5
+BENCHMARK_SCALES = (1000, 10000, 100000)
+BENCHMARK_RATES = {'EUR': 0.9, 'JPY': 150.0}
+BENCHMARK_RESULTS = 'benchmark_results.json'
+LINK_GRAPH_GRANTS = 100000
+LINK_GRAPH_LINKS_PER_GRANT = 20
+LINK_GRAPH_FUNDERS = 2000
+LINK_GRAPH_RECORDS = 1000000
+# The entry points timed by benchmark_imports, and the heavy modules
+# checked for in their fresh interpreter afterwards.
+IMPORT_TARGETS = ('app', 'batch', 'api_operations', 'harvest', 'visualizations')
+HEAVY_MODULES = ('pandas', 'pyarrow', 'plotly')
+IMPORT_PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+if {create_app}:
+    {module}.create_app()
+loaded = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{'seconds': seconds, 'loaded': loaded}}))
+'''
+RECORDS_PER_PAGE = 100
+
+# The stub server answers instantly, so the request rate is only
+# limited to keep the fetching stage comparable between runs.
+STUB_REQUESTS_PER_SECOND = 1000
+
+
+def synthetic_record(number, rng):
+    """Generate a Grants Index record with the same nesting as the API
+    output, including both the single dict and the list forms of the
+    repeated elements.
+
+    :param number: int.
+    :param rng: random.Random.
+    :return: dict.
+    """
+    related_records = [{'uid': f'WOS:{number:09d}{i:03d}'} for i in range(rng.randint(0, 5))]
+    if len(related_records) == 1:
+        related_records = related_records[0]
+    return {
+        'UID': f'GRANTS:{number:08d}',
+        'static_data': {
+            'summary': {
+                'names': {'count': 2, 'name': [
+                    {'role': 'principal_investigator', 'full_name': f'Investigator {number}'},
+                    {'role': 'researcher', 'full_name': f'Researcher {number}'}]},
+                'titles': {'title': [{'type': 'source', 'content': 'Grant Source'},
+                                     {'type': 'item', 'content': f'Grant Title {number}'}]},
+                'pub_info': {'pubyear': 2010 + number % 14},
+                'doctypes': {'doctype': 'Awarded Grant'}
+            },
+            'item': {
+                'financial_year': 2010 + number % 14,
+                'grant_agencies': {'grant_agency': {
+                    'country': rng.choice(['USA', 'GERMANY', 'JAPAN'])}}
+            },
+            'fullrecord_metadata': {
+                'related_records': {'record': related_records},
+                'keywords': {'keyword': [{'content': 'keyword'}, {'content': 'another keyword'}]},
+                'abstracts': {'abstract': {'abstract_text': {'p': 'Grant description. ' * 30}}},
+                'fund_ack': {'grants': {'grant': {
+                    'grant_source': 'Grant Source',
+                    'grant_agency_names': [
+                        {'pref': 'Y', 'content': rng.choice(['NIH', 'NSF', 'DFG'])},
+                        {'pref': 'N', 'content': 'Agency'}],
+                    'grant_data': {'grantDataItem': {
+                        'principalInvestigators': {'principalInvestigator': {'institution': {
+                            'pref': 'Y', 'content': rng.choice(['MIT', 'Yale', ''])}}},
+                        'totalAwardAmount': rng.choice(['', 1000.0, 25000.0]),
+                        'currency': rng.choice(['USD', 'EUR', 'JPY'])}}}}}
+            }
+        }
+    }
+
+
+def synthetic_records(count, seed=0):
+    """Generate a reproducible list of synthetic Grants Index records.
+
+    :param count: int.
+    :param seed: int.
+    :return: list of dict.
+    """
+    rng = random.Random(seed)
+    return [synthetic_record(number, rng) for number in range(count)]
+
+
+def synthetic_page(first_record, count, total, seed=0):
+    """Generate a Web of Science Expanded API page of synthetic records.
+
+    :param first_record: int.
+    :param count: int.
+    :param total: int.
+    :param seed: int.
+    :return: dict.
+    """
+    rng = random.Random(seed + first_record)
+    count = max(0, min(count, total - first_record + 1))
+    records = [synthetic_record(first_record + i, rng) for i in range(count)]
+    return {
+        'Data': {'Records': {'records': {'REC': records} if records else ''}},
+        'QueryResult': {'QueryID': 1, 'RecordsSearched': 0, 'RecordsFound': total}
+    }
+
+
+# The hand-written helpers extract_grant_fields replaced, kept as the
+# reference of benchmark_extraction.
+def reference_fetch_names(names_json):
+    """Retrieve the names of the principal investigator and other grant
+    participants, if any.
+
+    :param names_json: dict.
+    :return: str, str.
+    """
+    pr_inv = ''
+    other_nms = ''
+    if names_json['count'] > 0:
+        if names_json['count'] == 1 and names_json['name']['role'] == 'principal_investigator':
+            pr_inv = names_json['name']['full_name']
+        elif names_json['count'] == 1 and names_json['name']['role'] != 'principal_investigator':
+            other_nms = names_json['name']['full_name']
+        else:
+            non_pis = []
+            for name in names_json['name']:
+                if name['role'] == 'principal_investigator':
+                    pr_inv = name['full_name']
+                else:
+                    non_pis.append(name['full_name'])
+            other_nms = ', '.join(non_pis)
+    return pr_inv, other_nms
+
+
+def reference_fetch_grant_agency(item):
+    """Retrieve the name(s) of the grant agencies, if any.
+
+    :param item: dict.
+    :return: str.
+    """
+    agencies = []
+    if isinstance(item['grant_agency_names'], list):
+        for funder in item['grant_agency_names']:
+            if funder['pref'] == 'Y' and funder['content'] not in agencies:
+                agencies.append(funder['content'])
+        return ', '.join(agencies)
+    return item['grant_agency_names']['content']
+
+
+def reference_fetch_grant_country(item):
+    """Return country of the funding agency
+
+    :param item: dict.
+    :return: str.
+    """
+    if 'grant_agencies' in item.keys():
+        funders_json = item['grant_agencies']['grant_agency']
+        if isinstance(funders_json, list):
+            return ', '.join(list(set(f['country'] for f in funders_json)))
+        return funders_json['country']
+    return ''
+
+
+def reference_fetch_pi_institution(item):
+    """Retrieve the name(s) of the principal investigator's
+    institution, if any.
+
+    :param item: dict.
+    :return: str.
+    """
+    if isinstance(item, dict):
+        for key in item.keys():
+            if key == 'pref' and item[key] == 'Y':
+                return item['content']
+            return reference_fetch_pi_institution(item[key])
+    if isinstance(item, list):
+        names_list = []
+        for element in item:
+            names_list.append(reference_fetch_pi_institution(element))
+        return ', '.join(n for n in set(names_list) if n)
+    return ''
+
+
+def reference_fetch_fin_year(item):
+    """Retrieve the financial year value, if present in the grant record.
+
+    :param item: dict.
+    :return: int or str.
+    """
+    if 'financial_year' in item.keys():
+        return item['financial_year']
+    return ''
+
+
+def reference_fetch_related_records(item):
+    """Retrieve the associated Web of Science records list, if present
+    in the grant record.
+
+    :param item: dict.
+    :return: str, int.
+    """
+    if 'related_records' in item.keys():
+        if isinstance(item['related_records']['record'], list):
+            records_list = [r['uid'] for r in item['related_records']['record']]
+            return ', '.join(records_list), len(records_list)
+        return item['related_records']['record']['uid'], 1
+    return '', 0
+
+
+def reference_fetch_document_title(item):
+    """Retrieve the grant title.
+
+    :param item: dict.
+    :return: str.
+    """
+    if isinstance(item['title'], list):
+        for title in item['title']:
+            if title['type'] == 'item':
+                return title['content']
+    return item['title']['content']
+
+
+def reference_fetch_keywords(item):
+    """Retrieve grant keywords.
+
+    :param item: dict.
+    :return: str.
+    """
+    keywords_list = []
+    if 'keywords' in item:
+        if isinstance(item['keywords']['keyword'], list):
+            for keyword in item['keywords']['keyword']:
+                if 'content' in keyword.keys():
+                    keywords_list.append(str(keyword['content']))
+            return ', '.join(keywords_list)
+        if 'content' in item['keywords']['keyword'].keys():
+            return item['keywords']['keyword']['content']
+    return ''
+
+
+def reference_fetch_abstract(item):
+    """Retrieve grant description.
+
+    :param item: dict.
+    :return: str.
+    """
+    if isinstance(item['abstracts'], list):
+        return [', '.join(a['abstract_text']['p']) for a in item['abstracts']['abstract']]
+    if 'abstract' in item['abstracts'].keys():
+        return item['abstracts']['abstract']['abstract_text']['p']
+    return ''
+
+
+def reference_convert_to_usd(amount, currency, rates):
+    """Converts grant amount into USD.
+
+    :param amount: int or float.
+    :param currency: str.
+    :param rates: dict.
+    :return: str or float.
+    """
+    if amount != '':
+        if currency == 'USD':
+            return amount
+        if currency in rates.keys():
+            return amount / rates[f'{currency}']
+    return ''
+
+
+def reference_fetch_data(rec, rates):
+    """Take JSON retrieved by the API, return the grant fields of the
+    record, as the helpers did before extract_grant_fields.
+
+    :param rec: dict.
+    :param rates: dict.
+    :return: dict.
+    """
+    ut = rec['UID']
+    principal_investigator, other_names = reference_fetch_names(
+        rec['static_data']['summary']['names'])
+    doctitle = reference_fetch_document_title(rec['static_data']['summary']['titles'])
+    related_wos_records, related_wos_records_count = reference_fetch_related_records(
+        rec['static_data']['fullrecord_metadata'])
+    grant = rec['static_data']['fullrecord_metadata']['fund_ack']['grants']['grant']
+    grant_source = grant['grant_source']
+    grant_data_item = grant['grant_data']['grantDataItem']
+    grant_pi_institution = reference_fetch_pi_institution(grant_data_item['principalInvestigators'])
+    grant_amount = grant_data_item['totalAwardAmount']
+    grant_currency = grant_data_item['currency']
+    grant_amount_in_usd = reference_convert_to_usd(grant_amount, grant_currency, rates)
+
+    return {
+        'UT': ut,
+        'Publication Year': rec['static_data']['summary']['pub_info']['pubyear'],
+        'Financial Year': reference_fetch_fin_year(rec['static_data']['item']),
+        'Principal Investigator': principal_investigator,
+        'Other Names': other_names,
+        'Document Type': rec['static_data']['summary']['doctypes']['doctype'],
+        'Document Title': str(doctitle),
+        'Keywords': reference_fetch_keywords(rec['static_data']['fullrecord_metadata']),
+        'Grant Description': reference_fetch_abstract(rec['static_data']['fullrecord_metadata']),
+        'Related WoS Records': related_wos_records,
+        'Related WoS Records Count': related_wos_records_count,
+        'Funding Agency': reference_fetch_grant_agency(grant),
+        'Funding Country': reference_fetch_grant_country(rec['static_data']['item']),
+        'Grant Source': grant_source,
+        'Principal Investigator Institution': grant_pi_institution,
+        'Grant Amount': grant_amount,
+        'Currency': grant_currency,
+        'Grant Amount, USD': grant_amount_in_usd
+    }
+
+
+def time_per_record(function, recs, *args, repeats=BENCHMARK_REPEATS):
+    """Return the best time of calling the function on each of the
+    records, in microseconds per record.
+
+    :param function: function taking a record and the extra arguments.
+    :param recs: list of dict.
+    :param repeats: int.
+    :return: float.
+    """
+    best = min(timeit.repeat(lambda: [function(rec, *args) for rec in recs], number=1,
+                             repeat=repeats))
+    return best / len(recs) * 1e6
+
+
+def benchmark_extraction(count=BENCHMARK_RECORDS):
+    """Measure the time spent extracting the grant fields of a record,
+    with and without the currency conversion, against the hand-written
+    helpers extract_grant_fields replaced.
+
+    :param count: int.
+    :return: dict.
+    """
+    recs = synthetic_records(count)
+    pages = [recs[i:i + RECORDS_PER_PAGE] for i in range(0, len(recs), RECORDS_PER_PAGE)]
+    timings = {
+        'reference fetch_data, us/record': time_per_record(reference_fetch_data, recs,
+                                                           BENCHMARK_RATES),
+        'extract_grant_fields, us/record': time_per_record(extract_grant_fields, recs)
+    }
+    batches_time = min(timeit.repeat(
+        lambda: [fetch_data_batch(page, BENCHMARK_RATES) for page in pages],
+        number=1, repeat=BENCHMARK_REPEATS))
+    timings['fetch_data_batch, us/record'] = batches_time / len(recs) * 1e6
+    return timings
+
+
+def benchmark_json_decoding(count=RECORDS_PER_PAGE, repeats=BENCHMARK_REPEATS):
+    """Measure the decoding throughput of an API page with the standard
+    library, with the accelerated decoder, and streamed record by record
+    from chunks of the response body, in MB per second.
+
+    :param count: int.
+    :param repeats: int.
+    :return: dict.
+    """
+    document = json.dumps(synthetic_page(1, count, count)).encode('utf-8')
+    chunk_size = json_decoding.STREAM_CHUNK_SIZE
+    chunks = [document[i:i + chunk_size] for i in range(0, len(document), chunk_size)]
+    decoders = {
+        'json.loads': lambda: json.loads(document),
+        f'loads ({json_decoding.JSON_BACKEND})': lambda: json_decoding.loads(document),
+        f'iterate_records ({json_decoding.STREAM_BACKEND})':
+            lambda: list(json_decoding.iterate_records(chunks))
+    }
+    megabytes = len(document) / 1e6
+    return {f'{name}, MB/s': megabytes / min(timeit.repeat(decode, number=1, repeat=repeats))
+            for name, decode in decoders.items()}
+
+
+def record_fixtures(apikey, query, directory, records_per_page=RECORDS_PER_PAGE):
+    """Save the API pages of a search query as JSON files named after
+    their firstRecord value, to be replayed by the stub server.
+
+    :param apikey: str.
+    :param query: str.
+    :param directory: str.
+    :param records_per_page: int.
+    :return: int.
+    """
+    os.makedirs(directory, exist_ok=True)
+    pages_count = 0
+    for first_record, page_json in zip(range(1, 2 ** 31, records_per_page),
+                                       iterate_pages(apikey, query, records_per_page)):
+        with open(os.path.join(directory, f'{first_record}.json'), 'wb') as writing:
+            writing.write(json_decoding.dumps(page_json))
+        pages_count += 1
+    return pages_count
+
+
+def load_fixtures(directory):
+    """Read the recorded API pages as encoded JSON documents.
+
+    :param directory: str.
+    :return: dict.
+    """
+    pages = {}
+    for filename in os.listdir(directory):
+        first_record, extension = os.path.splitext(filename)
+        if extension == '.json' and first_record.isdigit():
+            with open(os.path.join(directory, filename), 'rb') as reading:
+                pages[int(first_record)] = reading.read()
+    return pages
+
+
+def synthetic_pages(records, records_per_page=RECORDS_PER_PAGE):
+    """Generate the API pages of a search query returning the given
+    number of synthetic records, as encoded JSON documents.
+
+    :param records: int.
+    :param records_per_page: int.
+    :return: dict.
+    """
+    return {first_record: json_decoding.dumps(synthetic_page(first_record, records_per_page,
+                                                             records))
+            for first_record in range(1, max(records, 1) + 1, records_per_page)}
+
+
+class StubApiHandler(BaseHTTPRequestHandler):
+    """Answer the Web of Science Expanded API requests with the page
+    matching their firstRecord parameter.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    pages = {}
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Send the requested page, or a 404 error if there is none."""
+        params = parse_qs(urlparse(self.path).query)
+        first_record = int(params.get('firstRecord', ['1'])[0])
+        body = self.pages.get(first_record)
+        status = 200
+        if body is None:
+            status = 404
+            body = json_decoding.dumps({'message': f'No page at firstRecord: {first_record}'})
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Keep the benchmark output quiet."""
+
+
+def serve_pages(fixtures, records, port_queue):
+    """Run the stub API server, serving the recorded fixtures if a
+    directory is given, or synthetic pages otherwise. The port the
+    server listens on is sent through the queue.
+
+    :param fixtures: str or None.
+    :param records: int.
+    :param port_queue: multiprocessing.Queue.
+    """
+    StubApiHandler.pages = load_fixtures(fixtures) if fixtures else synthetic_pages(records)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubApiHandler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class StubApiServer:
+    """Run the stub API server in a separate process, so that neither
+    its CPU time nor its memory are counted in the measurements, and
+    point the API client at it while the server is running.
+    """
+
+    def __init__(self, fixtures=None, records=BENCHMARK_RECORDS):
+        self.fixtures = fixtures
+        self.records = records
+        self.process = None
+        self.previous_client = None
+
+    def __enter__(self):
+        context = multiprocessing.get_context('spawn')
+        port_queue = context.Queue()
+        self.process = context.Process(target=serve_pages,
+                                       args=(self.fixtures, self.records, port_queue),
+                                       daemon=True)
+        self.process.start()
+        port = port_queue.get(timeout=600)
+        self.previous_client = api_operations.api_client
+        api_operations.api_client = ApiClient(wos_url=f'http://127.0.0.1:{port}/api/wos')
+        return self
+
+    def __exit__(self, *exc_info):
+        api_operations.api_client.close()
+        api_operations.api_client = self.previous_client
+        self.process.terminate()
+        self.process.join()
+
+
+def measure(function, memory=True):
+    """Call the function and measure the time it takes. With memory, the
+    function is called a second time while tracing the allocations, to
+    measure its peak memory use without slowing down the timed call.
+
+    :param function: function.
+    :param memory: bool.
+    :return: tuple of the function result and a dict.
+    """
+    start = time.perf_counter()
+    result = function()
+    measurement = {'seconds': time.perf_counter() - start}
+    if memory:
+        del result
+        tracemalloc.start()
+        try:
+            result = function()
+            measurement['peak_memory_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+    return result, measurement
+
+
+def fetch_all_pages(records_per_page=RECORDS_PER_PAGE):
+    """Retrieve all the pages of the search query from the stub server,
+    the way iterate_pages does without checkpoints.
+
+    :param records_per_page: int.
+    :return: list of dict.
+    """
+    initial_json = retrieve_wos_metadata_via_api('benchmark', 'benchmark', records_per_page)
+    total_results = initial_json['QueryResult']['RecordsFound']
+    first_records = range(records_per_page + 1, total_results + 1, records_per_page)
+    return [initial_json, *retrieve_pages('benchmark', 'benchmark', records_per_page,
+                                          first_records,
+                                          requests_per_second=STUB_REQUESTS_PER_SECOND)]
+
+
+def benchmark_harvest(records=BENCHMARK_RECORDS, fixtures=None, memory=True):
+    """Measure each stage of a harvest: retrieving the pages from the
+    stub server, parsing the records, building the DataFrame, saving it
+    as Parquet, exporting it to Excel, computing the aggregates, and
+    drawing each of the plots.
+
+    :param records: int.
+    :param fixtures: str or None.
+    :param memory: bool.
+    :return: dict.
+    """
+    stages = {}
+    with StubApiServer(fixtures, records):
+        pages, stages['fetch'] = measure(fetch_all_pages, memory)
+    grants, stages['parse'] = measure(
+        lambda: [grant for page_json in pages
+                 for grant in fetch_data_batch(page_records(page_json), BENCHMARK_RATES)],
+        memory)
+    del pages
+    df, stages['dataframe'] = measure(lambda: grants_frame(grants), memory)
+    del grants
+
+    with tempfile.TemporaryDirectory() as directory:
+        parquet_path = os.path.join(directory, 'grants.parquet')
+
+        def save_parquet():
+            sink = ParquetSink(parquet_path)
+            sink.write(df)
+            sink.close()
+
+        def save_excel():
+            sink = ExcelSink(os.path.join(directory, 'grants.xlsx'))
+            sink.write(df)
+            sink.close()
+
+        _, stages['parquet_export'] = measure(save_parquet, memory)
+        _, stages['excel_export'] = measure(save_excel, memory)
+        _, stages['excel_export_from_parquet'] = measure(lambda: export_to_excel(parquet_path),
+                                                         memory)
+
+    def aggregate():
+        aggregates = GrantsAggregates()
+        aggregates.write(df)
+        return aggregates
+
+    aggregates, stages['aggregates'] = measure(aggregate, memory)
+    for plot in PLOTS:
+        _, stages[plot.__name__] = measure(lambda plot=plot: plot(aggregates), memory)
+    return {'records': len(df), 'stages': stages}
+
+
+def benchmark_imports(targets=IMPORT_TARGETS, repeats=BENCHMARK_REPEATS):
+    """Time the import of each entry point in a fresh interpreter, the
+    best of a few runs, and report which heavy modules it loaded. The
+    app is also created, the way a server worker starts.
+
+    :param targets: iterable of str.
+    :param repeats: int.
+    :return: dict.
+    """
+    imports = {}
+    for module in targets:
+        code = IMPORT_PROBE.format(module=module, create_app=module == 'app',
+                                   heavy=HEAVY_MODULES)
+        runs = [json.loads(subprocess.run([sys.executable, '-c', code], check=True,
+                                          capture_output=True, text=True).stdout)
+                for _ in range(repeats)]
+        imports[module] = {'seconds': round(min(run['seconds'] for run in runs), 3),
+                           'loaded': runs[0]['loaded']}
+    return imports
+
+
+def synthetic_links(grants, links_per_grant, funders=LINK_GRAPH_FUNDERS,
+                    records=LINK_GRAPH_RECORDS, seed=0):
+    """Generate a reproducible link graph input: grants with one or a
+    few funders from a skewed distribution, linked to records a few of
+    which are related to many grants.
+
+    :param grants: int.
+    :param links_per_grant: int, the mean number of links of a grant.
+    :param funders: int.
+    :param records: int.
+    :param seed: int.
+    :return: tuple of five lists, the arguments of LinkGraph.
+    """
+    rng = np.random.default_rng(seed)
+    grant_uts = [f'GRANTS:{number:08d}' for number in range(grants)]
+    funder_grants = np.repeat(np.arange(grants), 1 + rng.poisson(0.5, grants))
+    funder_names = [f'Funder {rank % funders}'
+                    for rank in rng.zipf(1.3, len(funder_grants)).tolist()]
+    edge_grants = np.repeat(np.arange(grants), rng.poisson(links_per_grant, grants))
+    edge_records = (rng.zipf(1.2, len(edge_grants)) * 7919
+                    + rng.integers(0, records, len(edge_grants))) % records
+    return (grant_uts, [grant_uts[grant] for grant in funder_grants.tolist()], funder_names,
+            [grant_uts[grant] for grant in edge_grants.tolist()],
+            [f'WOS:{record:015d}' for record in edge_records.tolist()])
+
+
+def benchmark_link_graph(grants=LINK_GRAPH_GRANTS, links_per_grant=LINK_GRAPH_LINKS_PER_GRANT):
+    """Time building the link graph of synthetic grants and each of its
+    queries.
+
+    :param grants: int.
+    :param links_per_grant: int.
+    :return: dict.
+    """
+    links = synthetic_links(grants, links_per_grant)
+    graph, build_seconds = measure(lambda: LinkGraph(*links), memory=False)
+    funder = graph.funders[0]
+    stages = {'build': build_seconds}
+    for name, query in (('top_linked_grants', graph.top_linked_grants),
+                        ('record_funder_pairs', graph.record_funder_pairs),
+                        ('co_funders', lambda: graph.co_funders(funder)),
+                        ('top_co_funding', graph.top_co_funding),
+                        ('funder_clusters', graph.funder_clusters)):
+        _, stages[name] = measure(query, memory=False)
+    return {'grants': grants, 'records': len(graph.record_uts), 'links': graph.links_count,
+            'stages': stages}
+
+
+def run_benchmarks(scales=BENCHMARK_SCALES, fixtures=None, memory=True):
+    """Run the harvest benchmark on the recorded fixtures, or on each
+    scale of synthetic records, and the micro-benchmarks.
+
+    :param scales: iterable of int.
+    :param fixtures: str or None.
+    :param memory: bool.
+    :return: dict.
+    """
+    if fixtures:
+        harvests = {'fixtures': benchmark_harvest(fixtures=fixtures, memory=memory)}
+    else:
+        harvests = {str(records): benchmark_harvest(records, memory=memory) for records in scales}
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'json_backend': json_decoding.JSON_BACKEND,
+        'harvests': harvests,
+        'micro': {**benchmark_extraction(), **benchmark_json_decoding()},
+        'imports': benchmark_imports(),
+        'link_graph': benchmark_link_graph()
+    }
+
+
+def parse_arguments():
+    """Parse the command line options.
+
+    :return: argparse.Namespace.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n', maxsplit=1)[0])
+    parser.add_argument('--records', type=int, nargs='+', default=list(BENCHMARK_SCALES),
+                        help='numbers of synthetic records to harvest')
+    parser.add_argument('--fixtures', help='directory of recorded API pages to replay')
+    parser.add_argument('--record', metavar='QUERY',
+                        help='record the API pages of a search query into the --fixtures '
+                             'directory instead of running the benchmarks')
+    parser.add_argument('--output', default=BENCHMARK_RESULTS,
+                        help='file to write the JSON results to')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the peak memory measurements')
+    arguments = parser.parse_args()
+    if arguments.record and not arguments.fixtures:
+        parser.error('--record requires --fixtures')
+    return arguments
+
+
+if __name__ == '__main__':
+    arguments = parse_arguments()
+    if arguments.record:
+        from apikeys import EXPANDED_APIKEY  # pylint: disable=import-error
+        pages_recorded = record_fixtures(EXPANDED_APIKEY, arguments.record, arguments.fixtures)
+        print(f'Pages recorded: {pages_recorded}.')
+    else:
+        results = run_benchmarks(arguments.records, arguments.fixtures, arguments.memory)
+        with open(arguments.output, 'w', encoding='utf-8') as output:
+            json.dump(results, output, indent=2)
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,136 @@
+"""
+Persist the retrieved API pages of a search query to a local SQLite
+checkpoint store, so that an interrupted harvest can be resumed by
+fetching only the pages that are missing.
+"""
+
+from datetime import date, timedelta
+import os
+import sqlite3
+import threading
+import zlib
+from json_decoding import dumps, loads
+
+CHECKPOINTS_DB = 'cache/checkpoints.sqlite3'
+CHECKPOINT_MAX_AGE = timedelta(days=7)
+
+
+class CheckpointStore:
+    """Compressed JSON pages keyed by (query, firstRecord, count), with
+    a manifest per query recording the total number of records found
+    and the date the harvest was started.
+    """
+
+    def __init__(self, path=CHECKPOINTS_DB, max_age=CHECKPOINT_MAX_AGE):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS manifests ('
+                'query TEXT PRIMARY KEY, records_found INTEGER, harvest_date TEXT, '
+                'completed INTEGER DEFAULT 0)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS pages ('
+                'query TEXT, first_record INTEGER, count INTEGER, page BLOB, '
+                'PRIMARY KEY (query, first_record, count))'
+            )
+
+    def get_manifest(self, query):
+        """Return the manifest of an unfinished harvest of the search
+        query that is recent enough to be resumed, if any.
+
+        :param query: str.
+        :return: dict or None.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT records_found, harvest_date FROM manifests '
+                'WHERE query = ? AND completed = 0',
+                (query,)
+            ).fetchone()
+        if row is None:
+            return None
+        harvest_date = date.fromisoformat(row[1])
+        if date.today() - harvest_date > self.max_age:
+            return None
+        return {'records_found': row[0], 'harvest_date': harvest_date}
+
+    def start_harvest(self, query, records_found):
+        """Record the manifest of a new harvest. The pages saved by an
+        earlier harvest of the same query are kept only if it can be
+        resumed and has found the same number of records.
+
+        :param query: str.
+        :param records_found: int.
+        """
+        manifest = self.get_manifest(query)
+        if manifest is not None and manifest['records_found'] == records_found:
+            return
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM pages WHERE query = ?', (query,))
+            self.connection.execute(
+                'INSERT OR REPLACE INTO manifests VALUES (?, ?, ?, 0)',
+                (query, records_found, date.today().isoformat())
+            )
+
+    def finish_harvest(self, query):
+        """Mark the harvest of the search query as complete and drop
+        its pages.
+
+        :param query: str.
+        """
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM pages WHERE query = ?', (query,))
+            self.connection.execute('UPDATE manifests SET completed = 1 WHERE query = ?',
+                                    (query,))
+
+    def saved_first_records(self, query, count):
+        """Return the firstRecord values of the pages already saved.
+
+        :param query: str.
+        :param count: int.
+        :return: set of int.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT first_record FROM pages WHERE query = ? AND count = ?',
+                (query, count)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def get_page(self, query, first_record, count, raw=False):
+        """Return a saved page, if any, decoded, or as the raw JSON
+        document if raw is True.
+
+        :param query: str.
+        :param first_record: int.
+        :param count: int.
+        :param raw: bool.
+        :return: dict, bytes or None.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT page FROM pages WHERE query = ? AND first_record = ? AND count = ?',
+                (query, first_record, count)
+            ).fetchone()
+        if row is None:
+            return None
+        page = zlib.decompress(row[0])
+        return page if raw else loads(page)
+
+    def put_page(self, query, first_record, count, page_json):
+        """Save a retrieved page, decoded or as its raw JSON document.
+
+        :param query: str.
+        :param first_record: int.
+        :param count: int.
+        :param page_json: dict or bytes.
+        """
+        page = zlib.compress(page_json if isinstance(page_json, bytes) else dumps(page_json))
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)',
+                                    (query, first_record, count, page))
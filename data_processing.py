@@ -1,236 +1,516 @@
 """
-Fetch necessary metadata fields from Grants Index records. ALso fetch
-currency rates from the currency converter app or local cache, and
-return them as dictionaries for
+Fetch necessary metadata fields from Grants Index records, and convert
+the grant amounts into USD with the exchange rates of exchange_rates.
 """
 
-from datetime import date, datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import multiprocessing
+import os
+import numpy as np
 import pandas as pd
-from api_operations import retrieve_rates_via_api
 
-
-def retrieve_rates_from_table():
-    """Get the exchange rates from the locally cached .csv file in case
-    the API endpoint doesn't return data.
-
-    :return: dict.
+# The pool of processes the records can be parsed in, see
+# pipeline.iterate_grants.
+PARSE_WORKERS = os.cpu_count()
+
+# The columns with few distinct values, stored as pandas categoricals
+# and dictionary encoded in the data files (see storage.GRANTS_SCHEMA),
+# and the numeric columns, stored as nullable numbers.
+CATEGORICAL_COLUMNS = ['Document Type', 'Funding Country', 'Grant Source', 'Currency']
+INTEGER_COLUMNS = ['Publication Year', 'Financial Year', 'Related WoS Records Count']
+FLOAT_COLUMNS = ['Grant Amount', 'Grant Amount, USD']
+
+parse_executor = None
+
+
+# The parts of a record shared by several fields, as (parent part, path
+# from the parent), resolved once per record.
+RECORD_PARTS = {
+    'static_data': (None, ('static_data',)),
+    'summary': ('static_data', ('summary',)),
+    'item': ('static_data', ('item',)),
+    'metadata': ('static_data', ('fullrecord_metadata',)),
+    'grant': ('metadata', ('fund_ack', 'grants', 'grant')),
+    'grant_data': ('grant', ('grant_data', 'grantDataItem'))
+}
+
+# The output columns, in order. Each field is read from a record part
+# along a path. Fields with 'many' cardinality treat a single dict as a
+# list of one, keep the elements matching 'where' (or not matching
+# 'where_not'; with 'where_list_only', a single dict is always kept),
+# take the 'select' path of each of them, and combine the values with
+# the 'join' rule: first, last, all (comma-separated), unique
+# (comma-separated, without repetitions), list (a list, without
+# repetitions) or count. The 'preferred' join rule takes the preferred
+# names found by following the first key of each nested dict. The
+# Funding Agencies list is only kept for the grant to funding agency
+# edges, see storage.funder_edges.
+GRANT_FIELDS = [
+    {'column': 'UT', 'part': None, 'path': ('UID',)},
+    {'column': 'Publication Year', 'part': 'summary', 'path': ('pub_info', 'pubyear')},
+    {'column': 'Financial Year', 'part': 'item', 'path': ('financial_year',)},
+    {'column': 'Principal Investigator', 'part': 'summary', 'path': ('names', 'name'),
+     'many': True, 'where': ('role', 'principal_investigator'), 'select': ('full_name',),
+     'join': 'last'},
+    {'column': 'Other Names', 'part': 'summary', 'path': ('names', 'name'),
+     'many': True, 'where_not': ('role', 'principal_investigator'), 'select': ('full_name',),
+     'join': 'all'},
+    {'column': 'Document Type', 'part': 'summary', 'path': ('doctypes', 'doctype')},
+    {'column': 'Document Title', 'part': 'summary', 'path': ('titles', 'title'),
+     'many': True, 'where': ('type', 'item'), 'where_list_only': True, 'select': ('content',),
+     'join': 'first'},
+    {'column': 'Keywords', 'part': 'metadata', 'path': ('keywords', 'keyword'),
+     'many': True, 'select': ('content',), 'join': 'all'},
+    {'column': 'Grant Description', 'part': 'metadata', 'path': ('abstracts', 'abstract'),
+     'many': True, 'select': ('abstract_text', 'p'), 'join': 'all'},
+    {'column': 'Related WoS Records', 'part': 'metadata', 'path': ('related_records', 'record'),
+     'many': True, 'select': ('uid',), 'join': 'all'},
+    {'column': 'Related WoS Records Count', 'part': 'metadata',
+     'path': ('related_records', 'record'), 'many': True, 'join': 'count'},
+    {'column': 'Funding Agency', 'part': 'grant', 'path': ('grant_agency_names',),
+     'many': True, 'where': ('pref', 'Y'), 'where_list_only': True, 'select': ('content',),
+     'join': 'unique'},
+    {'column': 'Funding Country', 'part': 'item', 'path': ('grant_agencies', 'grant_agency'),
+     'many': True, 'select': ('country',), 'join': 'unique'},
+    {'column': 'Grant Source', 'part': 'grant', 'path': ('grant_source',)},
+    {'column': 'Principal Investigator Institution', 'part': 'grant_data',
+     'path': ('principalInvestigators',), 'join': 'preferred'},
+    {'column': 'Grant Amount', 'part': 'grant_data', 'path': ('totalAwardAmount',)},
+    {'column': 'Currency', 'part': 'grant_data', 'path': ('currency',)},
+    {'column': 'Funding Agencies', 'part': 'grant', 'path': ('grant_agency_names',),
+     'many': True, 'where': ('pref', 'Y'), 'where_list_only': True, 'select': ('content',),
+     'join': 'list'}
+]
+
+
+def path_lookup(target, source, path, default, indent=1):
+    """Return the source code lines assigning the value at a path of
+    keys to a variable, or a default value if any of the keys is
+    missing or leads to a value that is not a dict.
+
+    :param target: str.
+    :param source: str.
+    :param path: tuple of str.
+    :param default: str.
+    :param indent: int.
+    :return: list of str.
     """
-    rates_df = pd.read_csv(filepath_or_buffer='currencies.csv',
-                           skiprows=2,
-                           index_col='Currency')
-    return rates_df.to_dict(orient='dict')['Rate VS USD']
-
-
-def get_usd_rates():
-    """Retrieve exchange rates to convert various currencies into USD.
-
-    :return: dict.
+    pad = '    ' * indent
+    return [f'{pad}try:',
+            f'{pad}    {target} = {source}' + ''.join(f'[{key!r}]' for key in path),
+            f'{pad}except (KeyError, TypeError):',
+            f'{pad}    {target} = {default}']
+
+
+def select_values(elements, select, where=None, where_not=None):
+    """Return the values at the select path of the elements matching
+    the field conditions, as strings. This is the general case of the
+    compiled loops, used when some of the elements miss the selected
+    value or the values are not strings.
+
+    :param elements: list of dict.
+    :param select: tuple of str.
+    :param where: tuple or None.
+    :param where_not: tuple or None.
+    :return: list of str.
     """
-    tod = date.today()
-    with open('currencies.csv', 'r', encoding='utf-8') as reading:
-        updated = datetime.strptime(reading.readline().split(',')[1][:-1], '%m/%d/%Y').date()
-    if tod - updated < timedelta(days=1):
-        return retrieve_rates_from_table()
-    return retrieve_rates_via_api()
-
-
-def fetch_names(names_json):
-    """Retrieve the names of the principal investigator and other grant participants, if any.
-
-    :param names_json: dict.
-    :return: str, str.
+    values = []
+    for element in elements:
+        if not isinstance(element, dict):
+            continue
+        if where is not None and element.get(where[0]) != where[1]:
+            continue
+        if where_not is not None and element.get(where_not[0]) == where_not[1]:
+            continue
+        for key in select:
+            element = element.get(key) if isinstance(element, dict) else None
+        if isinstance(element, list):
+            values.extend(str(v) for v in element)
+        elif element is not None:
+            values.append(str(element))
+    return values
+
+
+def preferred_name(value):
+    """Return the preferred name in a nested structure, following the
+    first key of each dict. The unique preferred names of the elements
+    of a list are joined.
+
+    :param value: dict, list or str.
+    :return: str.
     """
-    pr_inv = ''
-    other_nms = ''
-    if names_json['count'] > 0:
-        if names_json['count'] == 1 and names_json['name']['role'] == 'principal_investigator':
-            pr_inv = names_json['name']['full_name']
-        elif names_json['count'] == 1 and names_json['name']['role'] != 'principal_investigator':
-            other_nms = names_json['name']['full_name']
+    while value.__class__ is dict:
+        for key in value:
+            if key == 'pref':
+                return value.get('content', '') if value[key] == 'Y' else ''
+            value = value[key]
+            break
         else:
-            non_pis = []
-            for name in names_json['name']:
-                if name['role'] == 'principal_investigator':
-                    pr_inv = name['full_name']
-                else:
-                    non_pis.append(name['full_name'])
-            other_nms = ', '.join(non_pis)
-    return pr_inv, other_nms
+            return ''
+    if value.__class__ is list:
+        names = (preferred_name(element) for element in value)
+        return ', '.join(dict.fromkeys(name for name in names if name))
+    return ''
 
 
-def fetch_grant_agency(item):
-    """Retrieve the name(s) of the grant agencies, if any.
+def field_condition(field, element):
+    """Return the source code of the condition an element must meet to
+    be included in the field value. A missing key raises a KeyError, so
+    that the element is handled by the general case.
 
-    :param item: dict.
-    :return: str.
+    :param field: dict.
+    :param element: str.
+    :return: str or None.
     """
-    agencies = []
-    if isinstance(item['grant_agency_names'], list):
-        for funder in item['grant_agency_names']:
-            if funder['pref'] == 'Y' and funder['content'] not in agencies:
-                agencies.append(funder['content'])
-        return ', '.join(agencies)
-    return item['grant_agency_names']['content']
+    if 'where' in field:
+        return f'{element}[{field["where"][0]!r}] == {field["where"][1]!r}'
+    if 'where_not' in field:
+        return f'{element}[{field["where_not"][0]!r}] != {field["where_not"][1]!r}'
+    return None
 
 
-def fetch_grant_country(item):
-    """Return country of the funding agency
+def field_combination(field, values):
+    """Return the source code of the expression combining the values
+    selected from the elements with the field join rule.
 
-    :param item: dict.
+    :param field: dict.
+    :param values: str.
     :return: str.
     """
-    if 'grant_agencies' in item.keys():
-        funders_json = item['grant_agencies']['grant_agency']
-        if isinstance(funders_json, list):
-            return ', '.join(list(set(f['country'] for f in funders_json)))
-        return funders_json['country']
-    return ''
-
-
-def fetch_pi_institution(item):
-    """Retrieve the name(s) of the principal investigator's
-    institution, if any. Due to the complexity of the JSON nesting,
-    this function will call itself to get the necessary fields.
-
-    :param item: dict.
-    :return: str.
+    if field['join'] == 'count':
+        return f'len({values})'
+    if field['join'] == 'first':
+        return f"{values}[0] if {values} else ''"
+    if field['join'] == 'last':
+        return f"{values}[-1] if {values} else ''"
+    if field['join'] == 'unique':
+        return f"', '.join(dict.fromkeys({values}))"
+    if field['join'] == 'list':
+        return f'list(dict.fromkeys({values}))'
+    return f"', '.join({values})"
+
+
+def element_group_lines(elements, members):
+    """Return the source code lines computing the values of all the
+    fields read from the same single dict or list of dicts, going over
+    the list once. The code is specialized for the common case of
+    string values present in every element, the general case is
+    handled by select_values. The first or last value of a field is
+    assigned in the loop, the values of the other fields are collected
+    in lists, shared by the fields selecting the same values. The
+    conditions of the fields with 'where_list_only' are not applied to
+    a single dict.
+
+    :param elements: str.
+    :param members: list of (str, dict) tuples of target variable names
+        and field specifications.
+    :return: list of str.
     """
-    if isinstance(item, dict):
-        for key in item.keys():
-            if key == 'pref' and item[key] == 'Y':
-                return item['content']
-            return fetch_pi_institution(item[key])
-    if isinstance(item, list):
-        names_list = []
-        for element in item:
-            names_list.append(fetch_pi_institution(element))
-        return ', '.join(n for n in set(names_list) if n)
-    return ''
-
-
-def fetch_fin_year(item):
-    """Retrieve the financial year value, if present in the grant record.
-
-    :param item: dict.
-    :return: int or str.
+    collectors = []
+    shared = {}
+    initial = []
+    results = []
+    general_case = []
+    dict_lines = []
+    checked = set()
+    for target, field in members:
+        condition = field_condition(field, 'element')
+        single_condition = None if field.get('where_list_only') else \
+            field_condition(field, elements)
+        single_where = (None, None) if field.get('where_list_only') else \
+            (field.get('where'), field.get('where_not'))
+        select = ''.join(f'[{key!r}]' for key in field.get('select', ()))
+        if field['join'] == 'count' and condition is None:
+            results.append(f'            {target} = len({elements})')
+            general_case.append(f'            {target} = len({elements})')
+            dict_lines.append(f'        {target} = 1')
+            continue
+        selected = 'element' if field['join'] == 'count' else f'element{select}'
+        if field['join'] in ('first', 'last'):
+            values = f'values_{target}'
+            collectors.append((field['join'], target, selected, condition))
+            general_case.append(f'            {values} = select_values({elements}, '
+                                f'{field["select"]!r}, {field.get("where")!r}, '
+                                f'{field.get("where_not")!r})')
+            if field['join'] == 'first':
+                # None until a value is found, as select_values skips
+                # the missing values.
+                initial.append(f'            {target} = None')
+                results += [f'            if {target} is None:',
+                            f"                {target} = ''"]
+            else:
+                initial.append(f"            {target} = ''")
+        else:
+            values = shared.get((selected, condition))
+            if values is None:
+                values = shared[selected, condition] = f'values_{target}'
+                collectors.append(('append', values, selected, condition))
+                initial.append(f'            {values} = []')
+                if field['join'] != 'count':
+                    general_case.append(f'            {values} = select_values({elements}, '
+                                        f'{field["select"]!r}, {field.get("where")!r}, '
+                                        f'{field.get("where_not")!r})')
+            results.append(f'            {target} = {field_combination(field, values)}')
+        # The values that are not strings are left to the general case:
+        # joining them raises a TypeError, the other values are checked.
+        if field['join'] in ('all', 'unique'):
+            checked.add(values)
+        elif field['join'] in ('first', 'last'):
+            results += [f'            if {target}.__class__ is not str:',
+                        '                raise TypeError']
+        elif field['join'] == 'list' and values not in checked:
+            results.append(f"            ''.join({target})")
+        if field['join'] == 'count':
+            general_case.append(f'            {target} = len(select_values({elements}, (), '
+                                f'{field.get("where")!r}, {field.get("where_not")!r}))')
+            dict_lines.append(f'        {target} = len(select_values([{elements}], (), '
+                              f'{single_where[0]!r}, {single_where[1]!r}))')
+            continue
+        general_case.append(f'            {target} = {field_combination(field, values)}')
+        if field['join'] == 'list':
+            dict_lines += [f'        {values} = select_values([{elements}], '
+                           f'{field["select"]!r}, {single_where[0]!r}, {single_where[1]!r})',
+                           f'        {target} = {field_combination(field, values)}']
+            continue
+        single_value = f'{elements}{select}'
+        if single_condition is not None:
+            single_value = f"{single_value} if {single_condition} else ''"
+        dict_lines += ['        try:',
+                       f'            {target} = {single_value}',
+                       '        except (KeyError, TypeError):',
+                       f'            {target} = None',
+                       f'        if {target}.__class__ is not str:',
+                       f'            {values} = select_values([{elements}], {field["select"]!r}, '
+                       f'{single_where[0]!r}, {single_where[1]!r})',
+                       f'            {target} = {field_combination(field, values)}']
+    empty_values = {'count': '0', 'list': '[]'}
+    defaults = [f'        {target} = {empty_values.get(field["join"], repr(""))}'
+                for target, field in members]
+
+    lines = [f'    if {elements}.__class__ is list:']
+    if len(collectors) == 1 and collectors[0][0] == 'append' and collectors[0][3] is None:
+        _, values, selected, _ = collectors[0]
+        lines += ['        try:',
+                  f'            {values} = [{selected} for element in {elements}]',
+                  *results,
+                  '        except (KeyError, TypeError, AttributeError):',
+                  *general_case]
+    elif collectors:
+        lines += ['        try:',
+                  *initial,
+                  f'            for element in {elements}:']
+        previous = None
+        for kind, variable, selected, condition in collectors:
+            if kind == 'append':
+                action = [f'{variable}.append({selected})']
+            elif kind == 'last':
+                action = [f'{variable} = {selected}']
+            else:
+                action = [f'if {variable} is None:', f'    {variable} = {selected}']
+            if condition is None:
+                lines += [f'                {line}' for line in action]
+            elif previous is not None and condition == previous.replace(' == ', ' != ', 1):
+                lines += ['                else:',
+                          *[f'                    {line}' for line in action]]
+            else:
+                lines += [f'                if {condition}:',
+                          *[f'                    {line}' for line in action]]
+            previous = condition
+        lines += [*results,
+                  '        except (KeyError, TypeError, AttributeError):',
+                  *general_case]
+    else:
+        lines += [line[4:] for line in results]
+    return lines + [f'    elif {elements}.__class__ is dict:',
+                    *dict_lines,
+                    '    else:',
+                    *defaults]
+
+
+def preferred_name_lines(target):
+    """Return the source code lines replacing a value by its preferred
+    name, following the nested dicts inline and leaving the lists and
+    the other values to preferred_name.
+
+    :param target: str.
+    :return: list of str.
     """
-    if 'financial_year' in item.keys():
-        return item['financial_year']
-    return ''
-
-
-def fetch_related_records(item):
-    """Retrieve the associated Web of Science records list, if present in the grant record.
-
-    :param item: dict.
-    :return: str, int.
+    return [f'    while {target}.__class__ is dict:',
+            f'        for key in {target}:',
+            '            break',
+            '        else:',
+            f"            {target} = ''",
+            '            break',
+            "        if key == 'pref':",
+            f"            {target} = {target}.get('content', '') if {target}[key] == 'Y' "
+            "else ''",
+            '            break',
+            f'        {target} = {target}[key]',
+            '    else:',
+            f'        {target} = preferred_name({target})']
+
+
+def compile_extractor(fields=GRANT_FIELDS, parts=RECORD_PARTS):
+    """Compile the field specifications into the source code of a
+    function extracting all the fields of a record in a single pass,
+    and return that function. Each record part is only looked up once,
+    and the fields read from the same list of elements share a single
+    loop over it.
+
+    :param fields: list of dict.
+    :param parts: dict.
+    :return: function.
     """
-    if 'related_records' in item.keys():
-        if isinstance(item['related_records']['record'], list):
-            records_list = [r['uid'] for r in item['related_records']['record']]
-            return ', '.join(records_list), len(records_list)
-        return item['related_records']['record']['uid'], 1
-    return '', 0
+    lines = ['def extract_grant_fields(rec):']
+    part_variables = {None: 'rec'}
+    for name, (parent, path) in parts.items():
+        part_variables[name] = f'part_{name}'
+        lines += path_lookup(part_variables[name], part_variables[parent], path, 'None')
+
+    element_groups = {}
+    columns = []
+    for i, field in enumerate(fields):
+        value = f'value_{i}'
+        columns.append(f'{field["column"]!r}: {value}')
+        part = part_variables[field['part']]
+        if field.get('join') == 'preferred':
+            lines += path_lookup(value, part, field['path'], 'None')
+            lines += preferred_name_lines(value)
+        elif field.get('many'):
+            element_groups.setdefault((part, field['path']), []).append((value, field))
+        else:
+            lines += path_lookup(value, part, field['path'], "''")
+    for i, ((part, path), members) in enumerate(element_groups.items()):
+        lines += path_lookup(f'elements_{i}', part, path, 'None')
+        lines += element_group_lines(f'elements_{i}', members)
+    lines.append(f'    return {{{", ".join(columns)}}}')
 
+    namespace = {'preferred_name': preferred_name, 'select_values': select_values}
+    exec('\n'.join(lines), namespace)  # pylint: disable=exec-used
+    return namespace['extract_grant_fields']
 
-def fetch_document_title(item):
-    """Retrieve the grant title.
 
-    :param item: dict.
-    :return: str.
-    """
-    if isinstance(item['title'], list):
-        for title in item['title']:
-            if title['type'] == 'item':
-                return title['content']
-    return item['title']['content']
+extract_grant_fields = compile_extractor()
 
 
-def fetch_keywords(item):
-    """Retrieve grant keywords.
+def parse_amounts(amounts):
+    """Convert grant amounts into an array of floats, with NaN for the
+    missing ones.
 
-    :param item: dict.
-    :return: str.
+    :param amounts: sequence of float, str or None.
+    :return: numpy array of float.
     """
-    keywords_list = []
-    if 'keywords' in item:
-        if isinstance(item['keywords']['keyword'], list):
-            for keyword in item['keywords']['keyword']:
-                if 'content' in keyword.keys():
-                    keywords_list.append(str(keyword['content']))
-            return ', '.join(keywords_list)
-        if 'content' in item['keywords']['keyword'].keys():
-            return item['keywords']['keyword']['content']
-    return ''
-
-
-def fetch_abstract(item):
-    """Retrieve grant description.
-
-    :param item: dict.
-    :return: str.
+    amounts = [np.nan if amount == '' or amount is None else amount for amount in amounts]
+    try:
+        return np.array(amounts, dtype=float)
+    except (TypeError, ValueError):
+        return pd.to_numeric(pd.Series(amounts, dtype=object), errors='coerce').to_numpy(dtype=float)
+
+
+def convert_to_usd(amounts, currencies, rates, years=None, yearly_rates=None):
+    """Convert grant amounts into USD in one vectorized pass: the rate
+    of each distinct currency (and year, with yearly rates) is looked up
+    once, and joined to the amounts through the currency codes. The
+    amounts of the years without rates of their own, or whose rates miss
+    their currency, are converted at the current rates.
+
+    :param amounts: numpy array of float.
+    :param currencies: sequence of str.
+    :param rates: dict.
+    :param years: sequence of int or None, the publication years.
+    :param yearly_rates: dict of int to dict, or None.
+    :return: numpy array of float, NaN where the amount or the rate is
+        missing.
     """
-    if isinstance(item['abstracts'], list):
-        return [', '.join(a['abstract_text']['p']) for a in item['abstracts']['abstract']]
-    if 'abstract' in item['abstracts'].keys():
-        return item['abstracts']['abstract']['abstract_text']['p']
-    return ''
+    keys = zip(years, currencies) if yearly_rates else zip(repeat(None), currencies)
+    codes = {}
+    currency_codes = np.fromiter((codes.setdefault(key, len(codes)) for key in keys),
+                                 dtype=np.intp, count=len(amounts))
+    currency_rates = np.array([
+        1.0 if currency == 'USD' else
+        (yearly_rates or {}).get(year_number(year), rates).get(currency,
+                                                               rates.get(currency, np.nan))
+        for year, currency in codes
+    ], dtype=float)
+    return amounts / currency_rates[currency_codes]
+
+
+def year_number(year):
+    """Return a publication year as an int, or None if it is missing.
+
+    :param year: int, str or None.
+    :return: int or None.
+    """
+    try:
+        return int(year)
+    except (TypeError, ValueError):
+        return None
 
 
-def convert_to_usd(amount, currency, rates):
-    """Converts grant amount into USD.
+def fetch_data(rec, rates):
+    """Take JSON retrieved by the API, return the grant fields of the
+    record with the grant amount converted into USD. Parsing the records
+    in batches with fetch_data_batch is faster.
 
-    :param amount: int or float.
-    :param currency: str.
+    :param rec: dict.
     :param rates: dict.
-    :return: str or float.
+    :return: dict.
     """
-    if amount != '':
-        if currency == 'USD':
-            return amount
-        if currency in rates.keys():
-            return amount / rates[f'{currency}']
-    return ''
+    return fetch_data_batch([rec], rates)[0]
 
 
-def fetch_data(rec, rates):
-    """Take JSON retrieved by the API, append each record to a grants_list list.
+def fetch_data_batch(recs, rates, yearly_rates=None):
+    """Parse a batch of raw records, converting the grant amounts of the
+    whole batch into USD at once, at the rates of their publication
+    years if yearly rates are given. Missing amounts are None. This is
+    the unit of work sent to the parsing processes.
 
-    :param rec: dict.
+    :param recs: list of dict.
     :param rates: dict.
-    :return: dict.
+    :param yearly_rates: dict of int to dict, or None.
+    :return: list of dict.
     """
-    ut = rec['UID']
-    print(ut)
-    principal_investigator, other_names = fetch_names(rec['static_data']['summary']['names'])
-    doctitle = fetch_document_title(rec['static_data']['summary']['titles'])
-    related_wos_records, related_wos_records_count = fetch_related_records(rec['static_data']
-                                                                           ['fullrecord_metadata'])
-    grant = rec['static_data']['fullrecord_metadata']['fund_ack']['grants']['grant']
-    grant_source = grant['grant_source']
-    grant_data_item = grant['grant_data']['grantDataItem']
-    grant_pi_institution = fetch_pi_institution(grant_data_item['principalInvestigators'])
-    grant_amount = grant_data_item['totalAwardAmount']
-    grant_currency = grant_data_item['currency']
-    grant_amount_in_usd = convert_to_usd(grant_amount, grant_currency, rates)
-
-    return {
-        'UT': ut,
-        'Publication Year': rec['static_data']['summary']['pub_info']['pubyear'],
-        'Financial Year': fetch_fin_year(rec['static_data']['item']),
-        'Principal Investigator': principal_investigator,
-        'Other Names': other_names,
-        'Document Type': rec['static_data']['summary']['doctypes']['doctype'],
-        'Document Title': str(doctitle),
-        'Keywords': fetch_keywords(rec['static_data']['fullrecord_metadata']),
-        'Grant Description': fetch_abstract(rec['static_data']['fullrecord_metadata']),
-        'Related WoS Records': related_wos_records,
-        'Related WoS Records Count': related_wos_records_count,
-        'Funding Agency': fetch_grant_agency(grant),
-        'Funding Country': fetch_grant_country(rec['static_data']['item']),
-        'Grant Source': grant_source,
-        'Principal Investigator Institution': grant_pi_institution,
-        'Grant Amount': grant_amount,
-        'Currency': grant_currency,
-        'Grant Amount, USD': grant_amount_in_usd
-    }
+    grants = [extract_grant_fields(rec) for rec in recs]
+    amounts = parse_amounts([grant['Grant Amount'] for grant in grants])
+    amounts_usd = convert_to_usd(amounts, [grant['Currency'] for grant in grants], rates,
+                                 [grant['Publication Year'] for grant in grants], yearly_rates)
+    for grant, amount, amount_usd in zip(grants, amounts.tolist(), amounts_usd.tolist()):
+        grant['Grant Amount'] = None if amount != amount else amount
+        grant['Grant Amount, USD'] = None if amount_usd != amount_usd else amount_usd
+    return grants
+
+
+def grants_frame(grants):
+    """Build a dataframe of parsed grants records with compact column
+    types: categoricals for the columns with few distinct values, and
+    nullable integers and floats for the numbers.
+
+    :param grants: list of dict.
+    :return: pandas dataframe.
+    """
+    df = pd.DataFrame(grants)
+    for column in CATEGORICAL_COLUMNS:
+        df[column] = df[column].astype('category')
+    for column in INTEGER_COLUMNS:
+        df[column] = pd.to_numeric(df[column], errors='coerce').astype('Int64')
+    for column in FLOAT_COLUMNS:
+        df[column] = pd.to_numeric(df[column], errors='coerce').astype('Float64')
+    return df
+
+
+def get_parse_executor():
+    """Return the process pool for parsing the records, starting it on
+    first use. The pool is kept for the lifetime of the app, so that
+    the worker processes are only started once.
+
+    :return: concurrent.futures.ProcessPoolExecutor.
+    """
+    global parse_executor
+    if parse_executor is None:
+        parse_executor = ProcessPoolExecutor(
+            max_workers=PARSE_WORKERS,
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return parse_executor
+
@@ -0,0 +1,202 @@
+"""
+Provide the exchange rates for converting the grant amounts into USD:
+the rates are kept in memory for the lifetime of the app, refreshed
+from the exchange rates API in the background once they are out of
+date, and saved as a dated history of rates files, so that the grants
+can be converted at the rates of their publication years. The rates
+file shipped with the app is the fallback when the API can't be
+reached.
+"""
+
+import csv
+from datetime import date, datetime, timedelta
+import os
+import tempfile
+import threading
+import time
+import requests
+from api_operations import retrieve_rates_via_api
+from metrics import metrics
+
+RATES_HISTORY_DIR = 'cache/rates'
+FALLBACK_RATES_FILE = 'currencies.csv'
+RATES_MAX_AGE = timedelta(days=1)
+# The seconds to wait before retrying a failed refresh, i.e. offline.
+RATES_RETRY_INTERVAL = 600
+RATES_DATE_FORMAT = '%m/%d/%Y'
+
+
+def read_rates_file(path):
+    """Read a rates file: the date of the rates on the first line, then
+    a table of the rates of the currencies against USD.
+
+    :param path: str.
+    :return: tuple of (date, dict).
+    """
+    with open(path, 'r', encoding='utf-8', newline='') as reading:
+        rows = csv.reader(reading)
+        updated = datetime.strptime(next(rows)[1], RATES_DATE_FORMAT).date()
+        rates = {}
+        for row in rows:
+            if len(row) != 2 or row[0] == 'Currency':
+                continue
+            rates[row[0]] = float(row[1])
+    return updated, rates
+
+
+def write_rates_file(path, updated, rates):
+    """Write a rates file atomically: the rates are written to a
+    temporary file in the same directory, which then replaces the
+    file, so that a reader never sees a partly written file, and
+    concurrent writers can't interleave their lines.
+
+    :param path: str.
+    :param updated: date.
+    :param rates: dict.
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    descriptor, temporary_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'w', encoding='utf-8', newline='') as writing:
+            rows = csv.writer(writing, lineterminator='\n')
+            rows.writerow(['Updated', updated.strftime(RATES_DATE_FORMAT)])
+            rows.writerow([])
+            rows.writerow(['Currency', 'Rate VS USD'])
+            rows.writerows(rates.items())
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+class RateProvider:
+    """Keep the exchange rates in memory, with their dated history.
+
+    The rates are loaded from the most recent file of the history, or
+    from the fallback file, on first use. Rates older than the maximum
+    age are still returned right away, while a background thread
+    retrieves the current ones from the API and adds them to the
+    history. Only when no rates are available at all does the caller
+    wait for the API.
+    """
+
+    def __init__(self, history_dir=RATES_HISTORY_DIR, fallback_path=FALLBACK_RATES_FILE,
+                 max_age=RATES_MAX_AGE, retry_interval=RATES_RETRY_INTERVAL, client=None):
+        self.history_dir = history_dir
+        self.fallback_path = fallback_path
+        self.max_age = max_age
+        self.retry_interval = retry_interval
+        self.client = client
+        self.history = None
+        self.rates = None
+        self.updated = None
+        self.refreshing = None
+        self.attempted = None
+        self.lock = threading.Lock()
+
+    def history_path(self, updated):
+        """Return the path of the history file of the rates of a date.
+
+        :param updated: date.
+        :return: str.
+        """
+        return os.path.join(self.history_dir, f'{updated.isoformat()}.csv')
+
+    def load(self):
+        """Load the history of the rates, and the most recent rates of
+        the history or of the fallback file. Unreadable files are
+        skipped. The caller must hold the lock.
+        """
+        self.history = {}
+        if os.path.isdir(self.history_dir):
+            for filename in os.listdir(self.history_dir):
+                if not filename.endswith('.csv'):
+                    continue
+                try:
+                    updated, rates = read_rates_file(os.path.join(self.history_dir, filename))
+                except (OSError, ValueError, IndexError, StopIteration):
+                    continue
+                self.history[updated] = rates
+        try:
+            updated, rates = read_rates_file(self.fallback_path)
+            self.history.setdefault(updated, rates)
+        except (OSError, ValueError, IndexError, StopIteration):
+            pass
+        if self.history:
+            self.updated = max(self.history)
+            self.rates = self.history[self.updated]
+
+    def get_rates(self):
+        """Return the current exchange rates, starting a background
+        refresh if they are out of date.
+
+        :return: dict.
+        """
+        with self.lock:
+            if self.history is None:
+                self.load()
+            rates, updated = self.rates, self.updated
+        if rates is None:
+            if not self.refresh():
+                raise RuntimeError('No exchange rates available: the exchange rates API '
+                                   f'can\'t be reached and {self.fallback_path} is missing.')
+            return self.rates
+        if date.today() - updated >= self.max_age:
+            self.refresh_in_background()
+        return rates
+
+    def yearly_rates(self):
+        """Return the rates of each year of the history: the most
+        recent rates dated in the year. The grants of the years before
+        the history starts are converted at the current rates.
+
+        :return: dict of int to dict.
+        """
+        with self.lock:
+            if self.history is None:
+                self.load()
+            return {updated.year: rates for updated, rates in sorted(self.history.items())}
+
+    def refresh(self):
+        """Retrieve the current rates from the API, save them to the
+        history, and make them the rates in memory. The rates in memory
+        are kept if the API can't be reached.
+
+        :return: bool, whether the rates were refreshed.
+        """
+        try:
+            rates = retrieve_rates_via_api(self.client)
+        except (requests.RequestException, KeyError, ValueError):
+            metrics.increment('rates.refresh_failures')
+            return False
+        metrics.increment('rates.refreshes')
+        updated = date.today()
+        try:
+            write_rates_file(self.history_path(updated), updated, rates)
+        except OSError:
+            pass
+        with self.lock:
+            if self.history is None:
+                self.load()
+            self.history[updated] = rates
+            if self.updated is None or updated >= self.updated:
+                self.updated = updated
+                self.rates = rates
+        return True
+
+    def refresh_in_background(self):
+        """Start refreshing the rates in a background thread, unless a
+        refresh is already running or the last one was attempted less
+        than the retry interval ago.
+        """
+        with self.lock:
+            if self.refreshing is not None and self.refreshing.is_alive():
+                return
+            if (self.attempted is not None
+                    and time.monotonic() - self.attempted < self.retry_interval):
+                return
+            self.attempted = time.monotonic()
+            self.refreshing = threading.Thread(target=self.refresh, name='rates-refresh',
+                                               daemon=True)
+            self.refreshing.start()
@@ -0,0 +1,433 @@
+"""
+Keep the grants records of all the harvests in a local SQLite database
+keyed by UT, so that the grants shared by overlapping search queries
+are stored once, and the visualizations can be built from SQL
+aggregates over any set of past queries. The grant descriptions and
+the related records are kept out of line, in tables of their own, so
+that the aggregates only scan the short columns. The funding agencies
+of each grant are also kept as edges, for the link graph.
+"""
+
+from datetime import date
+from itertools import repeat
+import os
+import sqlite3
+import threading
+import pyarrow as pa
+from aggregates import CUBE_DIMENSIONS, TOP_GRANTS_BY_RELATED_RECORDS, GrantsAggregates
+from link_graph import LinkGraph
+from pipeline import CHUNK_SIZE
+from query_cache import normalize_query
+from sharding import year_range_query
+from storage import ANALYTICAL_SCHEMA, RELATED_RECORDS_SEPARATOR, funder_edges, \
+    related_record_edges
+
+GRANTS_DB = 'cache/grants.sqlite3'
+# The columns the grants are most often sliced by.
+INDEXED_COLUMNS = {
+    'grants_year': ('Publication Year',),
+    'grants_funder': ('Funding Agency', 'Funding Country'),
+    'grants_country': ('Funding Country',),
+    'grants_institution': ('Principal Investigator Institution',)
+}
+# The most host parameters SQLite accepts in a statement by default.
+SQL_VARIABLES = 999
+
+
+def delta_query(query, since_year):
+    """Narrow a search query down to the grants published since a
+    year, i.e. the most recent publication year of its last harvest,
+    which may have received new grants since.
+
+    :param query: str.
+    :param since_year: int.
+    :return: str.
+    """
+    return year_range_query(query, since_year, max(since_year, date.today().year))
+
+
+def quoted(column):
+    """Return a grants data column name as an SQL identifier.
+
+    :param column: str.
+    :return: str.
+    """
+    return '"' + column.replace('"', '""') + '"'
+
+
+def sql_type(field):
+    """Return the SQLite type of a grants schema field.
+
+    :param field: pyarrow.Field.
+    :return: str.
+    """
+    if pa.types.is_integer(field.type):
+        return 'INTEGER'
+    if pa.types.is_floating(field.type):
+        return 'REAL'
+    return 'TEXT'
+
+
+def sql_values(column):
+    """Convert a dataframe column into a list of values SQLite can
+    store, with None for the missing values.
+
+    :param column: pandas series.
+    :return: list.
+    """
+    values = column.astype(object)
+    return values.where(column.notna(), None).tolist()
+
+
+class GrantsStore:
+    """The grants table, with a row per UT and indexes on the columns
+    the grants are sliced by, and the table of the UTs each search
+    query has returned.
+    """
+
+    def __init__(self, path=GRANTS_DB):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.columns = ANALYTICAL_SCHEMA.names
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS grants ('
+                + ', '.join(f'{quoted(field.name)} {sql_type(field)}'
+                            for field in ANALYTICAL_SCHEMA)
+                + ', harvest_date TEXT, PRIMARY KEY ("UT"))'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS grant_descriptions ('
+                'ut TEXT PRIMARY KEY, description TEXT)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS related_records ('
+                'ut TEXT, position INTEGER, related_ut TEXT, PRIMARY KEY (ut, position)) '
+                'WITHOUT ROWID'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS grant_funders ('
+                'ut TEXT, position INTEGER, agency TEXT, PRIMARY KEY (ut, position)) '
+                'WITHOUT ROWID'
+            )
+            for name, columns in INDEXED_COLUMNS.items():
+                self.connection.execute(
+                    f'CREATE INDEX IF NOT EXISTS {name} ON grants '
+                    f'({", ".join(quoted(column) for column in columns)})'
+                )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS query_grants ('
+                'query TEXT, ut TEXT, PRIMARY KEY (query, ut)) WITHOUT ROWID'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS harvests ('
+                'query TEXT PRIMARY KEY, harvest_date TEXT, max_year INTEGER, records INTEGER)'
+            )
+
+    def put_grants(self, query, chunk, replace=False):
+        """Store a chunk of grants records returned by a search query.
+        The grants already stored are skipped, or updated if replace is
+        True. The records without a UT can't be stored.
+
+        :param query: str.
+        :param chunk: pandas dataframe.
+        :param replace: bool.
+        :return: int, the number of grants added or updated.
+        """
+        harvest_date = date.today().isoformat()
+        rows = [row for row in zip(*(sql_values(chunk[column]) for column in self.columns),
+                                   repeat(harvest_date))
+                if row[0] is not None]
+        uts = [row[0] for row in rows]
+        descriptions = [(ut, description) for ut, description
+                        in zip(chunk['UT'].tolist(), sql_values(chunk['Grant Description']))
+                        if ut is not None and description]
+        edges = zip(*related_record_edges(chunk['UT'].tolist(),
+                                          sql_values(chunk['Related WoS Records'])))
+        funders = zip(*funder_edges(chunk['UT'].tolist(), chunk['Funding Agencies'].tolist()))
+        if replace:
+            conflict = 'DO UPDATE SET ' + ', '.join(
+                f'{quoted(column)} = excluded.{quoted(column)}'
+                for column in self.columns[1:] + ['harvest_date'])
+        else:
+            conflict = 'DO NOTHING'
+        with self.lock, self.connection:
+            changes = self.connection.total_changes
+            self.connection.executemany(
+                f'INSERT INTO grants VALUES ({", ".join("?" * (len(self.columns) + 1))}) '
+                f'ON CONFLICT ("UT") {conflict}',
+                rows
+            )
+            stored = self.connection.total_changes - changes
+            if replace:
+                self.connection.executemany('DELETE FROM grant_descriptions WHERE ut = ?',
+                                            zip(uts))
+                self.connection.executemany('DELETE FROM related_records WHERE ut = ?',
+                                            zip(uts))
+                self.connection.executemany('DELETE FROM grant_funders WHERE ut = ?', zip(uts))
+            self.connection.executemany('INSERT OR IGNORE INTO grant_descriptions VALUES (?, ?)',
+                                        descriptions)
+            self.connection.executemany('INSERT OR IGNORE INTO related_records VALUES (?, ?, ?)',
+                                        edges)
+            self.connection.executemany('INSERT OR IGNORE INTO grant_funders VALUES (?, ?, ?)',
+                                        funders)
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO query_grants VALUES (?, ?)',
+                zip(repeat(normalize_query(query)), uts)
+            )
+        return stored
+
+    def select_by_uts(self, select, uts):
+        """Run a query over a list of UTs in batches of as many UTs as
+        SQLite accepts parameters, and return all the rows.
+
+        :param select: str, the query up to the IN operator of its UT
+            condition.
+        :param uts: list of str.
+        :return: list of tuple.
+        """
+        rows = []
+        with self.lock:
+            for start in range(0, len(uts), SQL_VARIABLES):
+                batch = uts[start:start + SQL_VARIABLES]
+                rows += self.connection.execute(
+                    f'{select} IN ({", ".join("?" * len(batch))})', batch
+                ).fetchall()
+        return rows
+
+    def descriptions(self, uts):
+        """Load the descriptions of the given grants.
+
+        :param uts: list of str.
+        :return: dict of str to str.
+        """
+        return dict(self.select_by_uts(
+            'SELECT ut, description FROM grant_descriptions WHERE ut', uts
+        ))
+
+    def related_records(self, uts):
+        """Load the related records of the given grants, in their
+        original order.
+
+        :param uts: list of str.
+        :return: dict of str to list of str.
+        """
+        related_records = {}
+        for ut, _, related_ut in sorted(self.select_by_uts(
+                'SELECT ut, position, related_ut FROM related_records WHERE ut', uts)):
+            related_records.setdefault(ut, []).append(related_ut)
+        return related_records
+
+    def funders(self, uts):
+        """Load the funding agencies of the given grants, in their
+        original order.
+
+        :param uts: list of str.
+        :return: dict of str to list of str.
+        """
+        funders = {}
+        for ut, _, agency in sorted(self.select_by_uts(
+                'SELECT ut, position, agency FROM grant_funders WHERE ut', uts)):
+            funders.setdefault(ut, []).append(agency)
+        return funders
+
+    def queries(self):
+        """Return the stored search queries with their numbers of
+        grants.
+
+        :return: dict of str to int.
+        """
+        with self.lock:
+            return dict(self.connection.execute(
+                'SELECT query, COUNT(*) FROM query_grants GROUP BY query ORDER BY query'
+            ))
+
+    def selection(self, queries=None):
+        """Return the SQL condition selecting the grants of the given
+        search queries, all the stored grants if queries is None, and
+        its parameters.
+
+        :param queries: list of str or None.
+        :return: tuple of (str, list).
+        """
+        if queries is None:
+            return '1', []
+        queries = [normalize_query(query) for query in queries]
+        return (f'"UT" IN (SELECT ut FROM query_grants '
+                f'WHERE query IN ({", ".join("?" * len(queries))}))', queries)
+
+    def aggregates(self, queries=None, top_grants=TOP_GRANTS_BY_RELATED_RECORDS):
+        """Build the aggregates of the visualizations with SQL over the
+        union of the grants of the given search queries, or of all the
+        stored grants.
+
+        :param queries: list of str or None.
+        :param top_grants: int.
+        :return: GrantsAggregates.
+        """
+        condition, parameters = self.selection(queries)
+        year, country, agency, institution = (quoted(column) for column in CUBE_DIMENSIONS)
+        with self.lock:
+            totals = self.connection.execute(
+                f'SELECT {year}, COALESCE({country}, \'\'), '
+                f'COALESCE(NULLIF({agency}, \'\'), \'(name unavailable)\'), '
+                f'COALESCE(NULLIF({institution}, \'\'), \'(name unavailable)\'), '
+                f'TOTAL("Grant Amount, USD"), COUNT(*) FROM grants WHERE {condition} '
+                f'GROUP BY 1, 2, 3, 4',
+                parameters
+            ).fetchall()
+            top = self.connection.execute(
+                f'SELECT "Related WoS Records Count", "UT", "Document Title" FROM grants '
+                f'WHERE {condition} AND "Related WoS Records Count" IS NOT NULL '
+                f'ORDER BY "Related WoS Records Count" DESC, rowid LIMIT ?',
+                parameters + [top_grants]
+            ).fetchall()
+        aggregates = GrantsAggregates(top_grants)
+        with aggregates.lock:
+            for year_value, country_value, agency_value, institution_value, amount, count in totals:
+                aggregates.add_totals(year_value, country_value, agency_value,
+                                      institution_value, amount, count)
+            for related_records_count, ut, title in top:
+                aggregates.add_top_grant(related_records_count, ut, title)
+            aggregates.records = sum(row[-1] for row in totals)
+        return aggregates
+
+    def link_graph(self, queries=None):
+        """Build the link graph of the given search queries' grants, or
+        of all the stored grants, from their funding agencies and their
+        related records.
+
+        :param queries: list of str or None.
+        :return: LinkGraph.
+        """
+        condition, parameters = self.selection(queries)
+        with self.lock:
+            grants = self.connection.execute(
+                f'SELECT "UT" FROM grants WHERE {condition} ORDER BY rowid', parameters
+            ).fetchall()
+            funders = self.connection.execute(
+                f'SELECT ut, agency FROM grant_funders WHERE {condition} ORDER BY ut, position',
+                parameters
+            ).fetchall()
+            edges = self.connection.execute(
+                f'SELECT ut, related_ut FROM related_records WHERE {condition}', parameters
+            ).fetchall()
+        return LinkGraph([row[0] for row in grants], [row[0] for row in funders],
+                         [row[1] for row in funders], [row[0] for row in edges],
+                         [row[1] for row in edges])
+
+    def version(self):
+        """Return a number that changes whenever grants are stored, to
+        tell if what was built from the store is still current.
+
+        :return: int.
+        """
+        with self.lock:
+            return self.connection.total_changes
+
+    def iterate_grants(self, queries=None, chunk_size=CHUNK_SIZE, texts=True):
+        """Yield the stored grants of the given search queries, or all
+        the stored grants, as grants records, reading them in chunks,
+        with the list of their funding agencies. With texts, the
+        descriptions and the related records of each chunk are put back
+        into the records.
+
+        :param queries: list of str or None.
+        :param chunk_size: int.
+        :param texts: bool.
+        :return: generator of dict.
+        """
+        condition, parameters = self.selection(queries)
+        last_rowid = 0
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    f'SELECT rowid, {", ".join(quoted(column) for column in self.columns)} '
+                    f'FROM grants WHERE {condition} AND rowid > ? ORDER BY rowid LIMIT ?',
+                    parameters + [last_rowid, chunk_size]
+                ).fetchall()
+            if not rows:
+                return
+            grants = [dict(zip(self.columns, row[1:])) for row in rows]
+            uts = [grant['UT'] for grant in grants]
+            funders = self.funders(uts)
+            for grant in grants:
+                grant['Funding Agencies'] = funders.get(grant['UT'], [])
+            if texts:
+                descriptions = self.descriptions(uts)
+                related_records = self.related_records(uts)
+                for grant in grants:
+                    grant['Grant Description'] = descriptions.get(grant['UT'], '')
+                    grant['Related WoS Records'] = RELATED_RECORDS_SEPARATOR.join(
+                        related_records.get(grant['UT'], ()))
+            yield from grants
+            last_rowid = rows[-1][0]
+
+    def finish_harvest(self, query):
+        """Record the date of a completed harvest of a search query,
+        with the number of its stored grants and their most recent
+        publication year.
+
+        :param query: str.
+        """
+        query = normalize_query(query)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO harvests '
+                'SELECT ?, ?, MAX("Publication Year"), COUNT(*) FROM grants '
+                'WHERE "UT" IN (SELECT ut FROM query_grants WHERE query = ?)',
+                (query, date.today().isoformat(), query)
+            )
+
+    def get_harvest(self, query):
+        """Return the date, the most recent publication year and the
+        number of grants of the last harvest of a search query, if any.
+
+        :param query: str.
+        :return: dict or None.
+        """
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT harvest_date, max_year, records FROM harvests WHERE query = ?',
+                (normalize_query(query),)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'harvest_date': date.fromisoformat(row[0]), 'max_year': row[1],
+                'records': row[2]}
+
+    def sink(self, query, replace=False):
+        """Return a pipeline sink storing the grants of a search query.
+
+        :param query: str.
+        :param replace: bool.
+        :return: GrantsStoreSink.
+        """
+        return GrantsStoreSink(self, query, replace)
+
+
+class GrantsStoreSink:
+    """Write the grants records of a search query into the store chunk
+    by chunk, counting the grants that were added.
+    """
+
+    def __init__(self, store, query, replace=False):
+        self.store = store
+        self.query = query
+        self.replace = replace
+        self.stored = 0
+
+    def write(self, chunk):
+        """Store a chunk of grants records.
+
+        :param chunk: pandas dataframe.
+        """
+        self.stored += self.store.put_grants(self.query, chunk, self.replace)
+
+    def close(self):
+        """Nothing to release, the chunks are committed as they are
+        written.
+        """
@@ -0,0 +1,259 @@
+"""
+Harvest the grants data of search queries: retrieve the API pages,
+parse the records, and save the data file, the aggregate cube and the
+stored grants, with the stores shared by all the harvests of the
+process. Used by the Flask app and by the batch command line runner.
+"""
+
+from contextlib import contextmanager
+from datetime import date
+import os
+import shutil
+import time
+from aggregates import GrantsAggregates, cube_path
+from grants_store import delta_query
+from metrics import log_event, metrics, profiled
+from pipeline import iterate_grants, stream_to_sinks
+from sharding import iterate_query_pages
+from storage import ANALYTICAL_SCHEMA, FundersSink, ParquetSink, TextsSink, \
+    descriptions_path, funders_path, related_records_path
+
+DOWNLOADS_DIR = 'downloads'
+
+
+def data_filename(search_query):
+    """Return the name of the data file of a search query run today.
+
+    :param search_query: str.
+    :return: str.
+    """
+    safe_filename = search_query.replace('*', '').replace('"', '')
+    return f'{safe_filename} - {date.today()}.parquet'
+
+
+class Harvester:
+    """Run the harvests of search queries against shared stores: the
+    checkpoints of the retrieved pages, the query cache, the exchange
+    rates and the grants store. With a rate limiter, the API requests
+    of all the harvests share its request rate budget. With a profile
+    directory, each harvest is profiled with cProfile. With
+    texts_out_of_line, the data files only hold the analytical columns,
+    and the grant descriptions and related records are saved in side
+    files next to them. The funding agencies of the grants are always
+    saved as edges in a side file. With parallel_parse, the raw API pages
+    are decoded and parsed in a pool of processes. With stream_records,
+    the records of the API pages are decoded as the responses stream in,
+    unless they are decoded by the parsing processes.
+    """
+
+    def __init__(self, checkpoints, query_cache, rate_provider, grants_store,
+                 downloads_dir=DOWNLOADS_DIR, rate_limiter=None, profile_dir=None,
+                 texts_out_of_line=False, parallel_parse=False, stream_records=False):
+        self.checkpoints = checkpoints
+        self.query_cache = query_cache
+        self.rate_provider = rate_provider
+        self.grants_store = grants_store
+        self.downloads_dir = downloads_dir
+        self.rate_limiter = rate_limiter
+        self.profile_dir = profile_dir
+        self.texts_out_of_line = texts_out_of_line
+        self.parallel_parse = parallel_parse
+        self.stream_records = stream_records
+        os.makedirs(downloads_dir, exist_ok=True)
+
+    def data_path(self, filename):
+        """Return the path of a data file in the downloads directory.
+
+        :param filename: str.
+        :return: str.
+        """
+        return os.path.join(self.downloads_dir, filename)
+
+    def data_files(self, filename):
+        """Return the paths of the files a data file is saved as, by
+        query cache entry kind.
+
+        :param filename: str.
+        :return: dict of str to str.
+        """
+        path = self.data_path(filename)
+        if self.texts_out_of_line:
+            return {'analytical_table': path, 'descriptions': descriptions_path(path),
+                    'related_records': related_records_path(path),
+                    'funders': funders_path(path)}
+        return {'table': path, 'funders': funders_path(path)}
+
+    def data_sinks(self, filename):
+        """Return the pipeline sinks writing a data file.
+
+        :param filename: str.
+        :return: list.
+        """
+        path = self.data_path(filename)
+        if self.texts_out_of_line:
+            return [ParquetSink(path, schema=ANALYTICAL_SCHEMA), TextsSink(path),
+                    FundersSink(path)]
+        return [ParquetSink(path), FundersSink(path)]
+
+    def query_pages(self, apikey, search_query, job=None):
+        """Return the API pages of a search query, sharded if needed.
+
+        :param apikey: str.
+        :param search_query: str.
+        :param job: Job or None, to report the progress to.
+        :return: generator of dict, and of bytes with parallel_parse.
+        """
+        return iterate_query_pages(apikey, search_query, query_cache=self.query_cache,
+                                   checkpoints=self.checkpoints,
+                                   progress=job.pages_progress if job is not None else None,
+                                   rate_limiter=self.rate_limiter, raw=self.parallel_parse,
+                                   stream=self.stream_records)
+
+    @contextmanager
+    def instrumented(self, mode, search_query):
+        """Time a harvest, profile it if there is a profile directory,
+        and log its outcome as a structured event. The summary yielded
+        can be completed by the harvest.
+
+        :param mode: str, run or refresh.
+        :param search_query: str.
+        """
+        summary = {'mode': mode, 'query': search_query}
+        start = time.perf_counter()
+        with profiled(self.profile_dir, f'{mode} {search_query}'):
+            try:
+                yield summary
+            except Exception as error:
+                summary['error'] = f'{type(error).__name__}: {error}'
+                raise
+            finally:
+                summary['seconds'] = round(time.perf_counter() - start, 3)
+                metrics.observe(f'harvest.{mode}', summary['seconds'])
+                log_event('harvest', **summary)
+
+    def run(self, apikey, search_query, job=None):
+        """Harvest all the grants of a search query, see run_harvest.
+
+        :param apikey: str.
+        :param search_query: str.
+        :param job: Job or None, to report the progress to.
+        :return: tuple of (str, GrantsAggregates).
+        """
+        with self.instrumented('run', search_query) as summary:
+            filename, aggregates = self.run_harvest(apikey, search_query, job, summary)
+            summary['records'] = aggregates.records
+            return filename, aggregates
+
+    def refresh(self, apikey, search_query, job=None):
+        """Harvest the new grants of a search query, see
+        refresh_harvest.
+
+        :param apikey: str.
+        :param search_query: str.
+        :param job: Job or None, to report the progress to.
+        :return: tuple of (str, GrantsAggregates).
+        """
+        with self.instrumented('refresh', search_query) as summary:
+            filename, aggregates = self.refresh_harvest(apikey, search_query, job, summary)
+            summary['records'] = aggregates.records
+            return filename, aggregates
+
+    def run_harvest(self, apikey, search_query, job=None, summary=None):
+        """Harvest all the grants of a search query into its data file,
+        the aggregate cube and the grants store. The results of a query
+        that was run recently are served from the query cache.
+
+        :param apikey: str.
+        :param search_query: str.
+        :param job: Job or None, to report the progress to.
+        :param summary: dict or None, the summary of the harvest.
+        :return: tuple of (str, GrantsAggregates), the data file name
+            and the aggregates.
+        """
+        summary = summary if summary is not None else {}
+        filename = data_filename(search_query)
+        path = self.data_path(filename)
+        files = self.data_files(filename)
+        cached_files = {kind: self.query_cache.get_file(search_query, kind, 'parquet')
+                        for kind in files}
+        aggregates = self.query_cache.get_value(search_query, 'aggregates')
+        summary['cache_hit'] = None not in cached_files.values() and aggregates is not None
+        if summary['cache_hit']:
+            metrics.increment('harvest.cache_hits')
+            if not os.path.exists(path):
+                for kind, file_path in files.items():
+                    shutil.copyfile(cached_files[kind], file_path)
+                aggregates.save(cube_path(path))
+            return filename, aggregates
+
+        aggregates = GrantsAggregates()
+        if job is not None:
+            job.aggregates = aggregates
+        grants = iterate_grants(self.query_pages(apikey, search_query, job),
+                                self.rate_provider.get_rates(), self.parallel_parse,
+                                progress=job.records_progress if job is not None else None,
+                                on_batch=aggregates.write_records,
+                                yearly_rates=self.rate_provider.yearly_rates(), unique=True)
+        records_count = stream_to_sinks(grants, self.data_sinks(filename)
+                                        + [self.grants_store.sink(search_query)])
+        self.grants_store.finish_harvest(search_query)
+        self.save_result(search_query, filename, records_count, aggregates)
+        return filename, aggregates
+
+    def refresh_harvest(self, apikey, search_query, job=None, summary=None):
+        """Only retrieve the grants published since the most recent
+        publication year of the last harvest of the search query, merge
+        them by UT into its stored grants, and rebuild its data file
+        and aggregates from the grants store. A query that was never
+        harvested is run in full.
+
+        :param apikey: str.
+        :param search_query: str.
+        :param job: Job or None, to report the progress to.
+        :param summary: dict or None, the summary of the harvest.
+        :return: tuple of (str, GrantsAggregates), the data file name
+            and the aggregates.
+        """
+        harvest = self.grants_store.get_harvest(search_query)
+        if harvest is None or harvest['max_year'] is None:
+            return self.run_harvest(apikey, search_query, job, summary)
+        if summary is not None:
+            summary['since_year'] = harvest['max_year']
+
+        grants = iterate_grants(
+            self.query_pages(apikey, delta_query(search_query, harvest['max_year']), job),
+            self.rate_provider.get_rates(), self.parallel_parse,
+            progress=job.records_progress if job is not None else None,
+            yearly_rates=self.rate_provider.yearly_rates(), unique=True
+        )
+        store_sink = self.grants_store.sink(search_query, replace=True)
+        stream_to_sinks(grants, [store_sink])
+        self.grants_store.finish_harvest(search_query)
+        if summary is not None:
+            summary['records_updated'] = store_sink.stored
+
+        filename = data_filename(search_query)
+        records_count = stream_to_sinks(self.grants_store.iterate_grants([search_query]),
+                                        self.data_sinks(filename))
+        aggregates = self.grants_store.aggregates([search_query])
+        self.save_result(search_query, filename, records_count, aggregates)
+        return filename, aggregates
+
+    def save_result(self, search_query, filename, records_count, aggregates):
+        """Save the aggregate cube next to the data file of a search
+        query, and cache the number of records written, its aggregates
+        and its data file. The number of records written is cached apart
+        from the 'count' entry, the number of records the API finds,
+        since the records returned by several shards are only written
+        once.
+
+        :param search_query: str.
+        :param filename: str.
+        :param records_count: int.
+        :param aggregates: GrantsAggregates.
+        """
+        aggregates.save(cube_path(self.data_path(filename)))
+        self.query_cache.put_value(search_query, 'records_written', records_count)
+        self.query_cache.put_value(search_query, 'aggregates', aggregates)
+        for kind, path in self.data_files(filename).items():
+            self.query_cache.put_file(search_query, kind, path)
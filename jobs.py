@@ -0,0 +1,169 @@
+"""
+Run the search query harvests as background jobs, so that the browser
+requests return right away and several analysts can run their queries
+at the same time. The jobs report their progress while they run, and
+keep their result once they are done.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import uuid
+from query_cache import normalize_query
+
+# Each job mostly waits for the API or for the parsing processes, so a
+# small pool of threads is enough to run several harvests at once.
+JOB_WORKERS = 4
+# The finished jobs are kept for their results to be rendered.
+FINISHED_JOBS_KEPT = 50
+
+
+class Job:
+    """A search query harvest running in the background, with its
+    progress and, once it is done, its result or error.
+    """
+
+    def __init__(self, query):
+        self.id = uuid.uuid4().hex
+        self.query = query
+        self.status = 'queued'
+        self.pages_fetched = 0
+        self.pages_total = None
+        self.records_parsed = 0
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+        # The running aggregates of the harvest, for the chart previews.
+        self.aggregates = None
+        self.done = threading.Event()
+
+    def pages_progress(self, pages_fetched, pages_total):
+        """Record the number of API pages retrieved so far.
+
+        :param pages_fetched: int.
+        :param pages_total: int.
+        """
+        self.pages_fetched = pages_fetched
+        self.pages_total = pages_total
+
+    def records_progress(self, records_parsed):
+        """Record the number of records parsed so far.
+
+        :param records_parsed: int.
+        """
+        self.records_parsed = records_parsed
+
+    def eta(self):
+        """Estimate the number of seconds left before the job is done,
+        extrapolating from the share of the pages retrieved so far.
+
+        :return: float or None.
+        """
+        if self.status != 'running' or not self.pages_total or not self.pages_fetched:
+            return None
+        elapsed = time.time() - self.started
+        return elapsed * (self.pages_total - self.pages_fetched) / self.pages_fetched
+
+    def progress(self):
+        """Return the job status and progress.
+
+        :return: dict.
+        """
+        eta = self.eta()
+        return {
+            'id': self.id,
+            'query': self.query,
+            'status': self.status,
+            'pages_fetched': self.pages_fetched,
+            'pages_total': self.pages_total,
+            'records_parsed': self.records_parsed,
+            'eta_seconds': round(eta, 1) if eta is not None else None,
+            'error': self.error
+        }
+
+    def run(self, function, *args):
+        """Call the job function, passing the job itself as the last
+        argument so that the function can report its progress.
+
+        :param function: function.
+        """
+        self.status = 'running'
+        self.started = time.time()
+        try:
+            self.result = function(*args, self)
+            self.status = 'done'
+        except Exception as error:  # pylint: disable=broad-except
+            self.error = f'{type(error).__name__}: {error}'
+            self.status = 'failed'
+        finally:
+            self.finished = time.time()
+            self.aggregates = None
+            self.done.set()
+
+    def wait(self, timeout=None):
+        """Block until the job is done or has failed.
+
+        :param timeout: float or None, in seconds.
+        :return: bool, whether the job is finished.
+        """
+        return self.done.wait(timeout)
+
+
+class JobRegistry:
+    """Submit the jobs to a pool of worker threads, and keep them by id
+    so that their progress can be polled. A query that is already being
+    harvested is not submitted again: its running job is returned.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, finished_kept=FINISHED_JOBS_KEPT):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self.finished_kept = finished_kept
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, query, function, *args):
+        """Run function(*args, job) in the background for the search
+        query, unless the query is already being harvested.
+
+        :param query: str.
+        :param function: function.
+        :return: Job.
+        """
+        with self.lock:
+            for job in self.jobs.values():
+                if (job.status in ('queued', 'running')
+                        and normalize_query(job.query) == normalize_query(query)):
+                    return job
+            self.forget_finished()
+            job = Job(query)
+            self.jobs[job.id] = job
+        self.executor.submit(job.run, function, *args)
+        return job
+
+    def get(self, job_id):
+        """Return the job with the given id, or None.
+
+        :param job_id: str.
+        :return: Job or None.
+        """
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def status_counts(self):
+        """Return the number of the jobs kept by status.
+
+        :return: dict of str to int.
+        """
+        with self.lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {status: statuses.count(status) for status in sorted(set(statuses))}
+
+    def forget_finished(self):
+        """Drop the oldest finished jobs beyond the number of finished
+        jobs kept. The caller must hold the lock.
+        """
+        finished = sorted((job for job in self.jobs.values() if job.finished is not None),
+                          key=lambda job: job.finished)
+        for job in finished[:max(0, len(finished) - self.finished_kept)]:
+            del self.jobs[job.id]
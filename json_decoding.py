@@ -0,0 +1,177 @@
+"""
+Decode the JSON documents returned by the APIs with the fastest
+available library: orjson if it is installed, the standard library json
+module otherwise. The records of an API page can also be decoded from
+the response body as it streams in, one record at a time, with ijson if
+it is installed, or an incremental standard library decoder otherwise.
+"""
+
+import codecs
+import json
+import re
+from metrics import metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+JSON_BACKEND = 'orjson' if orjson is not None else 'json'
+STREAM_BACKEND = 'ijson' if ijson is not None else 'json'
+
+# The path to the list of records in a Web of Science Expanded API page.
+RECORDS_PATH = ('Data', 'Records', 'records', 'REC')
+STREAM_CHUNK_SIZE = 64 * 1024
+
+json_decoder = json.JSONDecoder()
+whitespace = re.compile(r'\s*')
+
+
+def loads(document):
+    """Decode a JSON document.
+
+    :param document: bytes or str.
+    :return: dict or list.
+    """
+    if orjson is not None:
+        return orjson.loads(document)
+    return json.loads(document)
+
+
+def dumps(value):
+    """Encode a value as a JSON document.
+
+    :param value: dict or list.
+    :return: bytes.
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def response_content(response):
+    """Return the body of an API response, counting its bytes.
+
+    :param response: requests.Response.
+    :return: bytes.
+    """
+    content = response.content
+    metrics.increment('api.bytes', len(content))
+    return content
+
+
+def response_chunks(response):
+    """Yield the chunks of the body of a streamed API response as they
+    arrive, counting their bytes.
+
+    :param response: requests.Response.
+    :return: generator of bytes.
+    """
+    for chunk in response.iter_content(STREAM_CHUNK_SIZE):
+        metrics.increment('api.bytes', len(chunk))
+        yield chunk
+
+
+def decode_response(response):
+    """Decode the JSON body of an API response.
+
+    :param response: requests.Response.
+    :return: dict or list.
+    """
+    content = response_content(response)
+    with metrics.timer('json.decode'):
+        return loads(content)
+
+
+def iterate_records(chunks, path=RECORDS_PATH):
+    """Yield the elements of the JSON list found at the path of keys of
+    a document, as the chunks of the document arrive, so that the full
+    document never has to be held in memory.
+
+    :param chunks: iterable of bytes.
+    :param path: tuple of str.
+    :return: generator of dict.
+    """
+    if ijson is not None:
+        return iterate_records_ijson(chunks, path)
+    return iterate_records_stdlib(chunks, path)
+
+
+def iterate_records_ijson(chunks, path=RECORDS_PATH):
+    """Yield the elements of the JSON list at the path of keys with the
+    ijson push parser.
+
+    :param chunks: iterable of bytes.
+    :param path: tuple of str.
+    :return: generator of dict.
+    """
+    events = ijson.sendable_list()
+    parser = ijson.items_coro(events, '.'.join(path) + '.item', use_float=True)
+    for chunk in chunks:
+        parser.send(chunk)
+        yield from events
+        del events[:]
+    parser.close()
+    yield from events
+
+
+def iterate_records_stdlib(chunks, path=RECORDS_PATH):
+    """Yield the elements of the JSON list at the path of keys with the
+    standard library decoder. The key preceding the list is looked up
+    in the raw text, and the elements are then decoded one by one as
+    soon as the buffer holds a complete one. The elements are expected
+    to be JSON objects, which can't be decoded from an incomplete text.
+
+    :param chunks: iterable of bytes.
+    :param path: tuple of str.
+    :return: generator of dict.
+    """
+    chunks = iter(chunks)
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    list_start = re.compile(r'"' + re.escape(path[-1]) + r'"\s*:\s*\[')
+    buffer = ''
+    position = None
+    exhausted = False
+
+    def read_more():
+        nonlocal buffer, exhausted
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            buffer += text_decoder.decode(b'', final=True)
+        else:
+            buffer += text_decoder.decode(chunk)
+
+    while position is None:
+        match = list_start.search(buffer)
+        if match is not None:
+            position = match.end()
+        elif exhausted:
+            return
+        else:
+            # Keep enough of the tail to match a key split over chunks.
+            buffer = buffer[-len(path[-1]) - 64:]
+            read_more()
+
+    while True:
+        position = whitespace.match(buffer, position).end()
+        if position < len(buffer) and buffer[position] == ',':
+            position = whitespace.match(buffer, position + 1).end()
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            element, end = json_decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if exhausted:
+                raise
+            buffer = buffer[position:]
+            position = 0
+            read_more()
+            continue
+        yield element
+        position = end
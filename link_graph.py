@@ -0,0 +1,334 @@
+"""
+Index the links between the grants and the Web of Science records they
+are related to as a graph of integer ids, in compressed sparse row
+arrays both ways, so that the grants can be ranked by their linked
+records and the funders whose grants share publications can be found
+without going over the grants records again.
+"""
+
+import heapq
+import os
+import numpy as np
+import pandas as pd
+from pyarrow import parquet as pq
+from storage import RELATED_RECORDS_SEPARATOR, funders_path, has_texts_out_of_line, \
+    load_funders, load_related_records
+
+TOP_LINKED_GRANTS = 50
+TOP_CO_FUNDERS = 20
+# The records linked to the grants of more funders than this, i.e. the
+# publications of large consortia, are left out of the co-funding pairs:
+# their pairs grow with the square of their funders and would outnumber
+# those of all the other records.
+MAX_RECORD_FUNDERS = 100
+# The number of pairs of funders expanded at a time when counting them,
+# to keep the intermediate arrays small.
+PAIRS_CHUNK_SIZE = 1 << 18
+
+
+def csr_arrays(rows, columns, rows_count):
+    """Build the compressed sparse row arrays of a list of edges: the
+    edges of row i are the columns indices[indptr[i]:indptr[i + 1]].
+
+    :param rows: numpy array of int.
+    :param columns: numpy array of int.
+    :param rows_count: int.
+    :return: tuple of (numpy array, numpy array), indptr and indices.
+    """
+    indptr = np.zeros(rows_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=rows_count), out=indptr[1:])
+    return indptr, columns[np.argsort(rows, kind='stable')].astype(np.int32)
+
+
+def expand_rows(indptr, indices, rows):
+    """Return the columns of each of the given rows of compressed sparse
+    row arrays, one after the other, and the position of the row each
+    column comes from.
+
+    :param indptr: numpy array of int.
+    :param indices: numpy array of int.
+    :param rows: numpy array of int.
+    :return: tuple of (numpy array, numpy array), the positions in rows
+        and the columns.
+    """
+    counts = np.diff(indptr)[rows]
+    positions = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return positions, indices[np.repeat(indptr[rows], counts) + offsets]
+
+
+def member_pairs(groups, members):
+    """Return all the pairs of members of the same group, from a list
+    of distinct (group, member) entries sorted by group then member, so
+    that the first member of each pair is the lower one.
+
+    :param groups: numpy array of int.
+    :param members: numpy array of int.
+    :return: tuple of three numpy arrays, the groups and the two
+        members of each pair.
+    """
+    entries = np.arange(len(groups))
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    ends = np.r_[starts[1:], len(groups)]
+    partners = np.repeat(ends, ends - starts) - entries - 1
+    first = np.repeat(entries, partners)
+    second = first + 1 + np.arange(len(first)) - np.repeat(np.cumsum(partners) - partners,
+                                                          partners)
+    return groups[first], members[first], members[second]
+
+
+def connected_labels(count, first, second):
+    """Label the connected components of a graph of count nodes given
+    as a list of edges, each node with the lowest node of its
+    component, by propagating the lowest labels along the edges.
+
+    :param count: int.
+    :param first: numpy array of int.
+    :param second: numpy array of int.
+    :return: numpy array of int.
+    """
+    labels = np.arange(count)
+    while True:
+        lowest = np.minimum(labels[first], labels[second])
+        updated = labels.copy()
+        np.minimum.at(updated, first, lowest)
+        np.minimum.at(updated, second, lowest)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+class LinkGraph:
+    """The bipartite graph of the grants and their related Web of
+    Science records, built from the UTs of the grants, from the grant UT
+    and the funding agency of each funder edge, and from the grant UT
+    and the record UT of each link. The grants get integer ids in the
+    order they are given, the records and the funders in the order they
+    are first seen, so that a grant has as many funder ids as funding
+    agencies. The funders and the links of each grant, and the grants of
+    each record, are stored as CSR arrays; the funders of each record,
+    and the number of records shared by each pair of funders, are
+    derived on first use.
+    """
+
+    def __init__(self, grant_uts, funder_grant_uts, funder_names, edge_grant_uts,
+                 edge_record_uts):
+        self.grant_uts = np.asarray(grant_uts, dtype=object)
+        grant_index = pd.Index(self.grant_uts)
+
+        funder_grants = grant_index.get_indexer(funder_grant_uts)
+        funder_codes, self.funders = pd.factorize(
+            pd.Series(funder_names, dtype=object).replace('', None))
+        self.funder_ids = {funder: i for i, funder in enumerate(self.funders)}
+        known = (funder_grants >= 0) & (funder_codes >= 0)
+        # The distinct funders of each grant, in the order they are given.
+        funder_keys = pd.unique(funder_grants[known].astype(np.int64) * len(self.funders)
+                                + funder_codes[known])
+        funder_grants, funder_codes = np.divmod(funder_keys, max(len(self.funders), 1))
+        self.funder_indptr, self.grant_funders = csr_arrays(funder_grants, funder_codes,
+                                                            len(self.grant_uts))
+
+        edge_grants = grant_index.get_indexer(edge_grant_uts)
+        record_codes, self.record_uts = pd.factorize(pd.Series(edge_record_uts, dtype=object))
+        known = (edge_grants >= 0) & (record_codes >= 0)
+        links = np.unique(edge_grants[known].astype(np.int64) * len(self.record_uts)
+                          + record_codes[known])
+        edge_grants, edge_records = np.divmod(links, max(len(self.record_uts), 1))
+        self.grant_indptr, self.grant_records = csr_arrays(edge_grants, edge_records,
+                                                           len(self.grant_uts))
+        self.record_indptr, self.record_grants = csr_arrays(edge_records, edge_grants,
+                                                            len(self.record_uts))
+        self.record_funders = None
+        self.pair_counts = None
+
+    @property
+    def links_count(self):
+        """:return: int."""
+        return len(self.grant_records)
+
+    def linked_records(self, ut):
+        """Return the records related to a grant.
+
+        :param ut: str.
+        :return: list of str.
+        """
+        grant = pd.Index(self.grant_uts).get_loc(ut)
+        records = self.grant_records[self.grant_indptr[grant]:self.grant_indptr[grant + 1]]
+        return self.record_uts[records].tolist()
+
+    def record_grants_of(self, record_ut):
+        """Return the grants a record is related to.
+
+        :param record_ut: str.
+        :return: list of str.
+        """
+        record = pd.Index(self.record_uts).get_loc(record_ut)
+        grants = self.record_grants[self.record_indptr[record]:self.record_indptr[record + 1]]
+        return self.grant_uts[grants].tolist()
+
+    def top_linked_grants(self, k=TOP_LINKED_GRANTS):
+        """Return the k grants with the most linked records, kept in a
+        bounded heap, with ties won by the earliest grants.
+
+        :param k: int.
+        :return: list of dict.
+        """
+        degrees = np.diff(self.grant_indptr)
+        top = heapq.nlargest(k, zip(degrees.tolist(), range(0, -len(degrees), -1)))
+        return [{'UT': self.grant_uts[-grant],
+                 'Funding Agencies': self.grant_funder_names(-grant),
+                 'Linked Records': degree}
+                for degree, grant in top]
+
+    def grant_funder_names(self, grant):
+        """Return the names of the funders of a grant id.
+
+        :param grant: int.
+        :return: list of str.
+        """
+        funders = self.grant_funders[self.funder_indptr[grant]:self.funder_indptr[grant + 1]]
+        return self.funders[funders].tolist()
+
+    def record_funder_pairs(self):
+        """Return the distinct (record, funder) pairs of the links,
+        sorted by record then funder, computed on first use.
+
+        :return: tuple of (numpy array, numpy array).
+        """
+        if self.record_funders is None:
+            edge_records = np.repeat(np.arange(len(self.record_uts)),
+                                     np.diff(self.record_indptr))
+            edges, edge_funders = expand_rows(self.funder_indptr, self.grant_funders,
+                                              self.record_grants)
+            keys = np.unique(edge_records[edges].astype(np.int64) * len(self.funders)
+                             + edge_funders)
+            self.record_funders = np.divmod(keys, max(len(self.funders), 1))
+        return self.record_funders
+
+    def co_funders(self, funder, k=TOP_CO_FUNDERS):
+        """Return the k funders sharing the most linked records with the
+        grants of a funder, with the number of records they share.
+
+        :param funder: str.
+        :param k: int.
+        :return: list of dict.
+        """
+        funder_id = self.funder_ids.get(funder)
+        if funder_id is None:
+            return []
+        records, funders = self.record_funder_pairs()
+        shared = np.zeros(len(self.record_uts), dtype=bool)
+        shared[records[funders == funder_id]] = True
+        others = funders[shared[records] & (funders != funder_id)]
+        counts = np.bincount(others, minlength=len(self.funders))
+        candidates = np.flatnonzero(counts)
+        top = heapq.nlargest(k, zip(counts[candidates].tolist(), (-candidates).tolist()))
+        return [{'Funding Agency': self.funders[-other], 'Shared Records': count}
+                for count, other in top]
+
+    def co_funding_pairs(self, min_shared=1):
+        """Count the linked records shared by each pair of funders,
+        computed on first use. The pairs of the funders of each record
+        are expanded a chunk of records at a time and counted chunk by
+        chunk, leaving out the records with more than MAX_RECORD_FUNDERS
+        funders.
+
+        :param min_shared: int.
+        :return: tuple of three numpy arrays, the two funder ids of each
+            pair and the number of records they share.
+        """
+        if self.pair_counts is None:
+            records, funders = self.record_funder_pairs()
+            starts = np.flatnonzero(np.r_[True, records[1:] != records[:-1]])
+            sizes = np.diff(np.r_[starts, len(records)])
+            kept = (sizes > 1) & (sizes <= MAX_RECORD_FUNDERS)
+            records, funders = records[np.repeat(kept, sizes)], funders[np.repeat(kept, sizes)]
+            ends = np.cumsum(sizes[kept])
+            pairs = np.cumsum(sizes[kept] * (sizes[kept] - 1) // 2)
+            pairs_count = pairs[-1] if len(pairs) else 0
+            cuts = np.searchsorted(pairs, np.arange(PAIRS_CHUNK_SIZE, pairs_count,
+                                                    PAIRS_CHUNK_SIZE))
+            bounds = np.unique(np.r_[0, ends[cuts], len(records)]).tolist()
+            keys, counts = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                _, first, second = member_pairs(records[start:end], funders[start:end])
+                chunk_keys, chunk_counts = np.unique(first * len(self.funders) + second,
+                                                     return_counts=True)
+                keys.append(chunk_keys)
+                counts.append(chunk_counts)
+            keys, positions = np.unique(np.concatenate(keys), return_inverse=True)
+            counts = np.bincount(positions, weights=np.concatenate(counts),
+                                 minlength=len(keys)).astype(np.int64)
+            first, second = np.divmod(keys, max(len(self.funders), 1))
+            self.pair_counts = first, second, counts
+        first, second, counts = self.pair_counts
+        kept = counts >= min_shared
+        return first[kept], second[kept], counts[kept]
+
+    def top_co_funding(self, k=TOP_CO_FUNDERS):
+        """Return the k pairs of funders sharing the most linked
+        records.
+
+        :param k: int.
+        :return: list of dict.
+        """
+        first, second, counts = self.co_funding_pairs()
+        top = heapq.nlargest(k, zip(counts.tolist(), (-first).tolist(), (-second).tolist()))
+        return [{'Funding Agencies': [self.funders[-a], self.funders[-b]], 'Shared Records': count}
+                for count, a, b in top]
+
+    def funder_clusters(self, min_shared=1):
+        """Group the funders into clusters linked by shared records: two
+        funders are in the same cluster if a chain of pairs of funders
+        sharing at least min_shared records each joins them. The
+        clusters of a single funder are left out, and so are the records
+        with more than MAX_RECORD_FUNDERS funders, as in the pairs.
+
+        :param min_shared: int.
+        :return: list of dict, the funders of each cluster and the
+            number of records shared within it, largest first.
+        """
+        first, second, _ = self.co_funding_pairs(min_shared)
+        labels = connected_labels(len(self.funders), first, second)
+        records, funders = self.record_funder_pairs()
+        kept = np.bincount(records, minlength=len(self.record_uts))[records] \
+            <= MAX_RECORD_FUNDERS
+        records, funders = records[kept], funders[kept]
+        # A record is shared within a cluster if two of its funders are
+        # in it, i.e. if its funders have that cluster label twice.
+        record_labels, funders_count = np.unique(records * len(self.funders) + labels[funders],
+                                                 return_counts=True)
+        shared_counts = np.bincount(record_labels[funders_count > 1] % max(len(self.funders), 1),
+                                    minlength=len(self.funders))
+        sizes = np.bincount(labels, minlength=len(self.funders))
+        clusters = [{'Funding Agencies': sorted(self.funders[labels == label].tolist()),
+                     'Shared Records': int(shared_counts[label])}
+                    for label in np.flatnonzero(sizes > 1)]
+        return sorted(clusters, key=lambda cluster: (-len(cluster['Funding Agencies']),
+                                                     -cluster['Shared Records']))
+
+
+def load_link_graph(path):
+    """Build the link graph of the grants of a Parquet data file, from
+    its funding agencies edges, and from its related records edges if
+    they are saved out of line, or from its joined related records
+    otherwise. The data files saved without funding agencies edges get
+    the joined funding agencies of each grant as its single funder.
+
+    :param path: str.
+    :return: LinkGraph.
+    """
+    if has_texts_out_of_line(path):
+        grants = pq.read_table(path, columns=['UT', 'Funding Agency']).to_pandas()
+        edges = load_related_records(path)
+    else:
+        grants = pq.read_table(path, columns=['UT', 'Funding Agency',
+                                              'Related WoS Records']).to_pandas()
+        related = grants['Related WoS Records'].fillna('').str.split(RELATED_RECORDS_SEPARATOR)
+        edges = pd.DataFrame({'UT': grants['UT'], 'Related UT': related}).explode('Related UT')
+        edges = edges[edges['Related UT'].fillna('') != '']
+    funders = load_funders(path) if os.path.exists(funders_path(path)) else grants
+    return LinkGraph(grants['UT'].tolist(), funders['UT'].tolist(),
+                     funders['Funding Agency'].tolist(), edges['UT'].tolist(),
+                     edges['Related UT'].tolist())
@@ -0,0 +1,118 @@
+"""
+Measure where the time of the harvests goes: counters and per-stage
+timers updated from the hot paths (API requests, JSON decoding, record
+parsing, file writing, chart rendering), structured log events, and an
+opt-in profiling mode dumping the cProfile statistics of a single run.
+"""
+
+import cProfile
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('grants')
+
+
+class Metrics:
+    """Process-wide counters, and timers keeping the number of calls,
+    the total and the maximum duration of each stage. Safe to update
+    from any thread.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.timers = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, amount=1):
+        """Add an amount to a counter.
+
+        :param name: str.
+        :param amount: int or float.
+        """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        """Add the duration of a call to a timer.
+
+        :param name: str.
+        :param seconds: float.
+        """
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """Time the block of a with statement.
+
+        :param name: str.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """Return the current values of the counters and timers.
+
+        :return: dict.
+        """
+        with self.lock:
+            return {
+                'uptime_seconds': round(time.time() - self.started, 1),
+                'counters': dict(self.counters),
+                'timers': {name: {'count': count, 'total_seconds': round(total, 6),
+                                  'max_seconds': round(maximum, 6)}
+                           for name, (count, total, maximum) in self.timers.items()}
+            }
+
+
+metrics = Metrics()
+
+
+def log_event(event, **fields):
+    """Log an event as a single line of JSON.
+
+    :param event: str.
+    """
+    logger.info(json.dumps({'event': event, 'time': round(time.time(), 3), **fields},
+                           default=str))
+
+
+@contextmanager
+def profiled(profile_dir, name):
+    """Profile the block of a with statement with cProfile, if a
+    profile directory is given, and dump the statistics to a .prof file
+    named after the run, which can be read with pstats or snakeviz.
+    Only the calling thread is profiled: the time spent waiting for the
+    page retrieval threads and the parsing processes shows as waits.
+
+    :param profile_dir: str or None.
+    :param name: str.
+    """
+    if profile_dir is None:
+        yield
+        return
+    os.makedirs(profile_dir, exist_ok=True)
+    safe_name = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)[:100]
+    path = os.path.join(profile_dir, f'{safe_name}-{time.strftime("%Y%m%d-%H%M%S")}.prof')
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        log_event('profile', name=name, path=path)
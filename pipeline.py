@@ -0,0 +1,265 @@
+"""
+Stream the grants records from the API pages to the output files and
+the running aggregates chunk by chunk, so that the memory use stays
+flat regardless of the number of records the search query returns.
+"""
+
+from collections import deque
+from itertools import islice
+from api_operations import retrieve_wos_metadata_via_api, retrieve_pages
+from data_processing import fetch_data_batch, get_parse_executor, grants_frame, PARSE_WORKERS
+from json_decoding import loads
+from metrics import log_event, metrics
+
+RECORDS_PER_PAGE = 100
+# The most records the API lets a single search query retrieve.
+MAX_RECORDS_PER_QUERY = 100000
+CHUNK_SIZE = 1000
+
+
+def page_records(page_json):
+    """Return the list of raw records from an API page.
+
+    :param page_json: dict.
+    :return: list.
+    """
+    records = page_json['Data']['Records']['records']
+    return records['REC'] if records else []
+
+
+def iterate_pages(apikey, search_query, records_per_page=RECORDS_PER_PAGE, checkpoints=None,
+                  progress=None, rate_limiter=None, raw=False, stream=False):
+    """Yield the API pages of the search query results as they arrive.
+    With a checkpoint store, each retrieved page is saved, and only the
+    pages missing from an interrupted earlier harvest are requested. The
+    first page is always requested, so that the pages of an earlier
+    harvest are dropped if the query finds a different number of records
+    since. With raw, the pages after the first one are yielded as their
+    raw JSON documents, to be decoded by the parsing processes; the first
+    page is always decoded, for its number of records. With stream, the
+    records of the pages after the first one are decoded as the response
+    bodies stream in, and only the records are kept of those pages.
+
+    :param apikey: str.
+    :param search_query: str.
+    :param records_per_page: int.
+    :param checkpoints: CheckpointStore or None.
+    :param progress: callable taking the numbers of pages retrieved and
+        of pages required, or None.
+    :param rate_limiter: RateLimiter or None, to share a request rate
+        budget with other harvests.
+    :param raw: bool.
+    :param stream: bool.
+    :return: generator of dict, and of bytes if raw is True.
+    """
+    initial_json = retrieve_wos_metadata_via_api(apikey, search_query, records_per_page,
+                                                 rate_limiter=rate_limiter)
+    if checkpoints is not None:
+        checkpoints.start_harvest(search_query, initial_json['QueryResult']['RecordsFound'])
+        checkpoints.put_page(search_query, 1, records_per_page, initial_json)
+    total_results = min(initial_json['QueryResult']['RecordsFound'], MAX_RECORDS_PER_QUERY)
+    requests_required = ((total_results - 1) // records_per_page) + 1
+    log_event('pages_required', query=search_query, pages=requests_required)
+    if progress is not None:
+        progress(1, requests_required)
+    yield initial_json
+
+    first_records = range(records_per_page + 1, total_results + 1, records_per_page)
+    saved = set()
+    if checkpoints is not None:
+        # The first page was saved above, it is not counted as restored.
+        saved = {first_record
+                 for first_record in checkpoints.saved_first_records(search_query,
+                                                                    records_per_page)
+                 if first_record in first_records}
+        if saved:
+            log_event('pages_restored', query=search_query, pages=len(saved))
+    retrieved_pages = retrieve_pages(
+        apikey,
+        search_query,
+        records_per_page,
+        [first_record for first_record in first_records if first_record not in saved],
+        rate_limiter=rate_limiter,
+        raw=raw,
+        stream=stream
+    )
+    for i, first_record in enumerate(first_records, start=2):
+        if first_record in saved:
+            subsequent_json = checkpoints.get_page(search_query, first_record, records_per_page,
+                                                   raw)
+            metrics.increment('pages.restored')
+        else:
+            with metrics.timer('pages.wait'):
+                subsequent_json = next(retrieved_pages)
+            metrics.increment('pages.retrieved')
+            if checkpoints is not None:
+                checkpoints.put_page(search_query, first_record, records_per_page,
+                                     subsequent_json)
+        if progress is not None:
+            progress(i, requests_required)
+        yield subsequent_json
+        log_event('page', query=search_query, page=i, pages=requests_required)
+    if checkpoints is not None:
+        checkpoints.finish_harvest(search_query)
+
+
+def parse_page_content(content, rates, yearly_rates=None):
+    """Decode a raw API page and parse its records. This is the unit of
+    work of the parsing processes, so that both the decoding and the
+    parsing are spread over them, and only the raw page and the parsed
+    records are pickled.
+
+    :param content: bytes.
+    :param rates: dict.
+    :param yearly_rates: dict of int to dict, or None.
+    :return: list of dict.
+    """
+    return fetch_data_batch(page_records(loads(content)), rates, yearly_rates)
+
+
+def iterate_parsed_batches(pages, rates, yearly_rates=None):
+    """Send each page to the pool of parsing processes, keeping a
+    bounded number of pages in flight, and yield the parsed batches in
+    the order of the pages. The raw pages are decoded in the processes,
+    the records of the decoded ones are sent as they are.
+
+    :param pages: iterable of bytes or dict.
+    :param rates: dict.
+    :param yearly_rates: dict of int to dict, or None.
+    :return: generator of list of dict.
+    """
+    executor = get_parse_executor()
+    pending = deque()
+    for page in pages:
+        if isinstance(page, bytes):
+            pending.append(executor.submit(parse_page_content, page, rates, yearly_rates))
+        else:
+            pending.append(executor.submit(fetch_data_batch, page_records(page), rates,
+                                           yearly_rates))
+        if len(pending) > PARSE_WORKERS * 2:
+            yield parsed_batch(pending.popleft())
+    while pending:
+        yield parsed_batch(pending.popleft())
+
+
+def parsed_batch(future):
+    """Return the parsed batch of a page sent to the parsing processes,
+    timing the wait for it.
+
+    :param future: concurrent.futures.Future.
+    :return: list of dict.
+    """
+    with metrics.timer('parse.batch'):
+        return future.result()
+
+
+def parse_page(page_json, rates, yearly_rates=None):
+    """Parse the records of an API page in the calling process, timing
+    the parsing alone.
+
+    :param page_json: dict.
+    :param rates: dict.
+    :param yearly_rates: dict of int to dict, or None.
+    :return: list of dict.
+    """
+    with metrics.timer('parse.batch'):
+        return fetch_data_batch(page_records(page_json), rates, yearly_rates)
+
+
+def iterate_grants(pages, rates, parallel=False, progress=None, on_batch=None,
+                   yearly_rates=None, unique=False):
+    """Parse the records of each page, in the calling process, or in a
+    pool of processes if parallel is True. Pickling decoded pages to the
+    pool costs about as much as parsing them, so the pool is meant for
+    the raw pages of iterate_pages, which are decoded in the processes
+    as well. The records are yielded in the order of the pages. With
+    unique, the records whose UT was already yielded are dropped, i.e.
+    the records found by several shards of a query.
+
+    :param pages: iterable of dict, or of bytes if parallel is True.
+    :param rates: dict.
+    :param parallel: bool.
+    :param progress: callable taking the number of parsed records, or
+        None.
+    :param on_batch: callable taking the list of the parsed records of
+        each page, i.e. to update running aggregates page by page, or
+        None.
+    :param yearly_rates: dict of int to dict, or None, to convert the
+        grant amounts at the rates of their publication years.
+    :param unique: bool.
+    :return: generator of dict.
+    """
+    if parallel:
+        batches = iterate_parsed_batches(pages, rates, yearly_rates)
+    else:
+        batches = (parse_page(page_json, rates, yearly_rates) for page_json in pages)
+    records_parsed = 0
+    seen = set()
+    for batch in batches:
+        metrics.increment('records.parsed', len(batch))
+        if unique:
+            batch = unseen_grants(batch, seen)
+        records_parsed += len(batch)
+        if on_batch is not None:
+            on_batch(batch)
+        if progress is not None:
+            progress(records_parsed)
+        yield from batch
+
+
+def unseen_grants(batch, seen):
+    """Return the grants records of a batch whose UT is not in the set
+    of the UTs seen so far, adding their UTs to it.
+
+    :param batch: list of dict.
+    :param seen: set of str.
+    :return: list of dict.
+    """
+    unseen = []
+    for grant in batch:
+        ut = grant['UT']
+        if ut is not None:
+            if ut in seen:
+                continue
+            seen.add(ut)
+        unseen.append(grant)
+    return unseen
+
+
+def chunked(iterable, size=CHUNK_SIZE):
+    """Group the items of an iterable into lists of a bounded size.
+
+    :param iterable: iterable.
+    :param size: int.
+    :return: generator of list.
+    """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def stream_to_sinks(grants, sinks, chunk_size=CHUNK_SIZE):
+    """Write the parsed grants records to each of the sinks in bounded
+    chunks, closing the sinks when the records are exhausted.
+
+    :param grants: iterable of dict.
+    :param sinks: list of objects with write and close methods.
+    :param chunk_size: int.
+    :return: int.
+    """
+    records_count = 0
+    try:
+        for chunk in chunked(grants, chunk_size):
+            with metrics.timer('write.dataframe'):
+                chunk_df = grants_frame(chunk)
+            for sink in sinks:
+                with metrics.timer(f'write.{type(sink).__name__}'):
+                    sink.write(chunk_df)
+            records_count += len(chunk)
+            metrics.increment('records.written', len(chunk))
+    finally:
+        for sink in sinks:
+            with metrics.timer(f'write.{type(sink).__name__}.close'):
+                sink.close()
+    return records_count
+
@@ -0,0 +1,172 @@
+"""
+Cache the results of the search queries on disk, so that repeating the
+same query within the cache lifetime neither waits for nor spends the
+quota of the Web of Science API.
+"""
+
+from datetime import timedelta
+import hashlib
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
+import time
+from metrics import metrics
+
+QUERY_CACHE_DIR = 'cache/queries'
+QUERY_CACHE_TTL = timedelta(hours=1)
+QUERY_CACHE_MAX_BYTES = 512 * 1024 ** 2
+
+
+def normalize_query(query):
+    """Bring the equivalent spellings of a search query to the same
+    cache key: the advanced search field tags, operators and terms are
+    case-insensitive, and the extra whitespace doesn't matter.
+
+    :param query: str.
+    :return: str.
+    """
+    return ' '.join(query.split()).lower()
+
+
+class QueryCache:
+    """Size-bounded least recently used cache of the search query
+    results, with each entry expiring after a fixed lifetime. Small
+    values (i.e. the number of records found) are pickled, files (i.e.
+    the exported grants table) are copied into the cache directory.
+    """
+
+    def __init__(self, path=QUERY_CACHE_DIR, ttl=QUERY_CACHE_TTL,
+                 max_bytes=QUERY_CACHE_MAX_BYTES):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(path, 'index.sqlite3'),
+                                          check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                'filename TEXT PRIMARY KEY, created REAL, accessed REAL, size INTEGER)'
+            )
+
+    def entry_filename(self, query, kind, extension='pkl'):
+        """Return the name of the cache file for the search query.
+
+        :param query: str.
+        :param kind: str.
+        :param extension: str.
+        :return: str.
+        """
+        key = hashlib.sha1(normalize_query(query).encode('utf-8')).hexdigest()
+        return f'{key}.{kind}.{extension}'
+
+    def lookup(self, filename):
+        """Return the full path of a live cache entry, refreshing its
+        last access time, or None if it is missing or expired.
+
+        :param filename: str.
+        :return: str or None.
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT created FROM entries WHERE filename = ?',
+                                          (filename,)).fetchone()
+            if row is None:
+                metrics.increment('query_cache.misses')
+                return None
+            if now - row[0] > self.ttl.total_seconds():
+                self.remove(filename)
+                metrics.increment('query_cache.misses')
+                return None
+            self.connection.execute('UPDATE entries SET accessed = ? WHERE filename = ?',
+                                    (now, filename))
+        metrics.increment('query_cache.hits')
+        return os.path.join(self.path, filename)
+
+    def register(self, filename):
+        """Add a file written to the cache directory to the index and
+        evict the least recently used entries beyond the size limit.
+
+        :param filename: str.
+        """
+        now = time.time()
+        size = os.path.getsize(os.path.join(self.path, filename))
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                                    (filename, now, now, size))
+            total = self.connection.execute('SELECT SUM(size) FROM entries').fetchone()[0]
+            entries = self.connection.execute(
+                'SELECT filename, size FROM entries ORDER BY accessed'
+            ).fetchall()
+            for old_filename, old_size in entries:
+                if total <= self.max_bytes or old_filename == filename:
+                    break
+                self.remove(old_filename)
+                total -= old_size
+
+    def remove(self, filename):
+        """Delete a cache entry. The caller must hold the lock.
+
+        :param filename: str.
+        """
+        self.connection.execute('DELETE FROM entries WHERE filename = ?', (filename,))
+        try:
+            os.remove(os.path.join(self.path, filename))
+        except FileNotFoundError:
+            pass
+
+    def get_value(self, query, kind):
+        """Return a cached value for the search query, if any.
+
+        :param query: str.
+        :param kind: str.
+        :return: object or None.
+        """
+        path = self.lookup(self.entry_filename(query, kind))
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as reading:
+                return pickle.load(reading)
+        except FileNotFoundError:
+            return None
+
+    def put_value(self, query, kind, value):
+        """Cache a value for the search query.
+
+        :param query: str.
+        :param kind: str.
+        :param value: object.
+        """
+        filename = self.entry_filename(query, kind)
+        temporary_path = os.path.join(self.path, f'{filename}.tmp')
+        with open(temporary_path, 'wb') as writing:
+            pickle.dump(value, writing)
+        os.replace(temporary_path, os.path.join(self.path, filename))
+        self.register(filename)
+
+    def get_file(self, query, kind, extension):
+        """Return the path of a cached file for the search query, if any.
+
+        :param query: str.
+        :param kind: str.
+        :param extension: str.
+        :return: str or None.
+        """
+        return self.lookup(self.entry_filename(query, kind, extension))
+
+    def put_file(self, query, kind, source):
+        """Copy a file into the cache for the search query.
+
+        :param query: str.
+        :param kind: str.
+        :param source: str.
+        """
+        filename = self.entry_filename(query, kind, source.rsplit('.', 1)[-1])
+        temporary_path = os.path.join(self.path, f'{filename}.tmp')
+        shutil.copyfile(source, temporary_path)
+        os.replace(temporary_path, os.path.join(self.path, filename))
+        self.register(filename)
@@ -0,0 +1,115 @@
+"""
+Keep the rendered results (the plots and the data file name) of each
+user's latest run or loaded file on the server side, keyed by the id of
+the result, so that switching between the visualizations is a lookup
+that doesn't interfere with the other users.
+"""
+
+from collections import OrderedDict
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import weakref
+
+RESULTS_IN_MEMORY = 16
+RESULTS_SPILL_DIR = 'cache/results'
+RESULTS_ON_DISK = 256
+
+
+class ResultStore:
+    """Least recently used store of the results. Beyond the number of
+    results kept in memory, the least recently used ones are pickled to
+    a directory of their own in the spill directory, if there is one,
+    and loaded back into memory when they are looked up again. Beyond
+    the number of results kept on disk, the least recently spilled ones
+    are deleted. The directory of the store is deleted with it, and the
+    stores of other processes sharing the spill directory are left
+    alone.
+    """
+
+    def __init__(self, in_memory=RESULTS_IN_MEMORY, spill_dir=RESULTS_SPILL_DIR,
+                 on_disk=RESULTS_ON_DISK):
+        self.in_memory = in_memory
+        self.spill_dir = spill_dir
+        self.on_disk = on_disk
+        self.results = OrderedDict()
+        self.spilled = OrderedDict()
+        self.lock = threading.Lock()
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self.spill_dir = tempfile.mkdtemp(prefix=f'{os.getpid()}-', dir=spill_dir)
+            weakref.finalize(self, shutil.rmtree, self.spill_dir, ignore_errors=True)
+
+    def spill_path(self, result_id):
+        """Return the path of the file a result is spilled to.
+
+        :param result_id: str.
+        :return: str.
+        """
+        return os.path.join(self.spill_dir, f'{result_id}.pkl')
+
+    def put(self, result_id, result):
+        """Store a result as the most recently used one.
+
+        :param result_id: str.
+        :param result: dict.
+        """
+        with self.lock:
+            self.results[result_id] = result
+            self.results.move_to_end(result_id)
+            self.drop_spilled(result_id)
+            self.evict()
+
+    def get(self, result_id):
+        """Return a result, loading it back from disk if it was spilled,
+        or None if it is unknown or was evicted.
+
+        :param result_id: str or None.
+        :return: dict or None.
+        """
+        with self.lock:
+            if result_id in self.results:
+                self.results.move_to_end(result_id)
+                return self.results[result_id]
+            if result_id not in self.spilled:
+                return None
+            try:
+                with open(self.spill_path(result_id), 'rb') as reading:
+                    result = pickle.load(reading)
+            except FileNotFoundError:
+                result = None
+            self.drop_spilled(result_id)
+            if result is not None:
+                self.results[result_id] = result
+                self.evict()
+            return result
+
+    def evict(self):
+        """Spill or drop the least recently used results beyond the
+        memory limit, and delete the oldest spilled ones beyond the disk
+        limit. The caller must hold the lock.
+        """
+        while len(self.results) > self.in_memory:
+            result_id, result = self.results.popitem(last=False)
+            if self.spill_dir is None:
+                continue
+            with open(self.spill_path(result_id), 'wb') as writing:
+                pickle.dump(result, writing)
+            self.spilled[result_id] = True
+        while len(self.spilled) > self.on_disk:
+            self.drop_spilled(next(iter(self.spilled)))
+
+    def drop_spilled(self, result_id):
+        """Delete the spilled copy of a result, if any. The caller must
+        hold the lock.
+
+        :param result_id: str.
+        """
+        if self.spilled.pop(result_id, None) is None:
+            return
+        try:
+            os.remove(self.spill_path(result_id))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,164 @@
+"""
+Split the search queries finding more records than the Web of Science
+Expanded API lets a single query retrieve into publication year range
+shards under the limit, and harvest the shards into one dataset.
+"""
+
+from datetime import date
+from api_operations import validate_search_query
+from metrics import log_event
+from pipeline import MAX_RECORDS_PER_QUERY, RECORDS_PER_PAGE, iterate_pages
+
+FIRST_YEAR = 1900
+
+
+def year_range_query(query, first_year, last_year):
+    """Narrow a search query down to a range of publication years.
+
+    :param query: str.
+    :param first_year: int.
+    :param last_year: int.
+    :return: str.
+    """
+    if first_year == last_year:
+        return f'({query}) AND PY=({first_year})'
+    return f'({query}) AND PY=({first_year}-{last_year})'
+
+
+def count_records(apikey, query, query_cache=None, rate_limiter=None):
+    """Return the number of records a search query finds, probing the
+    API with a count=0 request unless the query cache knows it.
+
+    :param apikey: str.
+    :param query: str.
+    :param query_cache: QueryCache or None.
+    :param rate_limiter: RateLimiter or None.
+    :return: int.
+    """
+    if query_cache is not None:
+        records_found = query_cache.get_value(query, 'count')
+        if records_found is not None:
+            return records_found
+    status, records_found = validate_search_query(apikey, query, rate_limiter=rate_limiter)
+    if status != 200:
+        raise RuntimeError(f'Request status: {status}, message: {records_found}')
+    if query_cache is not None:
+        query_cache.put_value(query, 'count', records_found)
+    return records_found
+
+
+def plan_shards(query, records_found, count, limit=MAX_RECORDS_PER_QUERY,
+                first_year=FIRST_YEAR, last_year=None):
+    """Split a search query into publication year range shards finding
+    no more than limit records each, halving the ranges that find more.
+    Only the first half of each split range is probed: the count of the
+    second half is what remains of the range. The records without a
+    publication year in the range, if any, make a last shard. A single
+    year finding more than limit records can't be split further, and
+    is only harvested up to the limit.
+
+    :param query: str.
+    :param records_found: int, the number of records of the query.
+    :param count: callable returning the number of records a query
+        finds.
+    :param limit: int.
+    :param first_year: int.
+    :param last_year: int or None, the current year by default.
+    :return: list of (str, int) tuples, the shard queries and their
+        numbers of records.
+    """
+    if records_found <= limit:
+        return [(query, records_found)]
+    last_year = last_year if last_year is not None else date.today().year
+    in_range = count(year_range_query(query, first_year, last_year))
+    shards = []
+    ranges = [(first_year, last_year, in_range)]
+    while ranges:
+        first, last, found = ranges.pop()
+        if found == 0:
+            continue
+        if found <= limit or first == last:
+            shards.append((year_range_query(query, first, last), found))
+            continue
+        middle = (first + last) // 2
+        first_half = count(year_range_query(query, first, middle))
+        ranges.append((middle + 1, last, found - first_half))
+        ranges.append((first, middle, first_half))
+    if records_found > in_range:
+        shards.append((f'({query}) NOT PY=({first_year}-{last_year})',
+                       records_found - in_range))
+    return shards
+
+
+def iterate_shard_pages(apikey, shards, records_per_page=RECORDS_PER_PAGE, checkpoints=None,
+                        progress=None, rate_limiter=None, raw=False, stream=False):
+    """Yield the API pages of each shard in turn, reporting the progress
+    over the pages of all the shards.
+
+    :param apikey: str.
+    :param shards: list of (str, int) tuples.
+    :param records_per_page: int.
+    :param checkpoints: CheckpointStore or None.
+    :param progress: callable taking the numbers of pages retrieved and
+        of pages required, or None.
+    :param rate_limiter: RateLimiter or None.
+    :param raw: bool, see pipeline.iterate_pages.
+    :param stream: bool, see pipeline.iterate_pages.
+    :return: generator of dict, and of bytes if raw is True.
+    """
+    shard_pages = [max(1, (min(found, MAX_RECORDS_PER_QUERY) - 1) // records_per_page + 1)
+                   for _, found in shards]
+    pages_total = sum(shard_pages)
+    pages_before = 0
+    for (shard_query, _), pages in zip(shards, shard_pages):
+        shard_progress = None
+        if progress is not None:
+            def shard_progress(pages_fetched, _, pages_before=pages_before):
+                progress(pages_before + pages_fetched, pages_total)
+        yield from iterate_pages(apikey, shard_query, records_per_page, checkpoints,
+                                 shard_progress, rate_limiter, raw, stream)
+        pages_before += pages
+
+
+def iterate_query_pages(apikey, query, records_per_page=RECORDS_PER_PAGE, query_cache=None,
+                        checkpoints=None, progress=None, rate_limiter=None, raw=False,
+                        stream=False):
+    """Yield the API pages of a search query, split into shards if it
+    finds more records than a single query can retrieve. The record
+    counts are taken from the query cache when it knows them. Otherwise,
+    the number of records of the query is read from its first page, which
+    is only dropped if the query has to be split.
+
+    :param apikey: str.
+    :param query: str.
+    :param records_per_page: int.
+    :param query_cache: QueryCache or None.
+    :param checkpoints: CheckpointStore or None.
+    :param progress: callable taking the numbers of pages retrieved and
+        of pages required, or None.
+    :param rate_limiter: RateLimiter or None.
+    :param raw: bool, see pipeline.iterate_pages.
+    :param stream: bool, see pipeline.iterate_pages.
+    :return: generator of dict, and of bytes if raw is True.
+    """
+    records_found = query_cache.get_value(query, 'count') if query_cache is not None else None
+    if records_found is None or records_found <= MAX_RECORDS_PER_QUERY:
+        pages = iterate_pages(apikey, query, records_per_page, checkpoints, progress,
+                              rate_limiter, raw, stream)
+        first_page = next(pages)
+        records_found = first_page['QueryResult']['RecordsFound']
+        if query_cache is not None:
+            query_cache.put_value(query, 'count', records_found)
+        if records_found <= MAX_RECORDS_PER_QUERY:
+            yield first_page
+            yield from pages
+            return
+        pages.close()
+        if checkpoints is not None:
+            checkpoints.finish_harvest(query)
+    shards = plan_shards(query, records_found,
+                         lambda shard_query: count_records(apikey, shard_query, query_cache,
+                                                           rate_limiter))
+    log_event('query_split', query=query, shards=len(shards))
+    yield from iterate_shard_pages(apikey, shards, records_per_page, checkpoints, progress,
+                                   rate_limiter, raw, stream)
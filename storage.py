@@ -0,0 +1,396 @@
+"""
+Save and load the grants data: typed, compressed Parquet files for
+fast reloads with column projection, and Excel spreadsheets as an
+on-demand export. The large text fields no chart uses can be kept out
+of line, in side files keyed by UT that are only read on demand.
+"""
+
+import os
+import pandas as pd
+import pyarrow as pa
+from pyarrow import parquet as pq
+from openpyxl import Workbook
+from metrics import metrics
+
+# The type of the columns with few distinct values, dictionary encoded
+# so that they are loaded back as pandas categoricals.
+CATEGORY_TYPE = pa.dictionary(pa.int32(), pa.string())
+GRANTS_SCHEMA = pa.schema([
+    ('UT', pa.string()),
+    ('Publication Year', pa.int64()),
+    ('Financial Year', pa.int64()),
+    ('Principal Investigator', pa.string()),
+    ('Other Names', pa.string()),
+    ('Document Type', CATEGORY_TYPE),
+    ('Document Title', pa.string()),
+    ('Keywords', pa.string()),
+    ('Grant Description', pa.string()),
+    ('Related WoS Records', pa.string()),
+    ('Related WoS Records Count', pa.int64()),
+    ('Funding Agency', pa.string()),
+    ('Funding Country', CATEGORY_TYPE),
+    ('Grant Source', CATEGORY_TYPE),
+    ('Principal Investigator Institution', pa.string()),
+    ('Grant Amount', pa.float64()),
+    ('Currency', CATEGORY_TYPE),
+    ('Grant Amount, USD', pa.float64())
+])
+# The large text columns no chart uses, which can be stored out of
+# line: the grant descriptions by UT, and the related records as one
+# (UT, position, related UT) edge per record instead of a joined string.
+TEXT_COLUMNS = ['Grant Description', 'Related WoS Records']
+ANALYTICAL_SCHEMA = pa.schema([field for field in GRANTS_SCHEMA
+                               if field.name not in TEXT_COLUMNS])
+DESCRIPTIONS_SCHEMA = pa.schema([('UT', pa.string()), ('Grant Description', pa.string())])
+RELATED_RECORDS_SCHEMA = pa.schema([
+    ('UT', pa.string()),
+    ('Position', pa.int32()),
+    ('Related UT', pa.string())
+])
+RELATED_RECORDS_SEPARATOR = ', '
+# The funding agencies of the grants, as one (UT, position, agency) edge
+# per agency, since the names of the agencies can hold the separator of
+# the joined Funding Agency column.
+FUNDERS_SCHEMA = pa.schema([
+    ('UT', pa.string()),
+    ('Position', pa.int32()),
+    ('Funding Agency', pa.string())
+])
+PARQUET_COMPRESSION = 'zstd'
+EXCEL_ROWS_PER_BATCH = 10000
+
+
+def typed_frame(df, schema=GRANTS_SCHEMA):
+    """Convert a chunk of parsed grants records to the column types of
+    the grants schema: the '' placeholders of missing numbers become
+    nulls, the other values are stored as strings, and the dictionary
+    encoded ones as categoricals.
+
+    :param df: pandas dataframe.
+    :param schema: pyarrow.Schema, the columns to keep.
+    :return: pandas dataframe.
+    """
+    columns = {}
+    for field in schema:
+        if pa.types.is_string(field.type) or pa.types.is_dictionary(field.type):
+            columns[field.name] = df[field.name].map(
+                lambda v: v if v is None or isinstance(v, str) else str(v)
+            )
+            if pa.types.is_dictionary(field.type):
+                columns[field.name] = columns[field.name].astype('category')
+        else:
+            columns[field.name] = pd.to_numeric(df[field.name], errors='coerce')
+    return pd.DataFrame(columns)
+
+
+def descriptions_path(path):
+    """Return the path of the grant descriptions saved next to a grants
+    data file.
+
+    :param path: str.
+    :return: str.
+    """
+    return f'{path.rsplit(".", 1)[0]}.descriptions.parquet'
+
+
+def related_records_path(path):
+    """Return the path of the related records edges saved next to a
+    grants data file.
+
+    :param path: str.
+    :return: str.
+    """
+    return f'{path.rsplit(".", 1)[0]}.related.parquet'
+
+
+def related_record_edges(uts, related_records):
+    """Split the joined related records of grants into one edge per
+    related record, in their original order.
+
+    :param uts: iterable of str.
+    :param related_records: iterable of str or None.
+    :return: tuple of three lists, the UTs, the positions and the
+        related UTs.
+    """
+    edge_uts, positions, related_uts = [], [], []
+    for ut, joined in zip(uts, related_records):
+        if not joined or ut is None:
+            continue
+        for position, related_ut in enumerate(joined.split(RELATED_RECORDS_SEPARATOR)):
+            edge_uts.append(ut)
+            positions.append(position)
+            related_uts.append(related_ut)
+    return edge_uts, positions, related_uts
+
+
+def funders_path(path):
+    """Return the path of the funding agencies edges saved next to a
+    grants data file.
+
+    :param path: str.
+    :return: str.
+    """
+    return f'{path.rsplit(".", 1)[0]}.funders.parquet'
+
+
+def funder_edges(uts, agencies):
+    """Return one edge per funding agency of each grant, in their
+    original order.
+
+    :param uts: iterable of str.
+    :param agencies: iterable of list of str, or None.
+    :return: tuple of three lists, the UTs, the positions and the
+        funding agencies.
+    """
+    edge_uts, positions, edge_agencies = [], [], []
+    for ut, names in zip(uts, agencies):
+        if not isinstance(names, list) or ut is None:
+            continue
+        for position, agency in enumerate(names):
+            edge_uts.append(ut)
+            positions.append(position)
+            edge_agencies.append(agency)
+    return edge_uts, positions, edge_agencies
+
+
+class ParquetSink:
+    """Write the grants records into a Parquet file chunk by chunk, as
+    row groups of typed, compressed columns. With the analytical
+    schema, the text columns are left out.
+    """
+
+    def __init__(self, path, compression=PARQUET_COMPRESSION, schema=GRANTS_SCHEMA):
+        self.path = path
+        self.schema = schema
+        self.writer = pq.ParquetWriter(path, schema, compression=compression)
+
+    def write(self, chunk):
+        """Append a chunk of grants records as a row group.
+
+        :param chunk: pandas dataframe.
+        """
+        self.writer.write_table(pa.Table.from_pandas(typed_frame(chunk, self.schema),
+                                                     schema=self.schema,
+                                                     preserve_index=False))
+
+    def close(self):
+        """Write the Parquet file footer."""
+        self.writer.close()
+
+
+class TextsSink:
+    """Write the text columns of the grants records next to a grants
+    data file saved with the analytical schema: the non-empty grant
+    descriptions by UT, and the related records as edges.
+    """
+
+    def __init__(self, path, compression=PARQUET_COMPRESSION):
+        self.path = path
+        self.descriptions = pq.ParquetWriter(descriptions_path(path), DESCRIPTIONS_SCHEMA,
+                                             compression=compression)
+        self.related_records = pq.ParquetWriter(related_records_path(path),
+                                                RELATED_RECORDS_SCHEMA, compression=compression)
+
+    def write(self, chunk):
+        """Append the texts of a chunk of grants records.
+
+        :param chunk: pandas dataframe.
+        """
+        described = chunk[chunk['Grant Description'].fillna('') != '']
+        self.descriptions.write_table(pa.table(
+            [described['UT'].tolist(), described['Grant Description'].tolist()],
+            schema=DESCRIPTIONS_SCHEMA
+        ))
+        self.related_records.write_table(pa.table(
+            list(related_record_edges(chunk['UT'].tolist(),
+                                      chunk['Related WoS Records'].tolist())),
+            schema=RELATED_RECORDS_SCHEMA
+        ))
+
+    def close(self):
+        """Write the Parquet file footers."""
+        self.descriptions.close()
+        self.related_records.close()
+
+
+class FundersSink:
+    """Write the funding agencies edges of the grants records next to a
+    grants data file.
+    """
+
+    def __init__(self, path, compression=PARQUET_COMPRESSION):
+        self.path = path
+        self.writer = pq.ParquetWriter(funders_path(path), FUNDERS_SCHEMA,
+                                       compression=compression)
+
+    def write(self, chunk):
+        """Append the funding agencies edges of a chunk of grants
+        records.
+
+        :param chunk: pandas dataframe.
+        """
+        self.writer.write_table(pa.table(
+            list(funder_edges(chunk['UT'].tolist(), chunk['Funding Agencies'].tolist())),
+            schema=FUNDERS_SCHEMA
+        ))
+
+    def close(self):
+        """Write the Parquet file footer."""
+        self.writer.close()
+
+
+def excel_value(value):
+    """Convert a value into one that can be written to a worksheet
+    cell, leaving the cells of missing values empty.
+
+    :param value: object.
+    :return: object.
+    """
+    if isinstance(value, list):
+        return str(value)
+    if value is None or pd.isna(value):
+        return None
+    return value
+
+
+class ExcelSink:
+    """Write the grants records into an Excel file row by row, without
+    keeping the whole workbook in memory.
+    """
+
+    def __init__(self, path, sheet_name='Grants Data'):
+        self.path = path
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet(sheet_name)
+        self.header_written = False
+
+    def write(self, chunk):
+        """Append a chunk of grants records to the worksheet.
+
+        :param chunk: pandas dataframe.
+        """
+        if not self.header_written:
+            self.sheet.append(list(chunk.columns))
+            self.header_written = True
+        for row in chunk.itertuples(index=False):
+            self.sheet.append([excel_value(v) for v in row])
+
+    def close(self):
+        """Save the workbook to disk."""
+        self.workbook.save(self.path)
+
+
+def load_grants(path, columns=None):
+    """Load the grants data saved as a Parquet, Feather or Excel file.
+    With the columnar formats, only the requested columns are read.
+
+    :param path: str.
+    :param columns: list of str or None.
+    :return: pandas dataframe.
+    """
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path, columns=columns, dtype_backend='numpy_nullable')
+    if path.endswith('.feather'):
+        return pd.read_feather(path, columns=columns, dtype_backend='numpy_nullable')
+    return pd.read_excel(path, usecols=columns)
+
+
+def has_texts_out_of_line(path):
+    """Tell if a Parquet grants data file was saved without its text
+    columns, and with the side files holding them.
+
+    :param path: str.
+    :return: bool.
+    """
+    return (not set(TEXT_COLUMNS) & set(pq.read_schema(path).names)
+            and os.path.exists(descriptions_path(path)))
+
+
+def uts_filter(uts):
+    """Return the Parquet filter selecting the rows of a list of UTs,
+    or all the rows if uts is None.
+
+    :param uts: list of str or None.
+    :return: list or None.
+    """
+    return None if uts is None else [('UT', 'in', list(uts))]
+
+
+def load_descriptions(path, uts=None):
+    """Load the grant descriptions saved out of line next to a grants
+    data file, of the given UTs or of all the grants.
+
+    :param path: str, the grants data file.
+    :param uts: list of str or None.
+    :return: dict of str to str.
+    """
+    table = pq.read_table(descriptions_path(path), filters=uts_filter(uts))
+    return dict(zip(table.column('UT').to_pylist(),
+                    table.column('Grant Description').to_pylist()))
+
+
+def load_related_records(path, uts=None):
+    """Load the related records edges saved out of line next to a
+    grants data file, of the given UTs or of all the grants.
+
+    :param path: str, the grants data file.
+    :param uts: list of str or None.
+    :return: pandas dataframe, with a row per edge.
+    """
+    return pq.read_table(related_records_path(path),
+                         filters=uts_filter(uts)).to_pandas()
+
+
+def load_funders(path, uts=None):
+    """Load the funding agencies edges saved next to a grants data
+    file, of the given UTs or of all the grants.
+
+    :param path: str, the grants data file.
+    :param uts: list of str or None.
+    :return: pandas dataframe, with a row per edge.
+    """
+    return pq.read_table(funders_path(path), filters=uts_filter(uts)).to_pandas()
+
+
+def with_texts(path, df):
+    """Put back the text columns saved out of line into a dataframe of
+    grants records, joining the related records in their original
+    order.
+
+    :param path: str, the grants data file.
+    :param df: pandas dataframe.
+    :return: pandas dataframe.
+    """
+    uts = df['UT'].dropna().tolist()
+    descriptions = load_descriptions(path, uts)
+    edges = load_related_records(path, uts).sort_values(['UT', 'Position'])
+    related_records = edges.groupby('UT', sort=False)['Related UT'].agg(
+        RELATED_RECORDS_SEPARATOR.join).to_dict()
+    df = df.copy()
+    position = df.columns.get_loc('Keywords') + 1
+    df.insert(position, 'Grant Description',
+              [descriptions.get(ut, '') for ut in df['UT']])
+    df.insert(position + 1, 'Related WoS Records',
+              [related_records.get(ut, '') for ut in df['UT']])
+    return df
+
+
+def export_to_excel(path):
+    """Convert a saved Parquet file into an Excel spreadsheet next to
+    it, reading it in batches of rows. The text columns saved out of
+    line are put back batch by batch.
+
+    :param path: str.
+    :return: str.
+    """
+    excel_path = f'{path.rsplit(".", 1)[0]}.xlsx'
+    texts_out_of_line = has_texts_out_of_line(path)
+    with metrics.timer('export.excel'):
+        sink = ExcelSink(excel_path)
+        try:
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=EXCEL_ROWS_PER_BATCH):
+                df = batch.to_pandas()
+                sink.write(with_texts(path, df) if texts_out_of_line else df)
+        finally:
+            sink.close()
+    return excel_path
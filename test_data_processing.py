@@ -0,0 +1,98 @@
+"""
+Regression tests of the extraction of the fields of Grants Index
+records: the fields found as a single dict instead of a list, the
+list of funding agencies of a grant, and the conversion of the grant
+amounts into USD.
+"""
+
+import numpy as np
+from benchmarks import synthetic_records
+from data_processing import convert_to_usd, extract_grant_fields
+
+
+def grant_record():
+    """:return: dict, a synthetic Grants Index record."""
+    return synthetic_records(1)[0]
+
+
+def test_list_fields():
+    grant = extract_grant_fields(grant_record())
+    assert grant['Document Title'] == 'Grant Title 0'
+    assert grant['Funding Agency'] == 'NIH'
+    assert grant['Principal Investigator'] == 'Investigator 0'
+    assert grant['Other Names'] == 'Researcher 0'
+
+
+def test_single_title_of_another_type():
+    rec = grant_record()
+    rec['static_data']['summary']['titles']['title'] = {'type': 'source',
+                                                         'content': 'Only Title'}
+    assert extract_grant_fields(rec)['Document Title'] == 'Only Title'
+
+
+def test_single_funding_agency_not_preferred():
+    rec = grant_record()
+    grant = rec['static_data']['fullrecord_metadata']['fund_ack']['grants']['grant']
+    grant['grant_agency_names'] = {'pref': 'N', 'content': 'Only Agency'}
+    assert extract_grant_fields(rec)['Funding Agency'] == 'Only Agency'
+
+
+def test_single_funding_agency_without_pref():
+    rec = grant_record()
+    grant = rec['static_data']['fullrecord_metadata']['fund_ack']['grants']['grant']
+    grant['grant_agency_names'] = {'content': 'Only Agency'}
+    assert extract_grant_fields(rec)['Funding Agency'] == 'Only Agency'
+
+
+def test_single_names():
+    rec = grant_record()
+    names = rec['static_data']['summary']['names']
+    names['name'] = {'role': 'researcher', 'full_name': 'Only Researcher'}
+    grant = extract_grant_fields(rec)
+    assert grant['Principal Investigator'] == ''
+    assert grant['Other Names'] == 'Only Researcher'
+
+    names['name'] = {'role': 'principal_investigator', 'full_name': 'Only Investigator'}
+    grant = extract_grant_fields(rec)
+    assert grant['Principal Investigator'] == 'Only Investigator'
+    assert grant['Other Names'] == ''
+
+
+def test_irregular_elements():
+    rec = grant_record()
+    metadata = rec['static_data']['fullrecord_metadata']
+    metadata['keywords']['keyword'] = [{'content': 1}, {'other': 2}, 'keyword']
+    metadata['related_records']['record'] = {'uid': 'WOS:000000000009'}
+    grant = extract_grant_fields(rec)
+    assert grant['Keywords'] == '1'
+    assert grant['Related WoS Records'] == 'WOS:000000000009'
+    assert grant['Related WoS Records Count'] == 1
+
+
+def test_funding_agencies_list():
+    rec = grant_record()
+    grant = rec['static_data']['fullrecord_metadata']['fund_ack']['grants']['grant']
+    grant['grant_agency_names'] = [{'pref': 'Y', 'content': 'Ministry of Education, Japan'},
+                                   {'pref': 'Y', 'content': 'NIH'},
+                                   {'pref': 'Y', 'content': 'NIH'},
+                                   {'pref': 'N', 'content': 'Agency'}]
+    grant = extract_grant_fields(rec)
+    assert grant['Funding Agency'] == 'Ministry of Education, Japan, NIH'
+    assert grant['Funding Agencies'] == ['Ministry of Education, Japan', 'NIH']
+
+
+def test_preferred_institution_without_content():
+    rec = grant_record()
+    grant = rec['static_data']['fullrecord_metadata']['fund_ack']['grants']['grant']
+    grant['grant_data']['grantDataItem']['principalInvestigators'] = {
+        'principalInvestigator': {'institution': {'pref': 'Y'}}}
+    assert extract_grant_fields(rec)['Principal Investigator Institution'] == ''
+
+
+def test_currency_missing_from_yearly_rates():
+    amounts = convert_to_usd(np.array([100.0, 100.0, 100.0]), ['EUR', 'JPY', 'XXX'],
+                             {'EUR': 0.5, 'JPY': 100.0}, [2020, 2020, 2020],
+                             {2020: {'EUR': 0.8}})
+    assert amounts[0] == 125.0
+    assert amounts[1] == 1.0
+    assert np.isnan(amounts[2])
@@ -0,0 +1,33 @@
+"""
+Regression tests of the lazy imports of the entry points: building the
+Flask app and loading the batch script must not import the analysis and
+plotting modules.
+"""
+
+import os
+import subprocess
+import sys
+import pytest
+from benchmarks import HEAVY_MODULES
+
+REPOSITORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def loaded_heavy_modules(code, directory):
+    """Run Python code in a fresh interpreter and return the heavy
+    modules it has imported.
+
+    :param code: str.
+    :param directory: str, the working directory of the interpreter.
+    :return: list of str.
+    """
+    check = (f'import sys\nsys.path.insert(0, {REPOSITORY!r})\n{code}\n'
+             f'print(*[name for name in {HEAVY_MODULES!r} if name in sys.modules])')
+    output = subprocess.run([sys.executable, '-c', check], cwd=directory, check=True,
+                            capture_output=True, text=True).stdout
+    return output.split()
+
+
+@pytest.mark.parametrize('code', ['import app\napp.create_app()', 'import batch'])
+def test_entry_point_without_heavy_modules(code, tmp_path):
+    assert loaded_heavy_modules(code, tmp_path) == []
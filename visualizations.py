@@ -1,12 +1,18 @@
 """
-Visualize processed dicts or Excel files of data as Plotly express
-objects.
+Visualize processed dicts or saved files of data as Plotly express
+objects. Each plot is rendered on demand as a compact JSON figure, to
+be drawn by the plotly.js bundle that the page loads once.
 """
 
+import os
 import textwrap
-import pandas as pd
+import threading
+from aggregates import CHART_COLUMNS, GrantsAggregates, cube_path
+from metrics import metrics
+from storage import load_grants
 import plotly.express as px
-from plotly import offline
+from plotly import io as pio
+from plotly.offline import get_plotlyjs
 
 color_palette = ['#B175E1', '#18A381', '#3595F0', '#ED5564', '#5E33BF',
                  '#003F51', '#A39300', '#EC40DB', '#C8582A', '#1E48DD',
@@ -27,17 +33,45 @@ def word_wrap(x):
     return '<br>'.join(textwrap.wrap(str(x), 40))
 
 
+def figure_json(fig):
+    """Serialize a figure as compact JSON. Plotly escapes the HTML
+    special characters, so the JSON can be embedded in a script element
+    of the page.
+
+    :param fig: plotly Figure.
+    :return: str.
+    """
+    with metrics.timer('plot.serialize'):
+        return pio.to_json(fig, validate=False, pretty=False)
+
+
+def plotly_js():
+    """Return the plotly.js bundle the figures are drawn with.
+
+    :return: str.
+    """
+    return get_plotlyjs()
+
+
 def visualize_data(df):
-    """Create a number of html div object with various grant data
-    visualizations with Plotly.
+    """Create the various grant data visualizations with Plotly, each
+    rendered when it is first displayed.
 
     :param df: pandas dataframe.
-    :return: tuple of str.
+    :return: LazyPlots.
     """
-    # Visualizing Grants by Years.
-    df['Grant Amount, USD'] = df['Grant Amount, USD'].replace(to_replace='', value=0)
-    gby = df.groupby('Publication Year')['Grant Amount, USD'].sum()
+    aggregates = GrantsAggregates()
+    aggregates.write(df)
+    return visualize_aggregates(aggregates)
+
+
+def plot_funding_by_year(aggregates):
+    """Visualize grants funding volume by years.
 
+    :param aggregates: GrantsAggregates.
+    :return: str.
+    """
+    gby = aggregates.funding_by_year_frame()
     fig = px.bar(
         data_frame=gby,
         y='Grant Amount, USD',
@@ -60,22 +94,22 @@ def visualize_data(df):
                       ))
     fig.update_yaxes(title_text=None, showgrid=True, gridcolor='#9D9D9C')
     fig.update_xaxes(title_text=None, linecolor='#9D9D9C')
-    grants_by_years_plot = offline.plot(fig, output_type='div')
+    return figure_json(fig)
 
-    # Visualizing top organizations receiving grant funding.
-    df['Principal Investigator Institution'] = (
-        df['Principal Investigator Institution'].replace(to_replace='',
-                                                         value='(name unavailable)')
-    )
-    gbo = (df.groupby('Principal Investigator Institution')['Grant Amount, USD'].
-           sum('').to_frame().reset_index())
-    gbo.sort_values('Grant Amount, USD', ascending=False, inplace=True)
+
+def plot_top_grant_receivers(aggregates):
+    """Visualize top organizations receiving grant funding.
+
+    :param aggregates: GrantsAggregates.
+    :return: str.
+    """
+    gbo = aggregates.top_grant_receivers_frame()
     gbo['Principal Investigator Institution'] = (gbo['Principal Investigator Institution'].
                                                  apply(word_wrap))
 
-    display_items_gbo = 15
+    display_items_gbo = len(gbo)
     fig = px.treemap(
-        data_frame=gbo[:display_items_gbo],
+        data_frame=gbo,
         names='Principal Investigator Institution',
         parents=[None for x in range(display_items_gbo)],
         color_discrete_sequence=color_palette,
@@ -89,14 +123,16 @@ def visualize_data(df):
                   'size': 16},
         textinfo="label+value"
     )
-    top_grant_receivers_plot = offline.plot(fig, output_type='div')
-
-    # Visualizing top funding agencies by funding volume.
-    df['Funding Agency'] = (df['Funding Agency'].replace(to_replace='',
-                                                         value='(name unavailable)'))
-    gbf = (df.groupby(['Funding Agency', 'Funding Country'])['Grant Amount, USD'].
-           sum().to_frame().reset_index())
-    gbf.sort_values('Grant Amount, USD', ascending=False, inplace=True)
+    return figure_json(fig)
+
+
+def plot_top_funders(aggregates):
+    """Visualize top funding agencies by funding volume.
+
+    :param aggregates: GrantsAggregates.
+    :return: str.
+    """
+    gbf = aggregates.top_funders_frame()
     gbf['Funding Agency'] = gbf['Funding Agency'].apply(word_wrap)
 
     fig = px.treemap(
@@ -113,14 +149,16 @@ def visualize_data(df):
                   'size': 16},
         textinfo="label+value"
     )
-    top_funders_plot = offline.plot(fig, output_type='div')
+    return figure_json(fig)
+
+
+def plot_average_grant_volume(aggregates):
+    """Visualize average grant size by years.
 
-    # Visualizing Average Grant Size by Years
-    agvby = pd.merge(gby, df.groupby('Publication Year')['UT'].count(),
-                     on='Publication Year')
-    agvby['Average Grant Volume'] = agvby['Grant Amount, USD'] / agvby['UT']
-    agvby = agvby.rename(columns={'UT': 'Number of Grants',
-                                  'Grant Amount, USD': 'Total Funding Volume'})
+    :param aggregates: GrantsAggregates.
+    :return: str.
+    """
+    agvby = aggregates.average_grant_volume_frame()
 
     fig = px.bar(
         data_frame=agvby,
@@ -146,14 +184,20 @@ def visualize_data(df):
                       ))
     fig.update_yaxes(title_text=None, showgrid=True, gridcolor='#9D9D9C')
     fig.update_xaxes(title_text=None, linecolor='#9D9D9C')
-    average_grants_volume_by_years_plot = offline.plot(fig, output_type='div')
+    return figure_json(fig)
+
 
-    # Visualizing Top Grants by Associated Web of Science Records
-    df.sort_values('Related WoS Records Count', ascending=False, inplace=True)
-    df['Document Title'] = (df['Document Title'].dropna().apply(word_wrap))
+def plot_top_grants_by_related_records(aggregates):
+    """Visualize top grants by associated Web of Science records.
+
+    :param aggregates: GrantsAggregates.
+    :return: str.
+    """
+    tgbr = aggregates.top_grants_frame()
+    tgbr['Document Title'] = (tgbr['Document Title'].dropna().apply(word_wrap))
 
     fig = px.bar(
-        data_frame=df[:50],
+        data_frame=tgbr,
         x='UT',
         y='Related WoS Records Count',
         hover_name='Document Title',
@@ -176,20 +220,74 @@ def visualize_data(df):
                       ))
     fig.update_yaxes(title_text=None, showgrid=True, gridcolor='#9D9D9C')
     fig.update_xaxes(title_text=None, linecolor='#9D9D9C')
-    top_grants_by_associated_wos_records_plot = offline.plot(fig, output_type='div')
-    return (grants_by_years_plot,
-            top_grant_receivers_plot,
-            top_funders_plot,
-            average_grants_volume_by_years_plot,
-            top_grants_by_associated_wos_records_plot)
+    return figure_json(fig)
+
+
+# The plots in the order they are displayed.
+PLOTS = (
+    plot_funding_by_year,
+    plot_top_grant_receivers,
+    plot_top_funders,
+    plot_average_grant_volume,
+    plot_top_grants_by_related_records
+)
+
+
+class LazyPlots:
+    """The plots of a dataset, each rendered from the aggregates of the
+    grants data on its first lookup by index, and memoized.
+    """
+
+    def __init__(self, aggregates, plots=PLOTS):
+        self.aggregates = aggregates
+        self.plots = plots
+        self.rendered = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.plots)
+
+    def __getitem__(self, index):
+        with self.lock:
+            if index not in self.rendered:
+                with metrics.timer('plot.render'):
+                    self.rendered[index] = self.plots[index](self.aggregates)
+            return self.rendered[index]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
+def visualize_aggregates(aggregates):
+    """Create the various grant data visualizations with Plotly from
+    the running aggregates of the grants data, each rendered when it is
+    first displayed.
+
+    :param aggregates: GrantsAggregates.
+    :return: LazyPlots.
+    """
+    return LazyPlots(aggregates)
 
 
-def visualize_excel(file):
-    """Return graphs objects from previously saved Excel file.
+def visualize_file(file):
+    """Return graphs objects from previously saved Parquet, Feather or
+    Excel file. The graphs are built from the aggregate cube saved next
+    to the file; for the files saved without one, the cube is computed
+    from the columns the graphs need, and saved for the next time.
 
-    :param file:
-    :return: tuple of str.
+    :param file: str.
+    :return: LazyPlots.
     """
-    df = pd.read_excel(file)
-    plots = visualize_data(df)
-    return plots
+    path = cube_path(file)
+    if os.path.exists(path):
+        return visualize_aggregates(GrantsAggregates.load(path))
+    aggregates = GrantsAggregates()
+    aggregates.write(load_grants(file, columns=CHART_COLUMNS))
+    aggregates.save(path)
+    return visualize_aggregates(aggregates)